@@ -22,13 +22,75 @@
 
 // These constants won't change. They're used to give names to the pins used:
 
+// Set to 1 to send fixed-size binary frames instead of one ASCII line per
+// sample. Read them with SerialData(..., protocol='binary') and the matching
+// baud rate.
+#define FRAMED_OUTPUT 0
+
+// Analog inputs sampled together, the PID first. With more than one, each
+// ASCII line holds comma separated values and each framed sample holds one
+// value per input; read them with SerialData(..., channels=N).
+const uint8_t PINS[] = {A3};
+#define CHANNELS (sizeof(PINS) / sizeof(PINS[0]))
+
+#if FRAMED_OUTPUT
+// frame layout, must match frame_dtype() in Arduino_Monitor.py
+#define SAMPLES_PER_FRAME 8
+#define BAUD_RATE 1000000
+
+struct Frame {
+  uint16_t sync;        // 0xA5 0x5A on the wire
+  uint16_t seq;         // frame counter, gaps mean lost frames
+  uint32_t t_us;        // micros() of the first sample
+  uint16_t span_us;     // micros() from the first to the last sample
+  uint16_t samples[SAMPLES_PER_FRAME][CHANNELS];
+  uint8_t checksum;     // sum of all bytes after the sync word
+} __attribute__((packed));
+
+Frame frame;
+#else
+#define BAUD_RATE 115200
+#endif
+
 void setup() {
   // initialize serial communications at 9600 bps:
-  Serial.begin(115200);
+  Serial.begin(BAUD_RATE);
+#if FRAMED_OUTPUT
+  frame.sync = 0x5AA5;
+  frame.seq = 0;
+#endif
 }
 
 void loop() {
-  // read the analog in value:
-  int sensorValue = analogRead(A3);
-  Serial.println(sensorValue);
+#if FRAMED_OUTPUT
+  unsigned long t_first = micros();
+  unsigned long t_last = t_first;
+  for (int i = 0; i < SAMPLES_PER_FRAME; i++) {
+    t_last = micros();
+    for (unsigned int c = 0; c < CHANNELS; c++) {
+      frame.samples[i][c] = analogRead(PINS[c]);
+    }
+  }
+  frame.t_us = t_first;
+  frame.span_us = t_last - t_first;
+
+  uint8_t *bytes = (uint8_t *) &frame;
+  uint8_t sum = 0;
+  for (unsigned int i = 2; i < sizeof(Frame) - 1; i++) {
+    sum += bytes[i];
+  }
+  frame.checksum = sum;
+
+  Serial.write(bytes, sizeof(Frame));
+  frame.seq++;
+#else
+  // read the analog in values:
+  for (unsigned int c = 0; c < CHANNELS; c++) {
+    if (c > 0) {
+      Serial.print(',');
+    }
+    Serial.print(analogRead(PINS[c]));
+  }
+  Serial.println();
+#endif
 }
@@ -2,63 +2,627 @@
 Listen to serial, return most recent numeric values
 Lots of help from here:
 http://stackoverflow.com/questions/1093598/pyserial-how-to-read-last-line-sent-from-serial-device
+
+With ``buffered=True`` every received sample is also kept, together with its
+host receive timestamp, in a preallocated ring buffer that can be read in bulk
+with ``read_available()`` / ``drain()``.
+
+With ``protocol='binary'`` the port is expected to carry the fixed-size frames
+sent by AnalogIntSerial.ino built with ``FRAMED_OUTPUT``, which are decoded a
+whole chunk at a time and checked for lost frames.
+
+With ``channels=N`` the board sends N analog inputs sampled together, as comma
+separated ASCII lines or as frames holding N values per sample, and values are
+``(samples, N)`` arrays.
 """
-from threading import Thread
+from __future__ import print_function
+from threading import Thread, Lock, Event, current_thread
+import select
 import time
+import numpy as np
 import serial
-from datetime import datetime
 
-last_received = ''
+# number of samples kept in the ring buffer, about 8 minutes of the
+# AnalogIntSerial stream at 115200 baud
+DEFAULT_BUFFER_SIZE = 2 ** 20
+# longest time in seconds the acquisition thread blocks before checking
+# for shutdown and new ports
+READ_TIMEOUT = .1
+# idle sleep in seconds when several unselectable ports are polled
+POLL_SLEEP = .005
+# partial lines longer than this are garbage and get discarded
+MAX_LINE_LENGTH = 4096
+
+# binary frame layout, must match AnalogIntSerial.ino
+FRAME_SYNC = (0xA5, 0x5A)
+SAMPLES_PER_FRAME = 8
+SEQ_MODULO = 2 ** 16
+
+try:
+    thread_time = time.thread_time
+except AttributeError:
+    # Python < 3.7 has no per-thread CPU clock, CPU time isn't reported
+    thread_time = None
+
+
+class AcquisitionManager(Thread):
+    """
+    One background thread reading any number of serial ports.
+
+    The thread blocks in ``select`` on all ports at once until one of them
+    has data, takes everything waiting on each ready port in one read and
+    hands the chunk to that channel's parser, a `LineParser` or
+    `FrameDecoder`. Where serial ports can't be selected (Windows) a single
+    port is read with a blocking read bounded by the port timeout, and
+    several ports are polled with short sleeps when all are idle.
+
+    Channels are `SerialData` instances, they register themselves with *add*
+    and unregister with *remove*.
+    """
+
+    def __init__(self, poll_interval=READ_TIMEOUT):
+        Thread.__init__(self, name='AcquisitionManager')
+        self.daemon = True
+
+        self.poll_interval = poll_interval
+        self.channels = []
+
+        self.wakeups = 0
+        self.cpu_time = 0.
+        self.started_at = None
+        self.stopped_at = None
+
+        self._lock = Lock()
+        self._stop_event = Event()
+        self._iteration_done = Event()
+
+    def add(self, channel):
+        """Start reading the port of *channel*."""
+        with self._lock:
+            self.channels = self.channels + [channel]
+        if channel.fileno is None:
+            channel.serial_port.timeout = self.poll_interval
+
+    def remove(self, channel):
+        """Stop reading the port of *channel*, after which it can be closed."""
+        with self._lock:
+            self.channels = [c for c in self.channels if c is not channel]
+        if self.is_alive() and current_thread() is not self:
+            # let the iteration that may still use the port finish
+            self._iteration_done.clear()
+            self._iteration_done.wait(2 * self.poll_interval)
+
+    def stop(self, timeout=1.):
+        """Ask the thread to finish and wait for it."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def wait_for_data(self, channels):
+        """
+        Wait up to *poll_interval* for data, return ``(channel, chunk)``
+        pairs for every port that has some.
+        """
+        if not channels:
+            self._stop_event.wait(self.poll_interval)
+            return []
+        if all(channel.fileno is not None for channel in channels):
+            ready, _, _ = select.select(
+                [channel.fileno for channel in channels], [], [],
+                self.poll_interval
+            )
+            return [
+                (channel, channel.serial_port.read(
+                    max(channel.serial_port.in_waiting, 1)
+                ))
+                for channel in channels if channel.fileno in ready
+            ]
+        if len(channels) == 1:
+            port = channels[0].serial_port
+            chunk = port.read(max(port.in_waiting, 1))
+            if chunk and port.in_waiting:
+                chunk += port.read(port.in_waiting)
+            return [(channels[0], chunk)] if chunk else []
+        chunks = []
+        for channel in channels:
+            waiting = channel.serial_port.in_waiting
+            if waiting:
+                chunks.append((channel, channel.serial_port.read(waiting)))
+        if not chunks:
+            time.sleep(POLL_SLEEP)
+        return chunks
+
+    def run(self):
+        self.started_at = time.time()
+        cpu_start = thread_time() if thread_time is not None else None
+        try:
+            while not self._stop_event.is_set():
+                channels = self.channels
+                try:
+                    chunks = self.wait_for_data(channels)
+                except (serial.SerialException, select.error, OSError,
+                        TypeError, ValueError) as error:
+                    # a port was closed or unplugged under us, drop it and
+                    # keep reading the others
+                    self._drop_broken(channels, error)
+                    chunks = []
+                self.wakeups += 1
+                timestamp = time.time()
+                for channel, chunk in chunks:
+                    channel.feed(chunk, timestamp)
+                if cpu_start is not None:
+                    self.cpu_time = thread_time() - cpu_start
+                self._iteration_done.set()
+        finally:
+            if cpu_start is not None:
+                self.cpu_time = thread_time() - cpu_start
+            self.stopped_at = time.time()
+
+    def _drop_broken(self, channels, error):
+        for channel in channels:
+            try:
+                channel.serial_port.in_waiting
+            except (serial.SerialException, OSError, TypeError, ValueError,
+                    AttributeError):
+                channel.error = error
+                with self._lock:
+                    self.channels = [
+                        c for c in self.channels if c is not channel
+                    ]
+
+    def stats(self):
+        """
+        Return thread counters, including the thread CPU time and the CPU
+        load, CPU seconds per wall second, since the thread started.
+        """
+        cpu_time = self.cpu_time if thread_time is not None else None
+        elapsed = ((self.stopped_at or time.time()) - self.started_at
+                   if self.started_at is not None else 0.)
+        return {
+            'channels': len(self.channels),
+            'wakeups': self.wakeups,
+            'elapsed': elapsed,
+            'cpu_time': cpu_time,
+            'cpu_load': cpu_time / elapsed if cpu_time is not None and elapsed
+            else None,
+        }
+
+
+class LineParser(object):
+    """
+    Parser for the ASCII protocol, one number per line, or with *channels*
+    that many comma separated numbers per line. Lines with another count
+    are bogus.
+
+    Only the trailing partial line of a chunk is carried over to the next
+    one. All samples of a chunk get the chunk receive timestamp.
+    """
+
+    def __init__(self, channels=None):
+        self.channels = channels
+        self.partial = b''
+        self.last_line = b''
+        self.received = 0
+        self.parsed = 0
+
+    def feed(self, chunk, timestamp):
+        """Return ``(timestamps, values)`` of the lines completed by *chunk*."""
+        end = chunk.rfind(b'\n')
+        if end < 0:
+            self.partial += chunk
+            if len(self.partial) > MAX_LINE_LENGTH:
+                # no line ending in sight, this is not our protocol
+                self.partial = b''
+            return self._empty()
+        lines = (self.partial + chunk[:end]).split(b'\n')
+        self.partial = chunk[end + 1:]
+        self.last_line = lines[-1]
+
+        values = []
+        if self.channels is None:
+            for line in lines:
+                try:
+                    values.append(float(line))
+                except ValueError:
+                    pass
+        else:
+            for line in lines:
+                fields = line.split(b',')
+                if len(fields) != self.channels:
+                    continue
+                try:
+                    values.append([float(field) for field in fields])
+                except ValueError:
+                    pass
+        self.received += len(lines)
+        self.parsed += len(values)
+        if not values:
+            return self._empty()
+        return np.full(len(values), timestamp), np.array(values)
+
+    def _empty(self):
+        shape = (0,) if self.channels is None else (0, self.channels)
+        return np.empty(0), np.empty(shape)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'parsed': self.parsed,
+            'bogus': self.received - self.parsed,
+            'lost': 0,
+        }
+
+
+def frame_dtype(samples_per_frame=SAMPLES_PER_FRAME, channels=None):
+    """
+    Return the NumPy dtype of one binary frame, little endian and packed:
+    sync word, sequence counter, device micros() of the first sample, micros
+    from the first to the last sample, the 10 bit ADC samples and an 8 bit
+    sum of all bytes after the sync word. With *channels* each sample holds
+    that many values.
+    """
+    shape = (samples_per_frame,) if channels is None \
+        else (samples_per_frame, channels)
+    return np.dtype([
+        ('sync', '<u2'),
+        ('seq', '<u2'),
+        ('t_us', '<u4'),
+        ('span_us', '<u2'),
+        ('samples', '<u2', shape),
+        ('checksum', 'u1'),
+    ])
+
+
+class FrameDecoder(object):
+    """
+    Vectorized decoder for the binary frame protocol.
+
+    Each chunk is scanned for runs of back to back frames, which are viewed
+    with ``np.frombuffer`` and checksummed in one go. Gaps in the sequence
+    counter are counted as lost frames, so ``lost`` samples is exact as long
+    as fewer than 65536 frames go missing in a row. Samples are timestamped
+    on the host clock: the newest sample of a chunk gets the chunk receive
+    time and the others are placed before it using the device micros().
+    """
+
+    def __init__(self, samples_per_frame=SAMPLES_PER_FRAME, channels=None):
+        self.dtype = frame_dtype(samples_per_frame, channels)
+        self.frame_size = self.dtype.itemsize
+        self.samples_per_frame = samples_per_frame
+        self.channels = channels
+        self.pending = b''
+        self.last_seq = None
+        self.last_value = None
 
+        self.frames = 0
+        self.lost_frames = 0
+        self.bad_frames = 0
+        self.skipped_bytes = 0
 
-def receiving(serial_port):
-    global last_received
-    buffer = ''
-    while True:
-        buffer += serial_port.read_all()
-        if '\n' in buffer:
-            lines = buffer.split('\n')  # Guaranteed to have at least 2 entries
-            last_received = lines[-2]
-            # If the Arduino sends lots of empty lines, you'll lose the last
-            # filled line, so you could make the above statement conditional
-            # like so: if lines[-2]: last_received = lines[-2]
-            buffer = lines[-1]
+    def _find_frames(self, data):
+        """Return the valid frames in *data* and the number of bytes used."""
+        raw = np.frombuffer(data, dtype=np.uint8)
+        size = self.frame_size
+        found = []
+        pos = 0
+        while len(raw) - pos >= size:
+            if raw[pos] != FRAME_SYNC[0] or raw[pos + 1] != FRAME_SYNC[1]:
+                rest = raw[pos:]
+                sync = np.flatnonzero(
+                    (rest[:-1] == FRAME_SYNC[0]) & (rest[1:] == FRAME_SYNC[1])
+                )
+                skip = int(sync[0]) if len(sync) else len(rest) - 1
+                self.skipped_bytes += skip
+                pos += skip
+                continue
+            # frames following this one back to back
+            count = (len(raw) - pos) // size
+            block = raw[pos:pos + count * size].reshape(count, size)
+            aligned = (block[:, 0] == FRAME_SYNC[0]) & \
+                (block[:, 1] == FRAME_SYNC[1])
+            run = count if aligned.all() else int(np.argmin(aligned))
+            block = block[:run]
+            frames = np.frombuffer(
+                data, dtype=self.dtype, count=run, offset=pos
+            )
+            checksum = block[:, 2:-1].sum(axis=1) & 0xFF
+            good = checksum == block[:, -1]
+            self.bad_frames += run - int(np.count_nonzero(good))
+            found.append(frames[good])
+            pos += run * size
+        if found:
+            return np.concatenate(found), pos
+        return np.empty(0, dtype=self.dtype), pos
+
+    def feed(self, chunk, timestamp):
+        """Return ``(timestamps, values)`` of frames completed by *chunk*."""
+        data = self.pending + chunk
+        frames, used = self._find_frames(data)
+        self.pending = data[used:]
+        if not len(frames):
+            shape = (0,) if self.channels is None else (0, self.channels)
+            return np.empty(0), np.empty(shape)
+
+        seq = frames['seq'].astype(np.int64)
+        previous = np.empty_like(seq)
+        previous[0] = seq[0] - 1 if self.last_seq is None else self.last_seq
+        previous[1:] = seq[:-1]
+        step = (seq - previous) % SEQ_MODULO
+        # a step of 0 is a repeated frame, nothing was lost
+        self.lost_frames += int(np.maximum(step - 1, 0).sum())
+        self.last_seq = int(seq[-1])
+        self.frames += len(frames)
+
+        n = self.samples_per_frame
+        offsets = np.arange(n) / max(n - 1., 1.)
+        t_us = frames['t_us'].astype(np.int64)
+        # micros() wraps every ~71 minutes, take differences modulo 2**32
+        t_us = (t_us - t_us[-1] + 2 ** 31) % 2 ** 32 - 2 ** 31
+        device_us = t_us[:, None] + \
+            offsets[None, :] * frames['span_us'][:, None]
+        timestamps = timestamp + (device_us - device_us[-1, -1]).ravel() * 1e-6
+        values = frames['samples'].reshape(
+            (-1,) + frames['samples'].shape[2:]
+        ).astype(np.float64)
+        self.last_value = values[-1]
+        return timestamps, values
+
+    def stats(self):
+        return {
+            'received': self.frames,
+            'parsed': self.frames * self.samples_per_frame,
+            'bogus': self.bad_frames,
+            'lost': self.lost_frames * self.samples_per_frame,
+            'skipped_bytes': self.skipped_bytes,
+        }
+
+
+class SampleBuffer(object):
+    """
+    Preallocated ring buffer of timestamped samples.
+
+    One producer appends with *extend* and one consumer takes the unread
+    samples in bulk. If the consumer falls more than *capacity* samples
+    behind, the oldest unread samples are overwritten and counted in
+    *dropped*. With *channels* every sample is a row of that many values.
+    """
+
+    def __init__(self, capacity=DEFAULT_BUFFER_SIZE, channels=None):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        shape = (capacity,) if channels is None else (capacity, channels)
+        self.values = np.zeros(shape, dtype=np.float64)
+        self.written = 0
+        self.read_index = 0
+        self.dropped = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return self.written - self.read_index
+
+    def extend(self, timestamps, values):
+        """Append samples, overwriting the oldest unread ones if full."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return
+        with self._lock:
+            if n > self.capacity:
+                # only the newest *capacity* samples can be kept
+                self.written += n - self.capacity
+                timestamps = timestamps[-self.capacity:]
+                values = values[-self.capacity:]
+                n = self.capacity
+            start = self.written % self.capacity
+            first = min(n, self.capacity - start)
+            self.timestamps[start:start + first] = timestamps[:first]
+            self.values[start:start + first] = values[:first]
+            self.timestamps[:n - first] = timestamps[first:]
+            self.values[:n - first] = values[first:]
+            self.written += n
+            overrun = self.written - self.read_index - self.capacity
+            if overrun > 0:
+                self.dropped += overrun
+                self.read_index += overrun
+
+    def read_available(self, max_samples=None):
+        """
+        Return ``(timestamps, values)`` arrays holding the unread samples,
+        oldest first, and mark them as read.
+
+        At most *max_samples* samples are returned if it is given.
+        """
+        with self._lock:
+            n = self.written - self.read_index
+            if max_samples is not None:
+                n = min(n, max_samples)
+            start = self.read_index % self.capacity
+            first = min(n, self.capacity - start)
+            timestamps = np.concatenate((
+                self.timestamps[start:start + first],
+                self.timestamps[:n - first]
+            ))
+            values = np.concatenate((
+                self.values[start:start + first],
+                self.values[:n - first]
+            ))
+            self.read_index += n
+        return timestamps, values
+
+    def drain(self):
+        """Return all unread samples and mark them as read."""
+        return self.read_available()
 
 
 class SerialData(object):
+    """
+    Serial data source.
+
+    Positional and keyword arguments are passed to ``serial.Serial``, except
+    for *buffered* and *buffer_size*, which enable the lossless acquisition
+    mode, *protocol*, ``'ascii'`` (default) or ``'binary'``, *channels*, the
+    number of analog inputs the board sends per sample if there are several,
+    and *manager*, an `AcquisitionManager` shared with other ports. Without a
+    manager the port gets one of its own. With *start* False the port is
+    only read once `start` is called, e.g. after adding the listeners.
+    """
+
+    def __init__(self, *args, **kwargs):
+        buffered = kwargs.pop('buffered', False)
+        buffer_size = kwargs.pop('buffer_size', DEFAULT_BUFFER_SIZE)
+        protocol = kwargs.pop('protocol', 'ascii')
+        channels = kwargs.pop('channels', None)
+        manager = kwargs.pop('manager', None)
+        start = kwargs.pop('start', True)
 
-    def __init__(self, **kwargs):
+        self.manager = None
+        self.serial_port = None
+        # a single channel keeps the one dimensional values
+        self.channels = channels if channels != 1 else None
+        if protocol == 'ascii':
+            self.parser = LineParser(self.channels)
+        elif protocol == 'binary':
+            self.parser = FrameDecoder(channels=self.channels)
+        else:
+            raise ValueError('unknown protocol {!r}'.format(protocol))
+        self.buffer = SampleBuffer(buffer_size, self.channels) \
+            if buffered else None
+        self.listeners = []
+
+        self.bytes_read = 0
+        self.chunks_read = 0
+        self.error = None
+
+        self._owns_manager = False
         try:
-            self.serial_port = serial.Serial(**kwargs)
-        except serial.serialutil.SerialException:
+            self.serial_port = serial.Serial(*args, **kwargs)
+        except serial.serialutil.SerialException as error:
             # no serial connection
             self.serial_port = None
-        else:
-            Thread(target=receiving, args=(self.serial_port,)).start()
+            self.error = error
+            self.name = kwargs.get('port', args[0] if args else None)
+            return
+        self.name = self.serial_port.port
+        try:
+            self.fileno = self.serial_port.fileno()
+        except (AttributeError, IOError, ValueError):
+            self.fileno = None
+
+        if manager is None:
+            manager = AcquisitionManager()
+            self._owns_manager = True
+        self.manager = manager
+        manager.add(self)
+        if start:
+            self.start()
+
+    def start(self):
+        """Start the manager reading the port, if it isn't running yet."""
+        if self.manager is not None and not self.manager.is_alive():
+            self.manager.start()
+
+    def add_listener(self, listener):
+        """
+        Call *listener* with ``(timestamps, values)`` of every parsed batch.
+
+        Listeners run on the acquisition thread and must return quickly, e.g. by
+        queueing the samples like `SessionRecorder.write` does.
+        """
+        self.listeners.append(listener)
+
+    def feed(self, chunk, timestamp):
+        """Parse a chunk read by the manager at *timestamp*."""
+        self.bytes_read += len(chunk)
+        self.chunks_read += 1
+        timestamps, values = self.parser.feed(chunk, timestamp)
+        if len(values):
+            self._publish(timestamps, values)
+
+    def _publish(self, timestamps, values):
+        if self.buffer is not None:
+            self.buffer.extend(timestamps, values)
+        for listener in self.listeners:
+            listener(timestamps, values)
 
     def next(self):
         if self.serial_port is None:
             # return anything so we can test when Arduino isn't connected
             return 100
-        # return a float value or try a few times until we get one
-        for i in range(40):
-            raw_line = last_received
+        if isinstance(self.parser, FrameDecoder):
+            value = self.parser.last_value
+            if value is None:
+                return 0.
+            return value if self.channels is None else value[0]
+        # the value of the last line, of the first channel if there are
+        # several
+        raw_line = self.parser.last_line.split(b',')[0]
+        try:
+            return float(raw_line.strip())
+        except ValueError:
+            # counted in stats()['bogus'] by the parser
+            return 0.
+
+    def read_available(self, max_samples=None):
+        """Return unread ``(timestamps, values)``, requires buffered mode."""
+        if self.buffer is None:
+            raise RuntimeError('read_available() requires buffered=True')
+        return self.buffer.read_available(max_samples)
+
+    def drain(self):
+        """
+        Return all unread ``(timestamps, values)`` without blocking, requires
+        buffered mode. This is the batched data source interface used by
+        `GraphFrame`.
+        """
+        if self.serial_port is None:
+            # return anything so we can test when Arduino isn't connected
+            values = np.full((1, self.channels or 1), 100.)
+            return np.array([time.time()]), \
+                values[:, 0] if self.channels is None else values
+        if self.buffer is None:
+            raise RuntimeError('drain() requires buffered=True')
+        return self.buffer.drain()
+
+    def stats(self):
+        """
+        Return counters of received bytes, lines or frames, parsed samples,
+        samples lost on the link and samples dropped from the buffer, merged
+        with the counters of the manager thread. *backlog* is the number of
+        bytes waiting in the serial driver.
+        """
+        stats = self.manager.stats() if self.manager is not None else {}
+        stats['bytes'] = self.bytes_read
+        stats['chunks'] = self.chunks_read
+        stats['backlog'] = 0
+        if self.serial_port is not None:
             try:
-                valueNow =  float(raw_line.strip())
-                print(str(datetime.now()) + '\t' + str(valueNow))
-                return valueNow
-            except ValueError:
-                print 'bogus data', raw_line
-                time.sleep(.005)
-        return 0.
+                stats['backlog'] = self.serial_port.in_waiting
+            except (serial.SerialException, OSError):
+                pass
+        stats.update(self.parser.stats())
+        stats['dropped'] = self.buffer.dropped if self.buffer is not None \
+            else 0
+        return stats
 
-    def __del__(self):
+    def close(self):
+        """Stop reading the port and close it."""
+        if self.manager is not None:
+            self.manager.remove(self)
+            if self._owns_manager:
+                self.manager.stop()
+            self.manager = None
         if self.serial_port is not None:
             self.serial_port.close()
+            self.serial_port = None
+
+    def __del__(self):
+        self.close()
 
 
 if __name__ == '__main__':
     s = SerialData('com4')
     for i in range(500):
         time.sleep(.015)
-        print s.next()
+        print(s.next())
+    s.close()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks of the acquisition and plotting code, written out as JSON.
+
+* parse: throughput of `LineParser` and `FrameDecoder` on in-memory streams.
+* serial: a fake Arduino writes numbered samples into a pseudo-terminal at
+  fixed rates while they are read by `SerialData` and plotted on an Agg
+  canvas by the `PlotRenderer` of `GraphFrame`. Reports sample loss and the
+  latency from writing a sample to the end of the first redraw showing it.
+  Needs a POSIX system.
+* redraw: time of one redraw against history length, following the newest
+  10 s and showing the whole history, with full redraws and blitting.
+
+Compare result files of two versions to catch regressions.
+"""
+from __future__ import print_function, division
+from threading import Thread, Event
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa
+
+from Arduino_Monitor import (  # noqa
+    FrameDecoder, LineParser, SerialData, frame_dtype
+)
+from decimation import SampleHistory  # noqa
+from plot_renderer import DPI, PlotRenderer, channel_extrema  # noqa
+
+BENCHMARKS = ("parse", "serial", "redraw")
+PARSE_SAMPLES = 10 ** 6
+# bytes handed to a parser per feed, about one read of a busy port
+CHUNK_SIZE = 4096
+SERIAL_RATES = (1000, 10000, 50000)
+SERIAL_DURATION = 3.
+HISTORY_LENGTHS = (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+REDRAW_REPEATS = 20
+# samples/s of the histories the redraws are timed on
+HISTORY_RATE = 1000.
+X_WINDOW = 10.
+REFRESH_INTERVAL = .09
+FIGURE_SIZE = (8., 5.)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return a dict of the given percentiles of *values*, None if empty."""
+    if not len(values):
+        return {'p{}'.format(p): None for p in points}
+    return {
+        'p{}'.format(p): float(np.percentile(values, p)) for p in points
+    }
+
+
+def ascii_stream(n_samples):
+    """Return the bytes AnalogIntSerial.ino prints for *n_samples*."""
+    values = np.arange(n_samples) % 1024
+    return ''.join('{}\r\n'.format(v) for v in values.tolist()).encode()
+
+
+def frame_stream(n_frames, samples_per_frame=8):
+    """Return *n_frames* valid binary frames."""
+    frames = np.zeros(n_frames, dtype=frame_dtype(samples_per_frame))
+    frames['sync'] = 0x5AA5
+    frames['seq'] = np.arange(n_frames) % 2 ** 16
+    frames['t_us'] = np.arange(n_frames) * 800
+    frames['span_us'] = 700
+    frames['samples'] = np.arange(n_frames * samples_per_frame).reshape(
+        n_frames, samples_per_frame
+    ) % 1024
+    raw = frames.view(np.uint8).reshape(n_frames, -1)
+    frames['checksum'] = raw[:, 2:-1].sum(axis=1) % 256
+    return frames.tobytes()
+
+
+def time_parser(parser, stream):
+    started = time.perf_counter()
+    parsed = 0
+    for start in range(0, len(stream), CHUNK_SIZE):
+        parsed += len(parser.feed(stream[start:start + CHUNK_SIZE], 0.)[1])
+    elapsed = time.perf_counter() - started
+    return {
+        'samples': parsed,
+        'bytes': len(stream),
+        'seconds': elapsed,
+        'samples_per_s': parsed / elapsed,
+        'mbytes_per_s': len(stream) / elapsed / 1e6,
+    }
+
+
+def bench_parse(n_samples=PARSE_SAMPLES):
+    return {
+        'ascii': time_parser(LineParser(), ascii_stream(n_samples)),
+        'binary': time_parser(FrameDecoder(), frame_stream(n_samples // 8)),
+    }
+
+
+class AggPlot(object):
+    """
+    The plotting path of `GraphFrame` on an Agg canvas: Y extrema and min/max
+    envelope of the visible range drawn by its `PlotRenderer`, with a full
+    redraw or a blit of the line collection. *history* is a `SampleHistory`
+    of one channel, plotted with the default controls.
+    """
+
+    def __init__(self, history, blit=False):
+        self.histories = [history]
+        self.channels = [(0, 0)]
+        self.settings = [(True, 1.)]
+        self.renderer = PlotRenderer(
+            len(self.channels), blit=blit, size=FIGURE_SIZE, dpi=DPI
+        )
+        self.renderer.attach(FigureCanvasAgg(self.renderer.figure))
+
+    def draw(self, x_min, x_max, newest=False):
+        y_min, y_max = channel_extrema(
+            self.histories, self.channels, self.settings, x_min, x_max,
+            newest
+        )
+        if y_min is None:
+            y_min, y_max = 0, 1023
+        self.renderer.set_data(
+            self.histories, self.channels, self.settings, x_min, x_max
+        )
+        self.renderer.draw(x_min, x_max, round(y_min) - 1, round(y_max) + 1)
+
+
+def bench_redraw(lengths=HISTORY_LENGTHS, repeats=REDRAW_REPEATS):
+    random = np.random.RandomState(0)
+    results = []
+    for length in lengths:
+        # one channel of a single source, like in GraphFrame
+        history = SampleHistory(channels=1)
+        times = np.arange(length) / HISTORY_RATE
+        history.extend(
+            times, np.round(300 + 200 * np.sin(times) +
+                            random.normal(0, 5, length))[:, None]
+        )
+        t_last = times[-1]
+        result = {'samples': length}
+        for blit in (False, True):
+            for view, x_min in (('follow', t_last - X_WINDOW),
+                                ('full', 0.)):
+                plot = AggPlot(history, blit)
+                # first draw caches the background in blit mode
+                plot.draw(x_min, t_last, view == 'follow')
+                durations = []
+                for _ in range(repeats):
+                    started = time.perf_counter()
+                    plot.draw(x_min, t_last, view == 'follow')
+                    durations.append(1000 * (time.perf_counter() - started))
+                key = '{}_{}_ms'.format('blit' if blit else 'full', view)
+                result[key] = percentiles(durations)
+        results.append(result)
+        print('redraw {:>9d} samples: {}'.format(length, ', '.join(
+            '{} {:.2f}'.format(key, value['p50'])
+            for key, value in sorted(result.items()) if key != 'samples'
+        )), file=sys.stderr)
+    return results
+
+
+class FakeArduino(Thread):
+    """
+    Writes numbered ASCII samples into the master side of a pty at *rate*
+    samples/s, remembering when each one was written.
+    """
+
+    def __init__(self, master, rate, duration):
+        Thread.__init__(self, name='FakeArduino')
+        self.daemon = True
+        self.master = master
+        self.rate = rate
+        self.n_samples = int(rate * duration)
+        self.sent_at = np.zeros(self.n_samples)
+        self.done = Event()
+
+    def run(self):
+        started = time.time()
+        sent = 0
+        while sent < self.n_samples:
+            due = min(int((time.time() - started) * self.rate) + 1,
+                      self.n_samples)
+            if due > sent:
+                # unlike ADC counts the values don't wrap, they number the
+                # samples so losses and latencies can be matched up
+                data = ''.join(
+                    '{}\r\n'.format(i) for i in range(sent, due)
+                ).encode()
+                view = memoryview(data)
+                while len(view):
+                    view = view[os.write(self.master, view):]
+                self.sent_at[sent:due] = time.time()
+                sent = due
+            time.sleep(.001)
+        self.done.set()
+
+
+def bench_serial(rates=SERIAL_RATES, duration=SERIAL_DURATION):
+    import pty
+    import tty
+
+    results = []
+    for rate in rates:
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        source = SerialData(os.ttyname(slave), buffered=True)
+        history = SampleHistory(channels=1)
+        plot = AggPlot(history)
+        writer = FakeArduino(master, rate, duration)
+
+        plotted_at = np.full(writer.n_samples, np.nan)
+        draw_times = []
+        lateness = []
+        writer.start()
+        next_tick = time.time()
+        while True:
+            finished = writer.done.is_set()
+            timestamps, values = source.drain()
+            if len(values):
+                history.extend(timestamps, values[:, None])
+            t_last = history.latest_time() or 0.
+            started = time.time()
+            plot.draw(t_last - X_WINDOW, t_last, newest=True)
+            now = time.time()
+            draw_times.append(1000 * (now - started))
+            index = values.astype(np.int64)
+            index = index[(index >= 0) & (index < writer.n_samples)]
+            plotted_at[index] = now
+            if finished and not len(values):
+                break
+            next_tick += REFRESH_INTERVAL
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lateness.append(-1000 * delay)
+                next_tick = time.time()
+
+        stats = source.stats()
+        source.close()
+        os.close(master)
+        os.close(slave)
+
+        received = ~np.isnan(plotted_at)
+        latency = 1000 * (plotted_at - writer.sent_at)[received]
+        result = {
+            'rate': rate,
+            'sent': writer.n_samples,
+            'plotted': int(received.sum()),
+            'lost': int(writer.n_samples - received.sum()),
+            'bogus': stats.get('bogus', 0),
+            'latency_ms': percentiles(latency),
+            'draw_ms': percentiles(draw_times),
+            'late_ticks': len(lateness),
+            'cpu_load': stats.get('cpu_load'),
+        }
+        results.append(result)
+        print('serial {:>6d}/s: lost {} latency p50 {:.1f} ms'.format(
+            rate, result['lost'], result['latency_ms']['p50'] or 0.
+        ), file=sys.stderr)
+    return results
+
+
+def environment():
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'matplotlib': matplotlib.__version__,
+    }
+
+
+def parse_script_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="benchmarks to run, parse, serial or redraw, "
+                             "all by default")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="write the JSON results here instead of stdout")
+    parser.add_argument("--rates", type=int, nargs="+",
+                        default=SERIAL_RATES,
+                        help="fake Arduino sample rates")
+    parser.add_argument("--duration", type=float, default=SERIAL_DURATION,
+                        help="seconds of data sent at each rate")
+    parser.add_argument("--lengths", type=int, nargs="+",
+                        default=HISTORY_LENGTHS,
+                        help="history lengths of the redraw benchmark")
+    parser.add_argument("--quick", action="store_true",
+                        help="smaller sizes for a fast smoke run")
+
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {!r}".format(name))
+    if args.quick:
+        args.rates = args.rates[:1]
+        args.duration = min(args.duration, 1.)
+        args.lengths = [n for n in args.lengths if n <= 10 ** 5]
+    return args
+
+
+def main():
+    args = parse_script_args()
+    selected = args.benchmarks or BENCHMARKS
+    results = {'environment': environment()}
+
+    if "parse" in selected:
+        results['parse'] = bench_parse(
+            PARSE_SAMPLES // 10 if args.quick else PARSE_SAMPLES
+        )
+    if "serial" in selected:
+        if os.name == 'posix':
+            results['serial'] = bench_serial(args.rates, args.duration)
+        else:
+            print('serial benchmark needs a pty, skipped', file=sys.stderr)
+    if "redraw" in selected:
+        results['redraw'] = bench_redraw(args.lengths)
+
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Min/max envelope decimation of long sample histories for plotting.
+
+`MinMaxPyramid` keeps per-block minima and maxima of a growing series at
+levels of 8, 64, 512, ... samples per block, updated incrementally as samples
+are appended. An envelope of any index range is then built from the coarsest
+level that still has at least a block per output bin, so the cost of a
+frame depends on the number of pixels, not on the length of the session.
+
+The same levels answer range minimum/maximum queries in O(log n), and
+`SlidingExtrema` tracks the extrema of the newest samples in amortized O(1).
+
+Several channels sampled together can share one pyramid: their values are
+the columns of a 2-D series and every level, query and envelope covers all
+of them in one pass.
+"""
+from collections import deque
+import numpy as np
+
+# samples per block of the first level, and blocks per block of the next
+BLOCK = 8
+
+
+class GrowableArray(object):
+    """
+    NumPy array growing along its first axis with amortized O(1) appends.
+    Rows have the given *shape*, scalars by default.
+    """
+
+    def __init__(self, dtype=np.float64, capacity=1024, shape=()):
+        self._data = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def data(self):
+        """View of the filled part of the array."""
+        return self._data[:self._size]
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._data.dtype)
+        end = self._size + len(values)
+        if end > len(self._data):
+            capacity = max(end, 2 * len(self._data))
+            data = np.empty(
+                (capacity,) + self._data.shape[1:], dtype=self._data.dtype
+            )
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:end] = values
+        self._size = end
+
+
+class MinMaxPyramid(object):
+    """
+    Incrementally updated min/max pyramid over a growing series.
+
+    Level 0 is the raw series, level *k* holds the minimum and maximum of
+    every complete block of ``BLOCK ** k`` samples. With *channels* the
+    series has that many columns, reduced independently.
+    """
+
+    def __init__(self, channels=None):
+        self.shape = () if channels is None else (channels,)
+        self.values = GrowableArray(shape=self.shape)
+        self.mins = []
+        self.maxs = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, values):
+        """Append *values* and update the levels they complete."""
+        self.values.extend(values)
+        lower_min = lower_max = self.values.data
+        level = 0
+        while len(lower_min) >= BLOCK:
+            if level == len(self.mins):
+                self.mins.append(GrowableArray(shape=self.shape))
+                self.maxs.append(GrowableArray(shape=self.shape))
+            mins, maxs = self.mins[level], self.maxs[level]
+            start = len(mins) * BLOCK
+            stop = len(lower_min) // BLOCK * BLOCK
+            blocks = (-1, BLOCK) + self.shape
+            if stop > start:
+                mins.extend(
+                    lower_min[start:stop].reshape(blocks).min(axis=1)
+                )
+                maxs.extend(
+                    lower_max[start:stop].reshape(blocks).max(axis=1)
+                )
+            lower_min, lower_max = mins.data, maxs.data
+            level += 1
+
+    def _level_extrema(self, level, start, stop):
+        """
+        Return per-block minima, maxima and first sample index covering
+        samples ``[start, stop)`` at *level*, the first and last block
+        possibly partial.
+        """
+        values = self.values.data
+        if level == 0:
+            values = values[start:stop]
+            return values, values, np.arange(start, stop)
+        size = BLOCK ** level
+        mins = self.mins[level - 1].data
+        maxs = self.maxs[level - 1].data
+        # only the blocks entirely within the range
+        first = -(-start // size)
+        last = min(stop // size, len(mins))
+        if last < first:
+            # no complete block, a single partial one
+            values = values[start:stop]
+            return (values.min(axis=0)[None], values.max(axis=0)[None],
+                    np.array([start]))
+        head, tail = first * size, last * size
+        parts = []
+        if start < head:
+            # samples before the first complete block of this level
+            rest = values[start:head]
+            parts.append((rest.min(axis=0)[None], rest.max(axis=0)[None],
+                          [start]))
+        parts.append((mins[first:last], maxs[first:last],
+                      np.arange(first, last) * size))
+        if tail < stop:
+            # samples after the last complete block of this level
+            rest = values[tail:stop]
+            parts.append((rest.min(axis=0)[None], rest.max(axis=0)[None],
+                          [tail]))
+        block_mins, block_maxs, index = zip(*parts)
+        return (np.concatenate(block_mins), np.concatenate(block_maxs),
+                np.concatenate(index).astype(int))
+
+    def extrema(self, start, stop):
+        """
+        Return ``(minimum, maximum)`` of samples ``[start, stop)`` or
+        ``(None, None)`` if the range is empty. Per channel arrays of them
+        with several channels.
+
+        Unaligned ends are scanned at each level and the aligned middle is
+        passed up to the next one, so at most ``2 * BLOCK`` entries are
+        looked at per level.
+        """
+        start = max(int(start), 0)
+        stop = min(int(stop), len(self))
+        if stop <= start:
+            return None, None
+        minimum = np.full(self.shape, np.inf)
+        maximum = np.full(self.shape, -np.inf)
+        level = 0
+        while start < stop:
+            if level == 0:
+                mins = maxs = self.values.data
+            else:
+                mins = self.mins[level - 1].data
+                maxs = self.maxs[level - 1].data
+            aligned_start = -(-start // BLOCK) * BLOCK
+            aligned_stop = stop // BLOCK * BLOCK
+            if level == len(self.mins) or aligned_stop <= aligned_start:
+                edges = ((start, stop),)
+            else:
+                edges = ((start, aligned_start), (aligned_stop, stop))
+            for edge_start, edge_stop in edges:
+                if edge_stop > edge_start:
+                    minimum = np.minimum(
+                        minimum, mins[edge_start:edge_stop].min(axis=0)
+                    )
+                    maximum = np.maximum(
+                        maximum, maxs[edge_start:edge_stop].max(axis=0)
+                    )
+            if len(edges) == 1:
+                break
+            start = aligned_start // BLOCK
+            stop = aligned_stop // BLOCK
+            level += 1
+        if not self.shape:
+            return float(minimum), float(maximum)
+        return minimum, maximum
+
+    def envelope(self, start, stop, n_bins):
+        """
+        Return ``(indices, values)`` of at most about ``2 * n_bins`` points
+        tracing the min/max envelope of samples ``[start, stop)``.
+
+        Ranges shorter than ``2 * n_bins`` are returned undecimated.
+        """
+        start = max(int(start), 0)
+        stop = min(int(stop), len(self))
+        n_bins = max(int(n_bins), 1)
+        if stop - start <= 2 * n_bins:
+            return np.arange(start, stop), self.values.data[start:stop]
+
+        per_bin = (stop - start) / float(n_bins)
+        level = 0
+        while level < len(self.mins) and BLOCK ** (level + 1) <= per_bin:
+            level += 1
+        mins, maxs, index = self._level_extrema(level, start, stop)
+
+        # merge blocks into bins of equal block count
+        group = int(np.ceil(len(mins) / float(n_bins)))
+        if group > 1:
+            count = len(mins) // group * group
+            groups = (-1, group) + self.shape
+            bin_mins = mins[:count].reshape(groups).min(axis=1)
+            bin_maxs = maxs[:count].reshape(groups).max(axis=1)
+            bin_index = index[:count:group]
+            if count < len(mins):
+                bin_mins = np.concatenate(
+                    (bin_mins, mins[count:].min(axis=0)[None])
+                )
+                bin_maxs = np.concatenate(
+                    (bin_maxs, maxs[count:].max(axis=0)[None])
+                )
+                bin_index = np.append(bin_index, index[count])
+            mins, maxs, index = bin_mins, bin_maxs, bin_index
+
+        indices = np.repeat(index, 2)
+        values = np.empty((2 * len(mins),) + self.shape)
+        values[0::2] = mins
+        values[1::2] = maxs
+        return indices, values
+
+
+class SlidingExtrema(object):
+    """
+    Minimum and maximum of the newest samples of a series.
+
+    Monotonic deques of ``(index, value)`` keep only the samples that can
+    still become the extremum of a window ending at the newest sample.
+    Samples older than *window* are evicted as new ones arrive, and a query
+    can move the window start further forward. Window starts must not move
+    backwards.
+
+    Each batch is reduced with NumPy first: only the samples beyond every
+    later sample of the batch can stay in a deque, so for noisy data few of
+    them are pushed.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.count = 0
+        self._mins = deque()
+        self._maxs = deque()
+
+    def extend(self, values):
+        values = np.asarray(values)
+        first = self.count
+        self.count += len(values)
+        if len(values) > self.window:
+            # older samples fall out of the window straight away
+            first = self.count - self.window
+            values = values[-self.window:]
+        if not len(values):
+            return
+        # extrema of the samples after each one, in the batch
+        later_mins = np.empty(len(values), dtype=np.float64)
+        later_maxs = np.empty(len(values), dtype=np.float64)
+        later_mins[-1], later_maxs[-1] = np.inf, -np.inf
+        later_mins[:-1] = np.minimum.accumulate(values[:0:-1])[::-1]
+        later_maxs[:-1] = np.maximum.accumulate(values[:0:-1])[::-1]
+        minimum, maximum = values.min(), values.max()
+        while self._mins and self._mins[-1][1] >= minimum:
+            self._mins.pop()
+        while self._maxs and self._maxs[-1][1] <= maximum:
+            self._maxs.pop()
+        for queue, candidates in ((self._mins, values < later_mins),
+                                  (self._maxs, values > later_maxs)):
+            index = np.flatnonzero(candidates)
+            queue.extend(zip((index + first).tolist(),
+                             values[index].tolist()))
+        self._evict(self.count - self.window)
+
+    def covers(self, start):
+        """Return whether the samples from index *start* are all kept."""
+        return start >= self.count - self.window
+
+    def _evict(self, start):
+        while self._mins and self._mins[0][0] < start:
+            self._mins.popleft()
+        while self._maxs and self._maxs[0][0] < start:
+            self._maxs.popleft()
+
+    def extrema(self, start=None):
+        """
+        Return ``(minimum, maximum)`` of samples from index *start*, by
+        default of the last *window* samples, or ``(None, None)``.
+        """
+        if start is not None:
+            self._evict(start)
+        if not self._mins:
+            return None, None
+        return self._mins[0][1], self._maxs[0][1]
+
+
+class SampleHistory(object):
+    """
+    Plotted history of one data source: sample times, the min/max pyramid of
+    the values and the sliding extrema of the newest samples.
+
+    With *channels* the values are rows of that many channels sampled at the
+    same times, and extrema are per channel arrays.
+
+    Times must be non-decreasing; ranges are looked up by bisection.
+    """
+
+    def __init__(self, max_window_samples=2 ** 20, channels=None):
+        self.channels = channels
+        self.times = GrowableArray()
+        self.values = MinMaxPyramid(channels)
+        self.recent = [
+            SlidingExtrema(max_window_samples)
+            for _ in range(1 if channels is None else channels)
+        ]
+
+    def __len__(self):
+        return len(self.values)
+
+    def extend(self, times, values):
+        self.times.extend(times)
+        self.values.extend(values)
+        if self.channels is None:
+            self.recent[0].extend(values)
+        else:
+            for channel, recent in enumerate(self.recent):
+                recent.extend(values[:, channel])
+
+    def latest_time(self):
+        """Return the time of the newest sample, None before the first."""
+        return self.times.data[-1] if len(self.times) else None
+
+    def index_range(self, t_min, t_max):
+        """Return the index range of the samples with t_min <= t <= t_max."""
+        times = self.times.data
+        return (
+            int(times.searchsorted(t_min, 'left')),
+            int(times.searchsorted(t_max, 'right')),
+        )
+
+    def extrema(self, t_min, t_max, newest=False):
+        """
+        Return ``(minimum, maximum)`` of the samples between *t_min* and
+        *t_max*, or ``(None, None)``. With *newest* the range is known to end
+        at the newest sample and the sliding extrema answer it; the *t_min*
+        of such queries must not decrease. Ranges longer than
+        *max_window_samples* are answered by the pyramid.
+        """
+        start, stop = self.index_range(t_min, t_max)
+        if not newest or not self.recent[0].covers(start):
+            return self.values.extrema(start, stop)
+        if self.channels is None:
+            return self.recent[0].extrema(start)
+        extrema = [recent.extrema(start) for recent in self.recent]
+        if extrema[0][0] is None:
+            return None, None
+        return (np.array([pair[0] for pair in extrema]),
+                np.array([pair[1] for pair in extrema]))
+
+    def envelope(self, t_min, t_max, n_bins):
+        """Return ``(times, values)`` of the min/max envelope of a range."""
+        start, stop = self.index_range(t_min, t_max)
+        indices, values = self.values.envelope(start, stop, n_bins)
+        return self.times.data[indices], values
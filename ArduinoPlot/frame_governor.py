@@ -0,0 +1,87 @@
+"""
+Pacing of the plot redraws.
+
+`FrameGovernor` keeps a moving average of what a redraw of `GraphFrame`
+costs and stretches the refresh interval so that redrawing takes at most a
+*budget* fraction of the time, leaving the rest of the CPU to acquisition
+and the UI. The redraw timer is restarted as a one-shot timer after every
+tick, so slow redraws can't queue up timer events: ticks are kept on a grid
+of the current interval, and the ones missed while a redraw overran are
+coalesced into the next.
+"""
+from instrumentation import clock
+
+# fraction of the time redraws may take
+DEFAULT_BUDGET = .25
+# the interval never gets longer than this, in ms
+MAX_INTERVAL_MS = 1000
+# weight of the last redraw in the cost average
+SMOOTHING = .2
+
+
+class FrameGovernor(object):
+    """
+    Refresh intervals of at least *interval* ms keeping redraws within
+    *budget* of the time.
+
+    Call *drawn* with the duration of every redraw, *skipped* for ticks
+    without one, and start the timer with the ms returned by *schedule*.
+    """
+
+    def __init__(self, interval, budget=DEFAULT_BUDGET,
+                 max_interval=MAX_INTERVAL_MS, smoothing=SMOOTHING):
+        if not 0 < budget <= 1:
+            raise ValueError("budget must be in (0, 1]")
+        self.min_interval = interval / 1000.
+        self.max_interval = max(max_interval, interval) / 1000.
+        self.budget = budget
+        self.smoothing = smoothing
+
+        self.cost = None
+        self.deadline = None
+        self.frames = 0
+        self.skips = 0
+        self.coalesced = 0
+
+    @property
+    def interval(self):
+        """Current refresh interval in seconds."""
+        if self.cost is None:
+            return self.min_interval
+        return min(max(self.min_interval, self.cost / self.budget),
+                   self.max_interval)
+
+    def drawn(self, seconds):
+        """Account for a redraw that took *seconds*."""
+        self.frames += 1
+        if self.cost is None:
+            self.cost = seconds
+        else:
+            self.cost += self.smoothing * (seconds - self.cost)
+
+    def skipped(self):
+        """Account for a tick that had nothing new to draw."""
+        self.skips += 1
+
+    def schedule(self):
+        """Return the ms until the next tick is due."""
+        now = clock()
+        interval = self.interval
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += interval
+        if self.deadline < now:
+            # the ticks missed meanwhile are covered by the one just done
+            missed = int((now - self.deadline) // interval) + 1
+            self.coalesced += missed
+            self.deadline += missed * interval
+        return max(int(round(1000 * (self.deadline - now))), 1)
+
+    def stats(self):
+        return {
+            'interval_ms': 1000 * self.interval,
+            'draw_cost_ms': None if self.cost is None else 1000 * self.cost,
+            'frames': self.frames,
+            'skipped': self.skips,
+            'coalesced': self.coalesced,
+        }
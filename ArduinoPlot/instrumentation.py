@@ -0,0 +1,177 @@
+"""
+Cheap performance counters of the live plot.
+
+`PlotInstrumentation` is told about every timer tick and redraw of
+`GraphFrame` and, about once a second, polls the ``stats()`` of its data
+sources. From these it derives samples/s received and plotted, dropped and
+bogus samples, bytes waiting in the serial driver, draw time percentiles,
+timer lateness and, with a `FrameGovernor`, the refresh interval and skipped
+redraws. Each per-second summary is kept, so a whole session can be
+exported as JSON when the plot stutters.
+"""
+from collections import deque
+import json
+import time
+import numpy as np
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# draw times and tick lateness kept for the percentiles
+DEFAULT_WINDOW = 256
+# per-second summaries kept for export, an hour
+DEFAULT_HISTORY = 3600
+UPDATE_INTERVAL = 1.
+
+
+class RollingSamples(object):
+    """The last *size* values of a measurement, in a preallocated array."""
+
+    def __init__(self, size=DEFAULT_WINDOW):
+        self.values = np.zeros(size)
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def percentiles(self, points=(50, 90, 99)):
+        """Return ``{'p50': ...}`` of the kept values, None before any."""
+        values = self.values[:min(self.count, len(self.values))]
+        if not len(values):
+            return {'p{}'.format(p): None for p in points}
+        return {
+            'p{}'.format(p): float(value)
+            for p, value in zip(points, np.percentile(values, points))
+        }
+
+
+class PlotInstrumentation(object):
+    """
+    Counters of a `GraphFrame` redrawing every *refresh_interval* ms.
+
+    Call *tick* when the redraw timer fires, *frame* after each tick and
+    *update* on every tick; the latter returns a new summary at most every
+    *update_interval* seconds, otherwise None. The counters of *governor*
+    are included in the summaries.
+    """
+
+    def __init__(self, data_sources, refresh_interval,
+                 update_interval=UPDATE_INTERVAL, window=DEFAULT_WINDOW,
+                 history=DEFAULT_HISTORY, governor=None):
+        self.data_sources = data_sources
+        self.refresh_interval = refresh_interval / 1000.
+        self.governor = governor
+        self.update_interval = update_interval
+        self.draw_times = RollingSamples(window)
+        self.lateness = RollingSamples(window)
+        self.history = deque(maxlen=history)
+
+        self.frames = 0
+        self.plotted = 0
+        self.last_tick = None
+        self.last_update = None
+        self.last_counts = None
+        self.latest = None
+
+    def tick(self, due=None):
+        """
+        Record how late the timer fired, compared to the `clock` time *due*
+        or else to one refresh interval after the last tick.
+        """
+        now = clock()
+        if due is None and self.last_tick is not None:
+            due = self.last_tick + self.refresh_interval
+        if due is not None:
+            self.lateness.add(1000 * max(now - due, 0.))
+        self.last_tick = now
+
+    def frame(self, draw_time, samples_plotted):
+        """
+        Record a tick adding samples to the plot, and its redraw of
+        *draw_time* seconds unless that is None.
+        """
+        self.plotted += samples_plotted
+        if draw_time is not None:
+            self.frames += 1
+            self.draw_times.add(1000 * draw_time)
+
+    def _source_counts(self):
+        counts = {'parsed': 0, 'dropped': 0, 'bogus': 0, 'lost': 0,
+                  'backlog': 0}
+        for data_source in self.data_sources:
+            stats = data_source.stats() if hasattr(data_source, 'stats') \
+                else {}
+            for key in counts:
+                counts[key] += stats.get(key) or 0
+        counts['plotted'] = self.plotted
+        counts['frames'] = self.frames
+        governor = self.governor.stats() if self.governor is not None \
+            else {}
+        counts['skipped'] = governor.get('skipped', 0)
+        counts['coalesced'] = governor.get('coalesced', 0)
+        counts['interval_ms'] = governor.get(
+            'interval_ms', 1000 * self.refresh_interval
+        )
+        return counts
+
+    def update(self):
+        """Return a new summary once per update interval, else None."""
+        now = clock()
+        if self.last_update is None:
+            self.last_update, self.last_counts = now, self._source_counts()
+            return None
+        elapsed = now - self.last_update
+        if elapsed < self.update_interval:
+            return None
+        counts = self._source_counts()
+        previous = self.last_counts
+        summary = {
+            'time': time.time(),
+            'samples_in_per_s':
+                (counts['parsed'] - previous['parsed']) / elapsed,
+            'samples_out_per_s':
+                (counts['plotted'] - previous['plotted']) / elapsed,
+            'frames_per_s': (counts['frames'] - previous['frames']) / elapsed,
+            'skipped_per_s':
+                (counts['skipped'] - previous['skipped']) / elapsed,
+            'coalesced': counts['coalesced'],
+            'interval_ms': counts['interval_ms'],
+            'dropped': counts['dropped'],
+            'bogus': counts['bogus'],
+            'lost': counts['lost'],
+            'backlog_bytes': counts['backlog'],
+            'draw_ms': self.draw_times.percentiles(),
+            'lateness_ms': self.lateness.percentiles(),
+        }
+        self.last_update, self.last_counts = now, counts
+        self.latest = summary
+        self.history.append(summary)
+        return summary
+
+    def status_text(self, summary=None):
+        """Return a one line rendering of *summary*, the latest by default."""
+        summary = summary or self.latest
+        if summary is None:
+            return ''
+        return (
+            'in {:.0f}/s  out {:.0f}/s  {:.1f} fps  skipped {:.1f}/s  '
+            'every {:.0f} ms  dropped {}  bogus {}  '
+            'lost {}  backlog {} B  draw p50/p99 {:.1f}/{:.1f} ms  '
+            'late p99 {:.0f} ms'.format(
+                summary['samples_in_per_s'], summary['samples_out_per_s'],
+                summary['frames_per_s'], summary['skipped_per_s'],
+                summary['interval_ms'], summary['dropped'],
+                summary['bogus'], summary['lost'], summary['backlog_bytes'],
+                summary['draw_ms']['p50'] or 0.,
+                summary['draw_ms']['p99'] or 0.,
+                summary['lateness_ms']['p99'] or 0.,
+            )
+        )
+
+    def export(self, path):
+        """Write the kept summaries to *path* as JSON."""
+        with open(path, 'w') as export_file:
+            json.dump({
+                'refresh_interval_ms': 1000 * self.refresh_interval,
+                'summaries': list(self.history),
+            }, export_file, indent=1)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Record a PID session from the command line, without a GUI.
+
+Only the serial and recording modules are imported, so it starts quickly and
+runs over SSH on the acquisition PC. Throughput and loss counters are printed
+periodically until the duration or sample count is reached, or Ctrl+C.
+"""
+from __future__ import print_function
+from threading import Event
+import argparse
+import sys
+import time
+
+from Arduino_Monitor import SerialData
+from pid_recorder import SessionRecorder, default_session_path
+
+STATS_INTERVAL = 1.
+
+
+class SampleLimit(object):
+    """Listener passing samples on until *limit* of them were seen."""
+
+    def __init__(self, write, limit=None):
+        self.write = write
+        self.limit = limit
+        self.count = 0
+        self.reached = Event()
+
+    def __call__(self, timestamps, values):
+        if self.reached.is_set():
+            return
+        if self.limit is not None and self.count + len(values) >= self.limit:
+            keep = self.limit - self.count
+            timestamps, values = timestamps[:keep], values[:keep]
+            self.reached.set()
+        self.count += len(values)
+        self.write(timestamps, values)
+
+
+def format_stats(stats, count, rate, recorder):
+    return (
+        '{:10d} samples {:9.1f} /s  bogus {:d}  lost {:d}  '
+        'dropped {:d}  written {:d}'.format(
+            count, rate, stats.get('bogus', 0), stats.get('lost', 0),
+            stats.get('dropped', 0) + recorder.dropped,
+            recorder.samples_written,
+        )
+    )
+
+
+def parse_script_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+
+    parser.add_argument("port", help="serial port to be used")
+    parser.add_argument("-b", "--baudrate", type=int, help="port baud rate")
+    parser.add_argument("-t", "--timeout", type=float,
+                        help="port timeout value")
+    parser.add_argument("-p", "--protocol", choices=("ascii", "binary"),
+                        help="line protocol sent by the Arduino sketch")
+    parser.add_argument("-c", "--channels", type=int,
+                        help="analog inputs sent per sample by the board")
+    parser.add_argument("-o", "--output", metavar="DIR",
+                        help="session directory, pid_session_<time> by "
+                             "default")
+    parser.add_argument("-d", "--duration", type=float,
+                        help="stop after this many seconds")
+    parser.add_argument("-n", "--samples", type=int,
+                        help="stop after this many samples")
+    parser.add_argument("-s", "--stats-interval", type=float,
+                        default=STATS_INTERVAL,
+                        help="seconds between status lines, 0 to disable")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_script_args()
+    kwargs = {key: getattr(args, key)
+              for key in ("baudrate", "timeout", "protocol", "channels")
+              if getattr(args, key) is not None}
+
+    source = SerialData(args.port, **kwargs)
+    if source.serial_port is None:
+        print('cannot open {}: {}'.format(args.port, source.error),
+              file=sys.stderr)
+        return 1
+    recorder = SessionRecorder(
+        args.output or default_session_path(), channels=source.channels
+    )
+    limit = SampleLimit(recorder.write, args.samples)
+    source.add_listener(limit)
+    print('recording {} to {}'.format(args.port, recorder.path))
+
+    started = time.time()
+    deadline = None if args.duration is None else started + args.duration
+    interval = args.stats_interval or None
+    last_time, last_count = started, 0
+    try:
+        while not limit.reached.is_set():
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            timeout = 1. if interval is None else interval
+            if deadline is not None:
+                timeout = min(timeout, deadline - now)
+            if limit.reached.wait(timeout) or interval is None:
+                continue
+            now, count = time.time(), limit.count
+            if deadline is not None and now >= deadline:
+                break
+            rate = (count - last_count) / (now - last_time)
+            print(format_stats(source.stats(), count, rate, recorder))
+            last_time, last_count = now, count
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+        recorder.close()
+
+    elapsed = time.time() - started
+    print('done:', format_stats(
+        source.stats(), limit.count, limit.count / elapsed, recorder
+    ))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
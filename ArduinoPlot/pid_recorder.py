@@ -0,0 +1,389 @@
+"""
+Record PID sessions to disk and read them back.
+
+A session is a directory of chunk files plus an ``index.json`` listing them.
+Each chunk file starts with a small fixed header followed by raw
+``(timestamp, value)`` records, so it can be memory mapped and sliced
+without loading it. Sessions of boards sending several channels store a row
+of values per record. `SessionRecorder` writes from a background thread and
+never blocks the acquisition thread, `SessionReader` opens a session lazily
+and `ReplayData` plays one back as a data source for `GraphFrame`.
+"""
+from __future__ import print_function
+from threading import Thread
+import json
+import os
+import time
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MAGIC = b'PIDREC01'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('record_size', '<u4'),
+    ('n_samples', '<u8'),
+    ('t_first', '<f8'),
+    ('t_last', '<f8'),
+])
+RECORD_DTYPE = np.dtype([('t', '<f8'), ('v', '<f8')])
+INDEX_FILE = 'index.json'
+
+# 2 ** 22 samples is 64 MB per chunk, about half an hour of the ASCII stream
+DEFAULT_CHUNK_SAMPLES = 2 ** 22
+# batches waiting to be written before new ones are dropped
+DEFAULT_QUEUE_SIZE = 1024
+# samples per drain when replaying at maximum speed
+DEFAULT_REPLAY_BATCH = 2 ** 16
+
+
+def record_dtype(channels=None):
+    """Return the record dtype of a session with *channels* per sample."""
+    if channels is None:
+        return RECORD_DTYPE
+    return np.dtype([('t', '<f8'), ('v', '<f8', (channels,))])
+
+
+def _dtype_from_descr(descr):
+    """Rebuild a dtype from its ``descr`` after a round trip through JSON."""
+    return np.dtype([
+        tuple(field[:2]) + tuple(tuple(shape) for shape in field[2:])
+        for field in descr
+    ])
+
+
+def default_session_path(directory='.'):
+    """Return a new session directory name based on the current time."""
+    return os.path.join(
+        directory, time.strftime('pid_session_%Y%m%d_%H%M%S')
+    )
+
+
+def _replace(source, destination):
+    """Rename *source* over *destination*."""
+    try:
+        os.replace(source, destination)
+    except AttributeError:
+        # Python 2 can't rename over an existing file on Windows
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def _bisect(times, t):
+    """
+    Return the first index of sorted *times* whose value is >= *t*.
+
+    Unlike ``np.searchsorted`` this doesn't copy a strided memmap view, so it
+    only touches a handful of pages.
+    """
+    low, high = 0, len(times)
+    while low < high:
+        middle = (low + high) // 2
+        if times[middle] < t:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class SessionRecorder(object):
+    """
+    Background writer appending samples to chunk files of a session.
+
+    *write* only puts the samples on a bounded queue and returns; if the disk
+    can't keep up the batch is dropped and counted in *dropped* rather than
+    stalling the caller. A new chunk file is started every *chunk_samples*
+    samples. With *channels* every sample is a row of that many values.
+    """
+
+    def __init__(self, path=None, chunk_samples=DEFAULT_CHUNK_SAMPLES,
+                 queue_size=DEFAULT_QUEUE_SIZE, channels=None):
+        self.path = path or default_session_path()
+        self.chunk_samples = chunk_samples
+        self.record_dtype = record_dtype(channels)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.chunks = []
+        self.samples_written = 0
+        self.dropped = 0
+
+        self._file = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = Thread(target=self._run, name='SessionRecorder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, timestamps, values):
+        """Queue samples for writing, never blocks."""
+        if not len(values):
+            return
+        try:
+            self._queue.put_nowait((timestamps, values))
+        except queue.Full:
+            self.dropped += len(values)
+
+    def close(self):
+        """Write out the queued samples and finalize the session files."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            records = np.empty(len(item[1]), dtype=self.record_dtype)
+            records['t'] = item[0]
+            records['v'] = item[1]
+            self._append(records)
+        self._finish_chunk()
+
+    def _append(self, records):
+        while len(records):
+            if self._file is None:
+                self._start_chunk()
+            chunk = self.chunks[-1]
+            count = min(len(records), self.chunk_samples - chunk['n_samples'])
+            self._file.write(records[:count].tobytes())
+            if chunk['n_samples'] == 0:
+                chunk['t_first'] = float(records['t'][0])
+            chunk['n_samples'] += count
+            chunk['t_last'] = float(records['t'][count - 1])
+            self.samples_written += count
+            records = records[count:]
+            if chunk['n_samples'] >= self.chunk_samples:
+                self._finish_chunk()
+
+    def _start_chunk(self):
+        name = 'chunk_{:05d}.pid'.format(len(self.chunks))
+        self.chunks.append({
+            'file': name, 'n_samples': 0, 't_first': None, 't_last': None,
+        })
+        self._file = open(os.path.join(self.path, name), 'w+b')
+        self._write_header()
+        self._write_index()
+
+    def _finish_chunk(self):
+        if self._file is None:
+            return
+        self._write_header()
+        self._file.close()
+        self._file = None
+        self._write_index()
+
+    def _write_header(self):
+        chunk = self.chunks[-1]
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = MAGIC
+        header['version'] = VERSION
+        header['record_size'] = self.record_dtype.itemsize
+        header['n_samples'] = chunk['n_samples']
+        header['t_first'] = chunk['t_first'] or 0.
+        header['t_last'] = chunk['t_last'] or 0.
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+        self._file.seek(max(position, HEADER_SIZE))
+        self._file.flush()
+
+    def _write_index(self):
+        index = {
+            'version': VERSION,
+            'record_dtype': self.record_dtype.descr,
+            'chunks': self.chunks,
+        }
+        temporary = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(temporary, 'w') as index_file:
+            json.dump(index, index_file, indent=1)
+        _replace(temporary, os.path.join(self.path, INDEX_FILE))
+
+
+class SessionReader(object):
+    """
+    Lazy reader of a recorded session.
+
+    Chunk files are memory mapped on first use. The sample count of a chunk
+    that was still being written, or whose recorder died, is taken from its
+    file size.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+        self.chunks = index['chunks']
+        self.record_dtype = _dtype_from_descr(index['record_dtype'])
+        shape = self.record_dtype['v'].shape
+        self.channels = shape[0] if shape else None
+        self._maps = {}
+
+    def _records(self, i):
+        if i not in self._maps:
+            name = os.path.join(self.path, self.chunks[i]['file'])
+            size = os.path.getsize(name) - HEADER_SIZE
+            count = max(size, 0) // self.record_dtype.itemsize
+            if count == 0:
+                self._maps[i] = np.empty(0, dtype=self.record_dtype)
+            else:
+                self._maps[i] = np.memmap(
+                    name, dtype=self.record_dtype, mode='r',
+                    offset=HEADER_SIZE, shape=(count,)
+                )
+        return self._maps[i]
+
+    def __len__(self):
+        return sum(len(self._records(i)) for i in range(len(self.chunks)))
+
+    @property
+    def t_first(self):
+        for i in range(len(self.chunks)):
+            records = self._records(i)
+            if len(records):
+                return float(records['t'][0])
+        return None
+
+    @property
+    def t_last(self):
+        for i in reversed(range(len(self.chunks))):
+            records = self._records(i)
+            if len(records):
+                return float(records['t'][-1])
+        return None
+
+    def time_slice(self, t_start=None, t_stop=None, max_samples=None):
+        """
+        Return ``(timestamps, values)`` of the samples with
+        ``t_start <= t < t_stop``, reading only the chunks involved. At most
+        the first *max_samples* of them are returned.
+        """
+        timestamps, values = [], []
+        remaining = max_samples
+        for i, chunk in enumerate(self.chunks):
+            if t_stop is not None and chunk['t_first'] is not None and \
+                    chunk['t_first'] >= t_stop:
+                break
+            if remaining is not None and remaining <= 0:
+                break
+            records = self._records(i)
+            if not len(records):
+                continue
+            times = records['t']
+            if t_start is not None and times[-1] < t_start:
+                continue
+            start = 0 if t_start is None else _bisect(times, t_start)
+            stop = len(times) if t_stop is None else _bisect(times, t_stop)
+            if remaining is not None:
+                stop = min(stop, start + remaining)
+            if stop > start:
+                timestamps.append(np.array(times[start:stop]))
+                values.append(np.array(records['v'][start:stop]))
+                if remaining is not None:
+                    remaining -= stop - start
+        if not values:
+            shape = self.record_dtype['v'].shape
+            return np.empty(0), np.empty((0,) + shape)
+        return np.concatenate(timestamps), np.concatenate(values)
+
+    def iter_chunks(self):
+        """Yield ``(timestamps, values)`` memmap views, one per chunk."""
+        for i in range(len(self.chunks)):
+            records = self._records(i)
+            yield records['t'], records['v']
+
+
+class ReplayData(object):
+    """
+    Data source playing a recorded session back.
+
+    It offers the same interface as a buffered `SerialData`: *next* returns
+    the newest sample and *read_available* / *drain* the samples replayed
+    since the last call. Timestamps are those of the recording.
+
+    The session plays at *speed* times real time; with *speed* None every
+    *drain* returns the next *batch* samples, as fast as the consumer asks.
+    """
+
+    def __init__(self, path, speed=1., batch=DEFAULT_REPLAY_BATCH):
+        self.name = os.path.basename(os.path.normpath(path))
+        self.session = SessionReader(path)
+        self.channels = self.session.channels
+        self.t_first = self.session.t_first
+        self.speed = speed
+        self.batch = batch
+        self.started_at = None
+        self.origin = self.t_first
+        self.position = None
+        self.replayed = 0
+        self.last_value = 0.
+
+    def _replay_time(self):
+        if self.started_at is None:
+            self.started_at = time.time()
+            self.position = self.t_first
+        if self.speed is None:
+            return None
+        return self.origin + (time.time() - self.started_at) * self.speed
+
+    def set_speed(self, speed):
+        """Change the replay speed, continuing from the current position."""
+        if self.started_at is not None:
+            self.origin = self.position
+            self.started_at = time.time()
+        self.speed = speed
+
+    def read_available(self, max_samples=None):
+        if self.t_first is None:
+            return np.empty(0), np.empty(0)
+        now = self._replay_time()
+        if now is None and max_samples is None:
+            max_samples = self.batch
+        timestamps, values = self.session.time_slice(
+            self.position, now,
+            None if max_samples is None else max_samples + 1
+        )
+        if max_samples is not None and len(values) > max_samples:
+            # stop before a timestamp boundary so the next call starts there
+            cut = int(timestamps.searchsorted(timestamps[max_samples]))
+            if cut == 0:
+                # more than max_samples share the first timestamp: take
+                # all of them, else the next call would start there again
+                after = np.nextafter(timestamps[0], np.inf)
+                timestamps, values = self.session.time_slice(
+                    self.position, after)
+                self.position = after
+            else:
+                self.position = timestamps[cut]
+                timestamps, values = timestamps[:cut], values[:cut]
+        elif now is None:
+            # the whole session has been replayed
+            if len(timestamps):
+                self.position = np.nextafter(timestamps[-1], np.inf)
+        else:
+            self.position = now
+        self.replayed += len(values)
+        if len(values):
+            # next() reports the first channel, like SerialData.next
+            self.last_value = float(np.ravel(values[-1])[0])
+        return timestamps, values
+
+    def drain(self):
+        return self.read_available()
+
+    def next(self):
+        self.read_available()
+        return self.last_value
+
+    def stats(self):
+        return {'parsed': self.replayed, 'dropped': 0}
+
+    def close(self):
+        pass
@@ -0,0 +1,158 @@
+"""
+Drawing of the plotted channels, independent of the GUI toolkit.
+
+`PlotRenderer` owns the figure of `GraphFrame`: its axes, the single
+`LineCollection` drawing every channel and, in blit mode, the cached
+background. It draws on the canvas it is attached to, the wxAgg canvas of the
+frame or a plain Agg canvas in benchmark.py, so the benchmark times the very
+code the GUI runs.
+"""
+import numpy as np
+
+from matplotlib.artist import setp
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+
+DPI = 100
+# line colors of the plotted channels, in order
+CHANNEL_COLORS = [(1, 1, 0), (0, 1, 1), (1, 0, 1), (0, 1, 0), (1, .5, 0)]
+
+
+def channel_extrema(histories, channels, settings, x_min, x_max,
+                    newest=False):
+    """
+    Return ``(minimum, maximum)`` of the visible channels between *x_min*
+    and *x_max*, times their gain, or ``(None, None)`` if none has samples
+    there.
+
+    *channels* are ``(history index, column)`` pairs and *settings* their
+    ``(visible, gain)``. With *newest* the range ends at the newest sample,
+    see `SampleHistory.extrema`.
+    """
+    extrema = [
+        history.extrema(x_min, x_max, newest) for history in histories
+    ]
+    bounds = []
+    for (i, column), (visible, gain) in zip(channels, settings):
+        minimum, maximum = extrema[i]
+        if visible and minimum is not None:
+            ends = (minimum[column] * gain, maximum[column] * gain)
+            bounds.append((min(ends), max(ends)))
+    if not bounds:
+        return None, None
+    return min(pair[0] for pair in bounds), max(pair[1] for pair in bounds)
+
+
+class PlotRenderer(object):
+    """
+    Figure of *n_channels* lines, drawn with full redraws or, with *blit*,
+    over a cached background of the axes.
+
+    A canvas has to be attached before drawing.
+    """
+
+    def __init__(self, n_channels, labels=None, blit=False, size=(3.0, 3.0),
+                 dpi=DPI):
+        self.blit = blit
+        self.canvas = None
+        # axes state of the last full redraw and the cached background
+        self.view = None
+        self.background = None
+
+        self.figure = Figure(size, dpi=dpi)
+
+        self.axes = self.figure.add_subplot(111)
+        self.axes.set_facecolor('black')
+        self.axes.set_title('Arduino Serial Data', size=12)
+        self.axes.set_xlabel('Time (s)', size=8)
+        self.axes.grid(color='grey')
+
+        setp(self.axes.get_xticklabels(), fontsize=8)
+        setp(self.axes.get_yticklabels(), fontsize=8)
+
+        # all channels are drawn by a single collection, one segment each
+        colors = [
+            CHANNEL_COLORS[i % len(CHANNEL_COLORS)] for i in range(n_channels)
+        ]
+        self.plot_collection = LineCollection(
+            [np.empty((0, 2))] * n_channels, colors=colors,
+            linewidths=1, animated=blit,
+        )
+        self.axes.add_collection(self.plot_collection)
+        if n_channels > 1 and labels:
+            self.axes.legend(
+                [Line2D([], [], color=color, linewidth=1) for color in colors],
+                labels, loc='upper left', fontsize=8
+            )
+
+    def attach(self, canvas):
+        """Draw on *canvas*, a canvas of the figure."""
+        self.canvas = canvas
+        self.canvas.mpl_connect('draw_event', self.on_canvas_draw)
+
+    def invalidate(self):
+        """Make the next draw a full redraw, e.g. after adding artists."""
+        self.view = None
+
+    def set_data(self, histories, channels, settings, x_min, x_max):
+        """
+        Hand the min/max envelope of the visible range of each channel to
+        the line collection; *channels* and *settings* as in
+        `channel_extrema`.
+        """
+        # about two points per pixel of the axes width, computed for all
+        # channels of a history in one pass
+        envelopes = [
+            history.envelope(x_min, x_max, self.axes.bbox.width)
+            for history in histories
+        ]
+        segments = []
+        for (i, column), (visible, gain) in zip(channels, settings):
+            times, values = envelopes[i]
+            if not visible:
+                times = values = times[:0]
+            else:
+                values = values[:, column] * gain
+            segments.append(np.column_stack((times, values)))
+        self.plot_collection.set_segments(segments)
+
+    def draw(self, x_min, x_max, y_min, y_max, grid=True, xlabels=True):
+        """
+        Draw the figure with these bounds.
+
+        In blit mode the figure is only fully redrawn when the bounds, grid
+        or label visibility changed; otherwise the cached background of the
+        axes is restored and just the line collection is drawn over it.
+        """
+        view = (x_min, x_max, y_min, y_max, grid, xlabels)
+        if self.blit and view == self.view and self.background is not None:
+            self.canvas.restore_region(self.background)
+            self.axes.draw_artist(self.plot_collection)
+            self.canvas.blit(self.axes.bbox)
+            return
+        self.view = view
+
+        self.axes.set_xbound(lower=x_min, upper=x_max)
+        self.axes.set_ybound(lower=y_min, upper=y_max)
+
+        self.axes.grid(grid)
+
+        # Set x-axis labels visibility
+        setp(self.axes.get_xticklabels(), visible=xlabels)
+
+        self.canvas.draw()
+
+    def on_canvas_draw(self, event):
+        """Cache the background after every full draw, e.g. on resize."""
+        if self.blit:
+            self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+            self.axes.draw_artist(self.plot_collection)
+
+    def save(self, path):
+        """Save the figure to *path*."""
+        # animated artists are left out of saved figures
+        self.plot_collection.set_animated(False)
+        self.canvas.print_figure(path, dpi=self.figure.dpi)
+        self.plot_collection.set_animated(self.blit)
+        self.view = None
@@ -0,0 +1,301 @@
+"""
+Online detection of odor pulses in a PID signal.
+
+`PulseDetector` is fed the same ``(timestamps, values)`` batches as the plot.
+It tracks the baseline and its noise while the signal is idle and opens a
+pulse when the signal rises a few noise widths above the baseline. The pulse
+is closed when it falls back below a tenth of its amplitude, and a `Pulse`
+is then emitted with its onset, 10-90 % rise time, peak, plateau level and
+90-10 % decay time.
+
+Batches are processed with NumPy; only the running maxima of the current
+rising edge and the plateau candidates, counted by value, are kept between
+batches, so with ADC counts memory doesn't grow with the length of a pulse
+or of the session.
+"""
+from collections import namedtuple
+import numpy as np
+
+PulseOnset = namedtuple('PulseOnset', 'time baseline')
+Pulse = namedtuple('Pulse', [
+    'onset',        # time of the threshold crossing
+    'rise_time',    # from 10 % to 90 % of the amplitude
+    'peak_time',
+    'peak',
+    'amplitude',    # peak above baseline
+    'plateau',      # mean of the samples above 80 % of the amplitude
+    'decay_time',   # from the last sample above 90 % to below 10 %
+    'end',
+    'baseline',
+])
+
+# seconds of signal used to estimate the initial baseline and noise, and
+# at most this many of its samples
+WARMUP = 1.
+MAX_WARMUP_SAMPLES = 2 ** 14
+# median absolute deviation to standard deviation of Gaussian noise
+MAD_TO_SIGMA = 1.4826
+# time constant in seconds of the baseline and noise tracking
+BASELINE_TAU = 5.
+# fractions of the amplitude defining the rise, plateau and decay
+LOW_LEVEL = .1
+HIGH_LEVEL = .9
+PLATEAU_LEVEL = .8
+
+
+def _median_sigma(values):
+    """Return the median of *values* and a noise estimate from their MAD."""
+    median = np.median(values)
+    return median, MAD_TO_SIGMA * np.median(np.abs(values - median))
+
+
+class PulseDetector(object):
+    """
+    Streaming pulse detector.
+
+    A pulse starts when a sample exceeds the baseline by *on_noise* times
+    the noise and at least *min_amplitude*, and ends at the first sample
+    below ``baseline + max(off_noise * noise, amplitude / 10)``. The next
+    pulse can only start once the decay got within *off_noise* times the
+    noise of the baseline. Excursions shorter than *min_duration* seconds
+    are noise spikes, they are counted in *rejected* but emit nothing, and
+    the `PulseOnset` of a pulse is only emitted once it lasted that long.
+    Baseline and noise are tracked with medians, so pulses during the warmup
+    or in between detections pull them little. The noise estimate never goes
+    below *min_noise*, about one ADC count.
+    """
+
+    def __init__(self, on_noise=5., off_noise=2., min_amplitude=10.,
+                 min_noise=.5, min_duration=.05, warmup=WARMUP,
+                 baseline_tau=BASELINE_TAU):
+        self.on_noise = on_noise
+        self.off_noise = off_noise
+        self.min_amplitude = min_amplitude
+        self.min_noise = min_noise
+        self.min_duration = min_duration
+        self.warmup = warmup
+        self.baseline_tau = baseline_tau
+        self.listeners = []
+
+        self.baseline = None
+        self.sigma = None
+        self.last_time = None
+        self._warmup_start = None
+        self._warmup_values = []
+
+        # running maxima since the signal last sat at the baseline
+        self.record_times = []
+        self.record_values = []
+        # False from the end of a pulse until the signal is back at baseline
+        self.armed = True
+        # pulse in progress
+        self.onset = None
+        self.confirmed = False
+        self.start_baseline = None
+        self.peak = None
+        self.peak_time = None
+        self.last_high = None
+        # samples above 80 % of the amplitude so far, by value
+        self.plateau_levels = np.empty(0)
+        self.plateau_counts = np.empty(0)
+
+        self.pulses = 0
+        self.rejected = 0
+
+    @property
+    def noise(self):
+        return max(self.sigma, self.min_noise)
+
+    @property
+    def active(self):
+        """True while a pulse is in progress."""
+        return self.onset is not None
+
+    def add_listener(self, listener):
+        """Call ``listener(event)`` with every `PulseOnset` and `Pulse`."""
+        self.listeners.append(listener)
+
+    def feed(self, timestamps, values):
+        """Process a batch of samples and return the events it completes."""
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        if self.baseline is None:
+            used = self._warm_up(timestamps, values)
+            timestamps, values = timestamps[used:], values[used:]
+
+        events = []
+        while len(values):
+            if self.active:
+                used = self._pulse(timestamps, values, events)
+            else:
+                used = self._idle(timestamps, values)
+            timestamps, values = timestamps[used:], values[used:]
+        for event in events:
+            for listener in self.listeners:
+                listener(event)
+        return events
+
+    def _warm_up(self, timestamps, values):
+        """Collect the initial baseline samples, return how many were used."""
+        if not len(values):
+            return 0
+        if self._warmup_start is None:
+            self._warmup_start = timestamps[0]
+        used = int(timestamps.searchsorted(self._warmup_start + self.warmup))
+        kept = sum(len(part) for part in self._warmup_values)
+        self._warmup_values.append(values[:used][:MAX_WARMUP_SAMPLES - kept])
+        if used < len(values):
+            warmup_values = np.concatenate(self._warmup_values)
+            self._warmup_values = []
+            if not len(warmup_values):
+                warmup_values = values[:1]
+            self.baseline, self.sigma = _median_sigma(warmup_values)
+            self.last_time = timestamps[max(used - 1, 0)]
+        return used
+
+    def _track_baseline(self, timestamps, values):
+        """Move the baseline and noise towards the idle samples."""
+        if not len(values):
+            return
+        elapsed = max(timestamps[-1] - self.last_time, 0.)
+        weight = 1. - np.exp(-elapsed / self.baseline_tau)
+        median, sigma = _median_sigma(values)
+        self.baseline += weight * (median - self.baseline)
+        self.sigma += weight * (sigma - self.sigma)
+        self.last_time = timestamps[-1]
+
+    def _add_records(self, timestamps, values):
+        """Keep the samples exceeding every earlier one of the edge."""
+        if not len(values):
+            return
+        previous = self.record_values[-1] if self.record_values else -np.inf
+        maxima = np.maximum.accumulate(values)
+        rising = np.empty(len(values), dtype=bool)
+        rising[0] = values[0] > previous
+        rising[1:] = maxima[1:] > maxima[:-1]
+        rising &= maxima > previous
+        self.record_times.extend(timestamps[rising].tolist())
+        self.record_values.extend(values[rising].tolist())
+
+    def _idle(self, timestamps, values):
+        if not self.armed:
+            # still in the tail of the last pulse
+            settled = np.flatnonzero(
+                values <= self.baseline + self.off_noise * self.noise
+            )
+            if not len(settled):
+                return len(values)
+            self.armed = True
+            return settled[0]
+
+        threshold = self.baseline + max(
+            self.on_noise * self.noise, self.min_amplitude
+        )
+        above = np.flatnonzero(values > threshold)
+        stop = above[0] if len(above) else len(values)
+
+        # the rising edge starts after the last sample at the baseline
+        quiet = np.flatnonzero(values[:stop] <= self.baseline + self.noise)
+        if len(quiet):
+            del self.record_times[:], self.record_values[:]
+            start = quiet[-1] + 1
+        else:
+            start = 0
+        self._add_records(timestamps[start:stop], values[start:stop])
+        self._track_baseline(timestamps[:stop], values[:stop])
+        if stop < len(values):
+            self.onset = timestamps[stop]
+            self.confirmed = False
+            self.start_baseline = self.baseline
+            self.peak = -np.inf
+            self.last_high = self.onset
+            self.plateau_levels = np.empty(0)
+            self.plateau_counts = np.empty(0)
+        return stop
+
+    def _pulse(self, timestamps, values, events):
+        baseline = self.start_baseline
+        peaks = np.maximum(np.maximum.accumulate(values), self.peak)
+        amplitudes = peaks - baseline
+        end_levels = baseline + np.maximum(
+            self.off_noise * self.noise, LOW_LEVEL * amplitudes
+        )
+        below = np.flatnonzero(values < end_levels)
+        stop = below[0] if len(below) else len(values)
+
+        if stop:
+            times, samples = timestamps[:stop], values[:stop]
+            self._add_records(times, samples)
+            highest = int(samples.argmax())
+            if samples[highest] > self.peak:
+                self.peak = samples[highest]
+                self.peak_time = times[highest]
+            high = np.flatnonzero(
+                samples >= baseline + HIGH_LEVEL * amplitudes[:stop]
+            )
+            if len(high):
+                self.last_high = times[high[-1]]
+            self._add_plateau(samples)
+        last = timestamps[min(stop, len(values) - 1)]
+        if not self.confirmed and last - self.onset >= self.min_duration:
+            self.confirmed = True
+            events.append(PulseOnset(
+                float(self.onset), float(self.start_baseline)
+            ))
+        if stop < len(values):
+            if self.confirmed:
+                events.append(self._finish(timestamps[stop]))
+            else:
+                self.rejected += 1
+                self.onset = None
+                del self.record_times[:], self.record_values[:]
+        return stop
+
+    def _add_plateau(self, samples):
+        """Count the samples above 80 % of the amplitude by value.
+
+        The amplitude only grows, so levels below 80 % of the current one
+        can never be part of the plateau and are dropped; what is left when
+        the pulse ends is measured against its final amplitude.
+        """
+        threshold = self.start_baseline + PLATEAU_LEVEL * (
+            self.peak - self.start_baseline
+        )
+        levels = np.concatenate((self.plateau_levels, samples))
+        counts = np.concatenate((self.plateau_counts, np.ones(len(samples))))
+        kept = levels >= threshold
+        self.plateau_levels, index = np.unique(levels[kept],
+                                               return_inverse=True)
+        self.plateau_counts = np.bincount(index, weights=counts[kept],
+                                          minlength=len(self.plateau_levels))
+
+    def _finish(self, end):
+        baseline = self.start_baseline
+        amplitude = self.peak - baseline
+        record_values = np.array(self.record_values)
+        record_times = np.array(self.record_times)
+        low = record_values.searchsorted(baseline + LOW_LEVEL * amplitude)
+        high = record_values.searchsorted(baseline + HIGH_LEVEL * amplitude)
+        rise_time = record_times[min(high, len(record_times) - 1)] - \
+            record_times[min(low, len(record_times) - 1)]
+        count = self.plateau_counts.sum()
+        plateau = np.dot(self.plateau_levels, self.plateau_counts) / count \
+            if count else self.peak
+
+        pulse = Pulse(
+            onset=float(self.onset),
+            rise_time=float(rise_time),
+            peak_time=float(self.peak_time),
+            peak=float(self.peak),
+            amplitude=float(amplitude),
+            plateau=float(plateau),
+            decay_time=float(end - self.last_high),
+            end=float(end),
+            baseline=float(baseline),
+        )
+        self.pulses += 1
+        self.onset = None
+        self.armed = False
+        del self.record_times[:], self.record_values[:]
+        self.last_time = end
+        return pulse
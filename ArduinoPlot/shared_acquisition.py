@@ -0,0 +1,292 @@
+"""
+Serial acquisition in a child process publishing to shared memory.
+
+`AcquisitionProcess` runs a `SerialData` in its own process, so plotting,
+window dragging or saving a figure in the GUI process can't delay serial
+reads. The child appends every sample to a `SharedRingBuffer`, a ring of
+timestamps and values in ``multiprocessing.shared_memory`` with a single
+writer and a lock-free write counter. Any number of consumers, in any
+process, attach to it by name with `SharedRingReader`.
+
+Requires Python 3.8 or later.
+"""
+from __future__ import print_function
+import multiprocessing
+import time
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# header slots, int64 each
+CAPACITY, WRITTEN, RECEIVED, PARSED, BOGUS, LOST, HEARTBEAT, ERROR = range(8)
+HEADER_SLOTS = 8
+# samples kept in shared memory, 32 MB
+DEFAULT_CAPACITY = 2 ** 21
+# how often in seconds the child publishes its counters
+STATS_INTERVAL = .1
+# seconds to wait for the child to open the port
+OPEN_TIMEOUT = 10.
+
+
+def _attach(name, untrack=True):
+    """
+    Open an existing shared memory block without taking ownership.
+
+    Child processes share the resource tracker of their parent and must
+    leave its registration alone, so they pass *untrack* False.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers every attached block with the resource
+        # tracker, which would unlink it when this process exits
+        block = shared_memory.SharedMemory(name=name)
+        if not untrack:
+            return block
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, 'shared_memory')
+        except (ImportError, AttributeError):
+            pass
+        return block
+
+
+class SharedRingBuffer(object):
+    """
+    Ring of ``(timestamp, value)`` samples in a shared memory block.
+
+    The block holds a header of int64 slots (capacity, samples ever written
+    and the writer's counters) followed by the timestamp and value arrays.
+    The single writer fills the slots first and then advances the write
+    counter, so readers never need a lock.
+    """
+
+    def __init__(self, name=None, capacity=DEFAULT_CAPACITY, create=False,
+                 untrack=True):
+        if shared_memory is None:
+            raise RuntimeError('shared memory acquisition needs Python 3.8+')
+        if create:
+            size = 8 * (HEADER_SLOTS + 2 * capacity)
+            self.block = shared_memory.SharedMemory(
+                name=name, create=True, size=size
+            )
+        else:
+            self.block = _attach(name, untrack)
+        self.owner = create
+        self.name = self.block.name
+
+        self.header = np.ndarray(
+            HEADER_SLOTS, dtype=np.int64, buffer=self.block.buf
+        )
+        if create:
+            self.header[:] = 0
+            self.header[CAPACITY] = capacity
+        self.capacity = int(self.header[CAPACITY])
+        self.timestamps = np.ndarray(
+            self.capacity, dtype=np.float64, buffer=self.block.buf,
+            offset=8 * HEADER_SLOTS
+        )
+        self.values = np.ndarray(
+            self.capacity, dtype=np.float64, buffer=self.block.buf,
+            offset=8 * (HEADER_SLOTS + self.capacity)
+        )
+
+    @property
+    def written(self):
+        return int(self.header[WRITTEN])
+
+    def extend(self, timestamps, values):
+        """Append samples, only the single writer may call this."""
+        n = len(values)
+        if n == 0:
+            return
+        written = int(self.header[WRITTEN])
+        if n > self.capacity:
+            written += n - self.capacity
+            timestamps = timestamps[-self.capacity:]
+            values = values[-self.capacity:]
+            n = self.capacity
+        start = written % self.capacity
+        first = min(n, self.capacity - start)
+        self.timestamps[start:start + first] = timestamps[:first]
+        self.values[start:start + first] = values[:first]
+        self.timestamps[:n - first] = timestamps[first:]
+        self.values[:n - first] = values[first:]
+        # publish only once the samples are in place
+        self.header[WRITTEN] = written + n
+
+    def close(self):
+        """Detach, and free the block if this instance created it."""
+        # drop the views before closing, the buffer can't be released
+        # while they exist
+        self.header = self.timestamps = self.values = None
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+
+
+class SharedRingReader(object):
+    """
+    Consumer of a `SharedRingBuffer`, with its own read position.
+
+    *drain* returns the samples written since the previous call. If the
+    reader fell more than the ring capacity behind, or the writer lapped it
+    while copying, the lost samples are counted in *dropped*.
+    """
+
+    def __init__(self, ring, from_start=False):
+        if not isinstance(ring, SharedRingBuffer):
+            ring = SharedRingBuffer(ring)
+        self.ring = ring
+        self.read_index = 0 if from_start else ring.written
+        self.dropped = 0
+
+    def _copy(self, array, start, stop):
+        capacity = self.ring.capacity
+        first = start % capacity
+        n = stop - start
+        head = min(n, capacity - first)
+        return np.concatenate((
+            array[first:first + head], array[:n - head]
+        ))
+
+    def drain(self):
+        ring = self.ring
+        written = ring.written
+        start = max(self.read_index, written - ring.capacity)
+        self.dropped += start - self.read_index
+        timestamps = self._copy(ring.timestamps, start, written)
+        values = self._copy(ring.values, start, written)
+        # samples overwritten while we copied them are not trustworthy
+        overwritten = ring.written - ring.capacity - start
+        if overwritten > 0:
+            self.dropped += overwritten
+            timestamps = timestamps[overwritten:]
+            values = values[overwritten:]
+        self.read_index = written
+        return timestamps, values
+
+    def close(self):
+        self.ring.close()
+
+
+def _acquire(ring_name, args, kwargs, record, stop_event, status):
+    """
+    Child process main: read the port into the shared ring.
+
+    Whether the port opened is sent through *status*, None or an error
+    message; the child stops right away if it didn't.
+    """
+    from Arduino_Monitor import SerialData
+
+    ring = SharedRingBuffer(ring_name, untrack=False)
+    # nothing is read before the listeners are attached
+    source = SerialData(*args, start=False, **kwargs)
+    if source.serial_port is None:
+        ring.header[ERROR] = 1
+        status.send('cannot open {}: {}'.format(source.name, source.error))
+        status.close()
+        ring.close()
+        return
+    status.send(None)
+    status.close()
+    source.add_listener(ring.extend)
+    recorder = None
+    if record is not None:
+        from pid_recorder import SessionRecorder
+        recorder = SessionRecorder(record)
+        source.add_listener(recorder.write)
+    source.start()
+    try:
+        while not stop_event.wait(STATS_INTERVAL):
+            stats = source.stats()
+            ring.header[RECEIVED] = stats.get('received', 0)
+            ring.header[PARSED] = stats.get('parsed', 0)
+            ring.header[BOGUS] = stats.get('bogus', 0)
+            ring.header[LOST] = stats.get('lost', 0)
+            ring.header[HEARTBEAT] = int(time.time() * 1000)
+    finally:
+        source.close()
+        if recorder is not None:
+            recorder.close()
+        ring.close()
+
+
+class AcquisitionProcess(object):
+    """
+    Data source reading a serial port in a child process.
+
+    Arguments are those of `SerialData`, plus *capacity*, the size of the
+    shared ring, and *record*, a session directory the child records to.
+    It offers the batched data source interface of `GraphFrame`.
+
+    The constructor waits until the child opened the port. If it couldn't,
+    the child exits and *error* tells why, otherwise *error* is None.
+    """
+
+    def __init__(self, *args, **kwargs):
+        capacity = kwargs.pop('capacity', DEFAULT_CAPACITY)
+        record = kwargs.pop('record', None)
+        self.name = kwargs.get('port', args[0] if args else None)
+
+        self.ring = SharedRingBuffer(capacity=capacity, create=True)
+        self.reader = SharedRingReader(self.ring)
+        self._stop_event = multiprocessing.Event()
+        status, child_status = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_acquire,
+            args=(self.ring.name, args, kwargs, record, self._stop_event,
+                  child_status),
+            name='AcquisitionProcess-{}'.format(self.name),
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_status.close()
+
+        self.error = None
+        if status.poll(OPEN_TIMEOUT):
+            try:
+                self.error = status.recv()
+            except EOFError:
+                self.error = 'acquisition process of {} exited'.format(
+                    self.name
+                )
+        status.close()
+        if self.error is not None:
+            # the child stops on its own
+            self.process.join(OPEN_TIMEOUT)
+
+    @property
+    def ring_name(self):
+        """Name other processes attach to with `SharedRingReader`."""
+        return self.ring.name
+
+    def drain(self):
+        return self.reader.drain()
+
+    def stats(self):
+        header = self.ring.header
+        return {
+            'received': int(header[RECEIVED]),
+            'parsed': int(header[PARSED]),
+            'bogus': int(header[BOGUS]),
+            'lost': int(header[LOST]),
+            'dropped': self.reader.dropped,
+            'alive': (self.process.is_alive() and self.error is None and
+                      not header[ERROR]),
+        }
+
+    def close(self):
+        """Stop the child process and free the shared memory."""
+        if self.process is None:
+            return
+        self._stop_event.set()
+        self.process.join(2.)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+        self.ring.close()
@@ -0,0 +1,112 @@
+"""
+Synthetic PID signal for running the plot and acquisition code without an
+Arduino.
+
+`SyntheticPIDData` generates, in real time, the ADC counts of a PID sensor
+seeing a train of odor pulses: a first order rise while the valve is open,
+an exponential decay after it closes, and Gaussian noise on top. It offers
+the batched data source interface of `GraphFrame`, so sample rates far above
+the real board's can be plotted to test rendering.
+"""
+import time
+import numpy as np
+
+# analogRead() range
+ADC_MAX = 1023
+# pulse delay in seconds and relative amplitude of each further channel
+CHANNEL_DELAY = .25
+CHANNEL_GAIN = .7
+
+
+class SyntheticPIDData(object):
+    """
+    Data source generating a noisy PID pulse train at *rate* samples/s.
+
+    A pulse of *pulse_amplitude* counts above *baseline* starts every
+    *pulse_interval* seconds from *pulse_delay* and lasts *pulse_duration*
+    seconds, rising and decaying with time constants *rise_tau* and
+    *decay_tau*. Values are rounded and clipped to the ADC range unless
+    *quantize* is false.
+
+    With *channels* every sample is a row of that many values, like a board
+    sending several analog inputs; each further channel sees the pulses
+    later and smaller.
+    """
+
+    def __init__(self, rate=1000., noise=2., baseline=100.,
+                 pulse_amplitude=600., pulse_duration=2., pulse_interval=10.,
+                 pulse_delay=2.,
+                 rise_tau=.15, decay_tau=.6, quantize=True, seed=None,
+                 channels=None, name='synthetic'):
+        self.name = name
+        self.channels = channels
+        self.rate = float(rate)
+        self.noise = noise
+        self.baseline = baseline
+        self.pulse_amplitude = pulse_amplitude
+        self.pulse_duration = pulse_duration
+        self.pulse_interval = pulse_interval
+        self.pulse_delay = pulse_delay
+        self.rise_tau = rise_tau
+        self.decay_tau = decay_tau
+        self.quantize = quantize
+        self.random = np.random.RandomState(seed)
+
+        self.started_at = time.time()
+        self.generated = 0
+        self.last_value = float(baseline)
+
+    def signal(self, t):
+        """Return the noiseless signal at times *t* since the start."""
+        phase = np.mod(t - self.pulse_delay, self.pulse_interval)
+        on = phase < self.pulse_duration
+        rise = 1. - np.exp(-np.minimum(phase, self.pulse_duration) /
+                           self.rise_tau)
+        decay = np.exp(-np.maximum(phase - self.pulse_duration, 0.) /
+                       self.decay_tau)
+        # the decay starts from wherever the rise got to
+        pulse = np.where(on, rise, rise * decay)
+        return self.baseline + self.pulse_amplitude * np.where(
+            np.asarray(t) < self.pulse_delay, 0., pulse
+        )
+
+    def generate(self, start, stop):
+        """Return ``(timestamps, values)`` of samples ``[start, stop)``."""
+        t = np.arange(start, stop) / self.rate
+        if self.channels is None:
+            values = self.signal(t)
+        else:
+            channel = np.arange(self.channels)
+            values = self.baseline + CHANNEL_GAIN ** channel * (
+                self.signal(t[:, None] - CHANNEL_DELAY * channel) -
+                self.baseline
+            )
+        if self.noise:
+            values += self.random.normal(0., self.noise, values.shape)
+        if self.quantize:
+            values = np.clip(np.round(values), 0, ADC_MAX)
+        return self.started_at + t, values
+
+    def read_available(self, max_samples=None):
+        due = int((time.time() - self.started_at) * self.rate) + 1
+        if max_samples is not None:
+            due = min(due, self.generated + max_samples)
+        timestamps, values = self.generate(self.generated, due)
+        self.generated = max(due, self.generated)
+        if len(values):
+            # next() reports the first channel, like SerialData.next
+            self.last_value = float(np.ravel(values[-1])[0])
+        return timestamps, values
+
+    def drain(self):
+        return self.read_available()
+
+    def next(self):
+        self.read_available()
+        return self.last_value
+
+    def stats(self):
+        return {'parsed': self.generated, 'dropped': 0}
+
+    def close(self):
+        pass
@@ -14,26 +14,41 @@ from the beginning.
 Note: press Enter in the 'manual' text box to make a new value affect the plot.
 """
 
+from __future__ import print_function
+from collections import deque
 import argparse
 import os
+import sys
 import wx
-import numpy as np
 
 import matplotlib
-from matplotlib.figure import Figure
 
-from Arduino_Monitor import SerialData
+from Arduino_Monitor import AcquisitionManager, SerialData
+from decimation import SampleHistory
+from frame_governor import DEFAULT_BUDGET, FrameGovernor
+from instrumentation import PlotInstrumentation, clock
+from pid_recorder import ReplayData, SessionRecorder
+from plot_renderer import CHANNEL_COLORS, PlotRenderer, channel_extrema
+from pulse_detector import Pulse, PulseDetector
+from shared_acquisition import AcquisitionProcess
+from synthetic_data import SyntheticPIDData
 
 # The recommended way to use wx with mpl is with the WXAgg backend.
 matplotlib.use('WXAgg')
 
 # Those import have to be after setting matplotlib backend.
 from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigCanvas  # noqa
-import matplotlib.pyplot as plt  # noqa
 
 
 REFRESH_INTERVAL_MS = 90
-DPI = 100
+# seconds of newest data shown when the X axis follows the data
+X_WINDOW = 10.
+# in blit mode the following X axis moves by this many seconds at a time
+X_STEP = X_WINDOW / 4
+# in blit mode auto Y bounds get this fraction of padding when they change
+Y_PADDING = .1
+# artists kept on the axes for the newest detected pulses and onsets
+MAX_PULSE_ANNOTATIONS = 60
 
 
 class BoundControlBox(wx.Panel):
@@ -103,25 +118,106 @@ class BoundControlBox(wx.Panel):
         return self.auto_radio_button.GetValue()
 
 
+class ChannelControlBox(wx.Panel):
+    """
+    A check box showing or hiding a plotted channel and a text box with the
+    gain its values are multiplied by.
+    """
+    def __init__(self, parent, label, color):
+        wx.Panel.__init__(self, parent)
+
+        self._gain = 1.
+
+        self.check_box = wx.CheckBox(self, -1, label)
+        self.check_box.SetValue(True)
+        self.check_box.SetForegroundColour(
+            wx.Colour(*[int(255 * c) for c in color])
+        )
+
+        self.textbox = wx.TextCtrl(
+            self,
+            size=(40, -1),
+            value="1",
+            style=wx.TE_PROCESS_ENTER
+        )
+        self.Bind(wx.EVT_TEXT_ENTER, self.on_text_enter, self.textbox)
+
+        sizer = wx.BoxSizer(wx.HORIZONTAL)
+        sizer.Add(self.check_box, flag=wx.ALIGN_CENTER_VERTICAL)
+        sizer.Add(wx.StaticText(self, label=" x"),
+                  flag=wx.ALIGN_CENTER_VERTICAL)
+        sizer.Add(self.textbox, flag=wx.ALIGN_CENTER_VERTICAL)
+
+        self.SetSizer(sizer)
+        sizer.Fit(self)
+
+    @property
+    def gain(self):
+        return self._gain
+
+    def on_text_enter(self, event):
+        try:
+            self._gain = float(self.textbox.GetValue())
+        except ValueError:
+            self.textbox.SetValue(str(self._gain))
+        event.Skip()
+
+    def is_visible(self):
+        return self.check_box.GetValue()
+
+
 class GraphFrame(wx.Frame):
     """The main frame of the application."""
 
     title = 'Demo: dynamic matplotlib graph'
 
-    def __init__(self, data_source):
+    def __init__(self, data_sources, blit=False,
+                 refresh_interval=REFRESH_INTERVAL_MS, instrument=False,
+                 detect_pulses=False, budget=DEFAULT_BUDGET):
         wx.Frame.__init__(self, None, -1, self.title)
 
-        self.data_source = data_source
-        self.data = [self.data_source.next()]
+        if not isinstance(data_sources, (list, tuple)):
+            data_sources = [data_sources]
+        self.data_sources = data_sources
+        self.blit = blit
+        # stretches the refresh interval when redraws get expensive
+        self.governor = FrameGovernor(refresh_interval, budget)
+        # performance counters shown in the status bar, opt-in
+        self.instrumentation = PlotInstrumentation(
+            data_sources, refresh_interval, governor=self.governor
+        ) if instrument else None
+        # everything the last redraw depended on, see draw_plot
+        self.frame_key = None
+        # per data source sample times in seconds since the first sample of
+        # any source, and values of all its channels in one pyramid
+        self.histories = [
+            SampleHistory(channels=getattr(data_source, 'channels', None)
+                          or 1)
+            for data_source in data_sources
+        ]
+        # plotted channels as (history index, column) pairs
+        self.channels = [
+            (i, column) for i, history in enumerate(self.histories)
+            for column in range(history.channels)
+        ]
+        self.channel_control_boxes = []
+        # pulse detectors fed with the plotted times, one per channel
+        self.pulse_detectors = [
+            PulseDetector() for _ in self.channels
+        ] if detect_pulses else []
+        self.pulse_annotations = deque()
+        self.time_origin = None
         self.paused = False
+        self.paused_at = None
 
         self.create_menu()
         self.create_status_bar()
         self.create_main_panel()
+        self.collect_samples()
 
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_plot_redraw, self.redraw_timer)
-        self.redraw_timer.Start(REFRESH_INTERVAL_MS)
+        self.redraw_timer.Start(self.governor.schedule(), oneShot=True)
 
     def create_menu(self):
         self.menu_bar = wx.MenuBar()
@@ -134,6 +230,14 @@ class GraphFrame(wx.Frame):
         )
         self.Bind(wx.EVT_MENU, self.on_plot_save, save_plot_entry)
 
+        if self.instrumentation is not None:
+            export_stats_entry = menu.Append(
+                id=-1,
+                item="&Export statistics\tCtrl-E",
+                helpString="Save performance statistics to a JSON file"
+            )
+            self.Bind(wx.EVT_MENU, self.on_stats_export, export_stats_entry)
+
         menu.AppendSeparator()
 
         exit_entry = menu.Append(
@@ -151,6 +255,7 @@ class GraphFrame(wx.Frame):
 
         self.plot_initialize()
         self.canvas = FigCanvas(self.panel, -1, self.figure)
+        self.renderer.attach(self.canvas)
 
         self.xmin_control_box = BoundControlBox(self.panel, "X min", 0)
         self.xmax_control_box = BoundControlBox(self.panel, "X max", 50)
@@ -208,6 +313,30 @@ class GraphFrame(wx.Frame):
             flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL
         )
 
+        if len(self.channels) > 1:
+            self.hbox1.AddSpacer(20)
+            for i, label in enumerate(self.channel_labels()):
+                box = ChannelControlBox(
+                    self.panel, label,
+                    CHANNEL_COLORS[i % len(CHANNEL_COLORS)]
+                )
+                self.Bind(
+                    wx.EVT_CHECKBOX,
+                    self.on_channel_control_box_change,
+                    box.check_box
+                )
+                self.Bind(
+                    wx.EVT_TEXT_ENTER,
+                    self.on_channel_control_box_change,
+                    box.textbox
+                )
+                self.channel_control_boxes.append(box)
+                self.hbox1.Add(
+                    box,
+                    border=5,
+                    flag=wx.ALL | wx.ALIGN_CENTER_VERTICAL
+                )
+
         self.hbox2 = wx.BoxSizer(wx.HORIZONTAL)
         self.hbox2.Add(self.xmin_control_box, border=5, flag=wx.ALL)
         self.hbox2.Add(self.xmax_control_box, border=5, flag=wx.ALL)
@@ -225,84 +354,238 @@ class GraphFrame(wx.Frame):
 
     def create_status_bar(self):
         self.status_bar = self.CreateStatusBar()
+        if self.instrumentation is not None:
+            # messages on the left, performance counters on the right
+            self.status_bar.SetFieldsCount(2)
+            self.status_bar.SetStatusWidths([-1, -4])
 
     def plot_initialize(self):
-
-        self.figure = Figure((3.0, 3.0), dpi=DPI)
-
-        self.axes = self.figure.add_subplot(111)
-        self.axes.set_facecolor('black')
-        self.axes.set_title('Arduino Serial Data', size=12)
-        self.axes.grid(color='grey')
-
-        plt.setp(self.axes.get_xticklabels(), fontsize=8)
-        plt.setp(self.axes.get_yticklabels(), fontsize=8)
-
-        # Plot the data and save the reference to the plotted line
-        self.plot_data = self.axes.plot(
-            self.data, linewidth=1, color=(1, 1, 0),
-        )[0]
+        # the figure is drawn by a renderer shared with benchmark.py
+        self.renderer = PlotRenderer(
+            len(self.channels), self.channel_labels(), blit=self.blit
+        )
+        self.figure = self.renderer.figure
+        self.axes = self.renderer.axes
+
+    def channel_labels(self):
+        """Return the legend labels of the plotted channels."""
+        labels = []
+        for i, column in self.channels:
+            name = getattr(self.data_sources[i], 'name', None) or \
+                'source {}'.format(i)
+            if self.histories[i].channels > 1:
+                name = '{} ch{}'.format(name, column)
+            labels.append(name)
+        return labels
+
+    def channel_settings(self):
+        """Return ``(visible, gain)`` of every plotted channel."""
+        if not self.channel_control_boxes:
+            return [(True, 1.)] * len(self.channels)
+        return [
+            (box.is_visible(), box.gain)
+            for box in self.channel_control_boxes
+        ]
 
     def get_plot_xrange(self):
         """
         Return minimal and maximal values of plot -xaxis range to be displayed.
 
-        Values of *x_min* and *x_max* by default are determined to show sliding
-        window of last 50 elements of data set and they can be manually set.
+        Values of *x_min* and *x_max*, in seconds since the first sample, by
+        default are determined to show sliding window of last *X_WINDOW*
+        seconds of data set and they can be manually set. The window stops
+        following the data while paused.
         """
-        x_max = max(len(self.data), 200) if self.xmax_control_box.is_auto() \
-            else int(self.xmax_control_box.value)
-
-        x_min = x_max - 200 if self.xmin_control_box.is_auto() \
-            else int(self.xmin_control_box.value)
+        if self.xmax_control_box.is_auto():
+            latest = self.paused_at if self.paused else self.latest_time()
+            x_max = max(latest, X_WINDOW)
+            if self.blit:
+                # page the window instead of scrolling it every frame
+                x_max = -(-x_max // X_STEP) * X_STEP
+        else:
+            x_max = float(self.xmax_control_box.value)
+
+        x_min = x_max - X_WINDOW if self.xmin_control_box.is_auto() \
+            else float(self.xmin_control_box.value)
 
         return x_min, x_max
 
-    def get_plot_yrange(self):
+    def get_plot_yrange(self, x_min, x_max):
         """
         Return minimal and maximal values of plot y-axis range to be displayed.
 
         Values of *y_min* and *y_max* are determined by finding minimal and
-        maximal values of the data set and adding minimal necessary margin.
-
+        maximal values of the visible channels between *x_min* and *x_max*,
+        times their gain, and adding minimal necessary margin. When the X
+        axis follows the data the extrema come from the sliding window,
+        otherwise from a range query on the pyramid, so the cost doesn't grow
+        with the history.
         """
-        y_min = round(min(self.data)) - 1 if self.ymin_control_box.is_auto() \
+        newest = self.xmin_control_box.is_auto() and \
+            self.xmax_control_box.is_auto() and not self.paused
+        data_min, data_max = channel_extrema(
+            self.histories, self.channels, self.channel_settings(),
+            x_min, x_max, newest
+        )
+        if data_min is None:
+            # nothing visible, keep the current bounds
+            data_min, data_max = self.axes.get_ybound()
+
+        y_min = round(data_min) - 1 if self.ymin_control_box.is_auto() \
             else int(self.ymin_control_box.value)
 
-        y_max = round(max(self.data)) + 1 if self.ymax_control_box.is_auto() \
+        y_max = round(data_max) + 1 if self.ymax_control_box.is_auto() \
             else int(self.ymax_control_box.value)
 
-        return y_min, y_max
+        if self.blit:
+            y_min, y_max = self.hold_yrange(y_min, y_max)
 
-    def draw_plot(self):
-        """Redraw the plot."""
+        return y_min, y_max
 
-        x_min, x_max = self.get_plot_xrange()
-        y_min, y_max = self.get_plot_yrange()
+    def hold_yrange(self, y_min, y_max):
+        """
+        Keep the drawn auto Y bounds while they still contain the data and
+        aren't more than twice as wide as needed, pad them when they change.
+        Each change of bounds costs a full redraw in blit mode.
+        """
+        if self.renderer.view is None:
+            return y_min, y_max
+        drawn_min, drawn_max = self.renderer.view[2:4]
+        if drawn_min <= y_min and y_max <= drawn_max and \
+                drawn_max - drawn_min <= 2 * (y_max - y_min):
+            if self.ymin_control_box.is_auto():
+                y_min = drawn_min
+            if self.ymax_control_box.is_auto():
+                y_max = drawn_max
+            return y_min, y_max
+        padding = round((y_max - y_min) * Y_PADDING)
+        if self.ymin_control_box.is_auto():
+            y_min -= padding
+        if self.ymax_control_box.is_auto():
+            y_max += padding
+        return y_min, y_max
 
-        self.axes.set_xbound(lower=x_min, upper=x_max)
-        self.axes.set_ybound(lower=y_min, upper=y_max)
+    def collect_samples(self):
+        """
+        Add the samples each data source received to its history and return
+        how many there were.
+        """
+        collected = 0
+        for i, (data_source, history) in enumerate(
+                zip(self.data_sources, self.histories)):
+            timestamps, values = data_source.drain()
+            if not len(values):
+                continue
+            if self.time_origin is None:
+                self.time_origin = timestamps[0]
+            times = timestamps - self.time_origin
+            values = values.reshape(len(values), -1)
+            history.extend(times, values)
+            collected += len(values)
+            if not self.pulse_detectors:
+                continue
+            for channel, (source, column) in enumerate(self.channels):
+                if source != i:
+                    continue
+                detector = self.pulse_detectors[channel]
+                for event in detector.feed(times, values[:, column]):
+                    self.annotate_pulse(channel, event)
+        return collected
+
+    def annotate_pulse(self, channel, event):
+        """
+        Mark a pulse onset with a dashed line, and a finished pulse with a
+        shaded span and its amplitude, rise and decay times at the peak.
+        """
+        color = CHANNEL_COLORS[channel % len(CHANNEL_COLORS)]
+        if not isinstance(event, Pulse):
+            artists = [self.axes.axvline(
+                event.time, color=color, linestyle='--', linewidth=.8
+            )]
+        else:
+            artists = [
+                self.axes.axvspan(
+                    event.onset, event.end, color=color, alpha=.15, lw=0
+                ),
+                self.axes.annotate(
+                    '{:.0f}\nrise {:.2f} s\ndecay {:.2f} s'.format(
+                        event.amplitude, event.rise_time, event.decay_time
+                    ),
+                    (event.peak_time,
+                     event.peak * self.channel_settings()[channel][1]),
+                    color='white', size=7,
+                    ha='center', va='bottom', annotation_clip=True,
+                ),
+            ]
+            message = 'Pulse at {:.2f} s: amplitude {:.0f}, rise {:.3f} s, ' \
+                'plateau {:.0f}, decay {:.3f} s'.format(
+                    event.onset, event.amplitude, event.rise_time,
+                    event.plateau, event.decay_time
+                )
+            print(message)
+            self.flash_status_message(message, 5000)
+        self.pulse_annotations.extend(artists)
+        while len(self.pulse_annotations) > MAX_PULSE_ANNOTATIONS:
+            self.pulse_annotations.popleft().remove()
+        # annotations are part of the background in blit mode
+        self.renderer.invalidate()
+
+    def latest_time(self):
+        """Return the time of the newest sample, 0 before the first one."""
+        latest = [history.latest_time() for history in self.histories]
+        latest = [t for t in latest if t is not None]
+        return max(latest) if latest else 0.
+
+    def draw_plot(self, only_if_changed=False):
+        """
+        Redraw the plot and return whether it was redrawn.
 
-        self.axes.grid(self.grid_visibility_check_box.IsChecked())
+        The bounds and display options are taken from the controls and
+        drawn by the renderer, see `PlotRenderer.draw`. With
+        *only_if_changed* nothing is drawn when neither the view nor
+        the visible data changed since the last redraw, e.g. while paused.
+        """
 
-        # Set x-axis labels visibility
-        plt.setp(
-            self.axes.get_xticklabels(),
-            visible=self.xlabels_visibility_check_box.IsChecked()
+        x_min, x_max = self.get_plot_xrange()
+        y_min, y_max = self.get_plot_yrange(x_min, x_max)
+
+        # samples newer than x_max, or than the pause, don't matter
+        newest = self.paused_at if self.paused else self.latest_time()
+        frame_key = (
+            x_min, x_max, y_min, y_max, min(newest, x_max),
+            tuple(self.channel_settings()),
+            self.grid_visibility_check_box.IsChecked(),
+            self.xlabels_visibility_check_box.IsChecked(),
         )
-
-        self.plot_data.set_xdata(np.arange(len(self.data)))
-        self.plot_data.set_ydata(np.array(self.data))
-
-        self.canvas.draw()
+        if only_if_changed and self.renderer.view is not None and \
+                frame_key == self.frame_key:
+            return False
+        self.frame_key = frame_key
+
+        # only the min/max envelope of the visible range is handed to
+        # matplotlib
+        self.renderer.set_data(
+            self.histories, self.channels, self.channel_settings(),
+            x_min, x_max
+        )
+        self.renderer.draw(
+            x_min, x_max, y_min, y_max,
+            grid=self.grid_visibility_check_box.IsChecked(),
+            xlabels=self.xlabels_visibility_check_box.IsChecked(),
+        )
+        return True
 
     def on_pause_button_click(self, event):
         self.paused = not self.paused
+        self.paused_at = self.latest_time()
 
     def on_pause_button_update(self, event):
         label = "Resume" if self.paused else "Pause"
         self.pause_button.SetLabel(label)
 
+    def on_channel_control_box_change(self, event):
+        self.draw_plot()
+
     def on_grid_visibility_control_box_toggle(self, event):
         self.draw_plot()
 
@@ -323,15 +606,51 @@ class GraphFrame(wx.Frame):
 
         if dlg.ShowModal() == wx.ID_OK:
             path = dlg.GetPath()
-            self.canvas.print_figure(path, dpi=DPI)
+            self.renderer.save(path)
             self.flash_status_message("Saved to {}".format(path))
 
     def on_plot_redraw(self, event):
-        """Get new value from data source if necessary and redraw the plot."""
-        if not self.paused:
-            self.data.append(self.data_source.next())
+        """
+        Take every sample that arrived since the last tick from the data
+        source and redraw the plot if anything visible changed. Samples keep
+        being collected while paused, only the view stays put. The next tick
+        is then scheduled by the governor.
+        """
+        if self.instrumentation is not None:
+            self.instrumentation.tick(self.governor.deadline)
+        started = clock()
+        collected = self.collect_samples()
+        if self.draw_plot(only_if_changed=True):
+            elapsed = clock() - started
+            self.governor.drawn(elapsed)
+            if self.instrumentation is not None:
+                self.instrumentation.frame(elapsed, collected)
+        else:
+            self.governor.skipped()
+            if self.instrumentation is not None:
+                self.instrumentation.frame(None, collected)
+        self.redraw_timer.Start(self.governor.schedule(), oneShot=True)
+
+        if self.instrumentation is not None and \
+                self.instrumentation.update() is not None:
+            self.status_bar.SetStatusText(
+                self.instrumentation.status_text(), 1
+            )
+
+    def on_stats_export(self, event):
+        dlg = wx.FileDialog(
+            self,
+            message="Export statistics as...",
+            defaultDir=os.getcwd(),
+            defaultFile="plot_stats.json",
+            wildcard="JSON (*.json)|*.json",
+            style=wx.FD_SAVE
+        )
 
-        self.draw_plot()
+        if dlg.ShowModal() == wx.ID_OK:
+            path = dlg.GetPath()
+            self.instrumentation.export(path)
+            self.flash_status_message("Saved to {}".format(path))
 
     def on_exit(self, event):
         self.Destroy()
@@ -353,22 +672,136 @@ class GraphFrame(wx.Frame):
 def parse_script_args():
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("port", help="serial port to be used")
+    parser.add_argument("ports", nargs="*", metavar="port",
+                        help="serial ports to be used, one channel each")
     parser.add_argument("-b", "--baudrate", type=int, help="port baud rate")
     parser.add_argument("-t", "--timeout", type=float,
                         help="port timeout value")
+    parser.add_argument("-p", "--protocol", choices=("ascii", "binary"),
+                        help="line protocol sent by the Arduino sketch")
+    parser.add_argument("-c", "--channels", type=int,
+                        help="analog inputs sent per sample by each board")
+    parser.add_argument("-r", "--record", metavar="DIR",
+                        help="record every sample to a session directory, "
+                             "one subdirectory per port if there are several")
+    parser.add_argument("--replay", metavar="DIR", nargs="+",
+                        help="play back recorded sessions instead of "
+                             "reading serial ports")
+    parser.add_argument("--speed", type=replay_speed, default=1.,
+                        help="replay speed factor, or 'max' to replay as "
+                             "fast as the plot takes samples")
+    parser.add_argument("--synthetic", metavar="RATE", type=float,
+                        nargs="?", const=1000.,
+                        help="plot a synthetic PID pulse train at RATE "
+                             "samples/s (default 1000) instead of reading "
+                             "serial ports")
+    parser.add_argument("--process", action="store_true",
+                        help="read each port in a child process through "
+                             "shared memory (Python 3.8+)")
+    parser.add_argument("--blit", action="store_true",
+                        help="only redraw the lines between axes changes")
+    parser.add_argument("--pulses", action="store_true",
+                        help="detect odor pulses and annotate them")
+    parser.add_argument("-s", "--stats", action="store_true",
+                        help="show performance counters in the status bar")
+    parser.add_argument("-i", "--interval", type=int,
+                        default=REFRESH_INTERVAL_MS,
+                        help="shortest plot refresh interval in ms")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET,
+                        help="fraction of the time redraws may take, the "
+                             "refresh interval grows beyond it (default "
+                             "%(default)s)")
 
     args = parser.parse_args()
+    serial = not (args.replay is not None or args.synthetic is not None)
+    if args.replay is not None and args.synthetic is not None:
+        parser.error("--replay can't be combined with --synthetic")
+    if serial and not args.ports:
+        parser.error("a serial port, --replay or --synthetic is required")
+    if not serial and (args.record is not None or args.process):
+        parser.error("--record and --process need serial ports")
+    if not 0 < args.budget <= 1:
+        parser.error("--budget must be in (0, 1]")
+    if args.process and (args.channels or 1) > 1:
+        parser.error("--process only supports a single channel per port")
+
+    return args
+
+
+def replay_speed(text):
+    """Parse a --speed value, None meaning as fast as possible."""
+    if text == "max":
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
 
-    return {key: val for key, val in vars(args).iteritems() if val is not None}
+
+def serial_kwargs(args):
+    """Return the `SerialData` keyword arguments set on the command line."""
+    keys = ("baudrate", "timeout", "protocol", "channels")
+    return {key: getattr(args, key) for key in keys
+            if getattr(args, key) is not None}
+
+
+def record_path(directory, port, n_ports):
+    """Return the session directory to record *port* to."""
+    if n_ports == 1:
+        return directory
+    return os.path.join(directory, os.path.basename(port))
 
 
 if __name__ == "__main__":
 
-    kwargs = parse_script_args()
-    data_source = SerialData(**kwargs)
+    args = parse_script_args()
+    recorders = []
+    if args.replay is not None:
+        data_sources = [ReplayData(path, speed=args.speed)
+                        for path in args.replay]
+    elif args.synthetic is not None:
+        data_sources = [
+            SyntheticPIDData(rate=args.synthetic, channels=args.channels)
+        ]
+    elif args.process:
+        # the child processes record too, so the GUI can't stall them
+        data_sources = [
+            AcquisitionProcess(
+                port, record=None if args.record is None else record_path(
+                    args.record, port, len(args.ports)
+                ), **serial_kwargs(args)
+            )
+            for port in args.ports
+        ]
+        for data_source in data_sources:
+            if data_source.error is not None:
+                print(data_source.error, file=sys.stderr)
+    else:
+        # all ports are read by a single thread
+        manager = AcquisitionManager()
+        data_sources = [
+            SerialData(port, buffered=True, manager=manager,
+                       **serial_kwargs(args))
+            for port in args.ports
+        ]
+        if args.record is not None:
+            for data_source in data_sources:
+                recorder = SessionRecorder(record_path(
+                    args.record, data_source.name, len(data_sources)
+                ), channels=data_source.channels)
+                data_source.add_listener(recorder.write)
+                recorders.append(recorder)
 
     app = wx.App()
-    app.frame = GraphFrame(data_source)
+    app.frame = GraphFrame(
+        data_sources, blit=args.blit, refresh_interval=args.interval,
+        instrument=args.stats, detect_pulses=args.pulses,
+        budget=args.budget
+    )
     app.frame.Show()
     app.MainLoop()
+
+    for data_source in data_sources:
+        data_source.close()
+    for recorder in recorders:
+        recorder.close()
@@ -14,6 +14,11 @@ enum {
     solvent_wash,
     open_CO2_valve,
     open_odor_CO2,
+    clear_steps,
+    add_step,
+    run_steps,
+    abort_steps,
+    step_event,
 };
 
 /* Initialize CmdMessenger -- this should match PyCmdMessenger instance */
@@ -62,6 +67,44 @@ volatile int flushOut = flushOutPins[panel];
 volatile int vacuumOut = vacuumOutPins[panel];
 
 
+/* batch mode: a table of steps is uploaded once, then run on the board
+   clock, each step starting at its own time from the start of the run.
+   Progress is sent back as step_event messages. Codes need to be
+   consistent with valve_board.py */
+#define MAX_STEPS 200
+// step actions
+enum {
+    STEP_EXTRA_FLUSH,
+    STEP_SWITCH_PANEL,
+    STEP_ODOR,
+    STEP_ODOR_CO2,
+    STEP_CO2,
+};
+// events reported with step_event
+enum {
+    SEQUENCE_STARTED,
+    STEP_STARTED,
+    VALVE_OPENED,
+    VALVE_CLOSED,
+    SEQUENCE_DONE,
+    SEQUENCE_ABORTED,
+};
+struct Step {
+  unsigned long start;  // in ms from the start of the run
+  byte action;
+  char valve;
+  int dur1;  // in units of 10ms
+  int dur2;  // in units of 10ms
+};
+Step steps[MAX_STEPS];
+int numSteps = 0;
+bool running = false;
+int stepIdx = 0;
+int phase = 0;
+unsigned long runStart = 0;
+unsigned long phaseDue = 0;
+
+
 /* function to deal with long delay */
 void delay_long(int ten_ms){
   unsigned long millis_now = millis();
@@ -298,6 +341,173 @@ void on_solvent_wash(void){
 }
 
 
+/* send a step_event message with the board time since the run started */
+void send_event(int idx, int code){
+  c.sendCmdStart(step_event);
+  c.sendCmdBinArg(idx);
+  c.sendCmdBinArg(code);
+  c.sendCmdBinArg(millis() - runStart);
+  c.sendCmdEnd();
+}
+
+
+/* perform one phase of a step, return ms until the next one, -1 when done */
+long step_phase(Step &s, int idx, int ph){
+  if(s.action == STEP_EXTRA_FLUSH){
+    // flush with z-flush line, then z + extra lines
+    if(ph == 0){
+      return max(s.dur1, 0) * 10L;
+    }
+    if(ph == 1){
+      digitalWrite(vacuumOut, HIGH);
+      return max(s.dur2, 0) * 10L;
+    }
+    digitalWrite(vacuumOut, LOW);
+    return -1;
+  }
+  if(s.action == STEP_SWITCH_PANEL){
+    on_switch_panel();
+    return -1;
+  }
+  if(s.action == STEP_CO2){
+    if(ph == 0){
+      digitalWrite(masterCO2Valve, HIGH);
+      digitalWrite(masterCtrl2Valve, HIGH);  // since masterCtrlValve is N.O.
+      send_event(idx, VALVE_OPENED);
+      return s.dur1 * 10L;
+    }
+    digitalWrite(masterCO2Valve, LOW);
+    digitalWrite(masterCtrl2Valve, LOW);
+    send_event(idx, VALVE_CLOSED);
+    return -1;
+  }
+  // odor channel, with CO2 for STEP_ODOR_CO2
+  int in = allInPins[s.valve - 65];  // A is ascii 65
+  int out = allOutPins[s.valve - 65];
+  bool co2 = s.action == STEP_ODOR_CO2;
+  if(ph == 0){
+    // fill the tubing space, masterOdorValve still to exhaust
+    digitalWrite(in, HIGH);
+    digitalWrite(out, HIGH);
+    digitalWrite(flushIn, LOW);
+    digitalWrite(flushOut, LOW);
+    return prepare * 10L;
+  }
+  if(ph == 1){
+    digitalWrite(masterOdorValve, HIGH);
+    digitalWrite(masterCtrlValve, HIGH);  // since masterCtrlValve is N.O.
+    if(co2){
+      digitalWrite(masterCO2Valve, HIGH);
+      digitalWrite(masterCtrl2Valve, HIGH);
+    }
+    send_event(idx, VALVE_OPENED);
+    return s.dur1 * 10L;
+  }
+  digitalWrite(masterOdorValve, LOW);
+  digitalWrite(masterCtrlValve, LOW);
+  if(co2){
+    digitalWrite(masterCO2Valve, LOW);
+    digitalWrite(masterCtrl2Valve, LOW);
+  }
+  send_event(idx, VALVE_CLOSED);
+  // flush the panel manifold
+  digitalWrite(in, LOW);
+  digitalWrite(out, LOW);
+  digitalWrite(flushIn, HIGH);
+  digitalWrite(flushOut, HIGH);
+  return -1;
+}
+
+
+/* run the phase of the current step when it's due, called from loop */
+void run_due_phase(void){
+  unsigned long now = millis();
+  if((long)(now - phaseDue) < 0){
+    return;
+  }
+  if(phase == 0){
+    // phases are timed from the actual start of the step
+    phaseDue = now;
+    send_event(stepIdx, STEP_STARTED);
+  }
+  long next = step_phase(steps[stepIdx], stepIdx, phase);
+  if(next >= 0){
+    phase++;
+    phaseDue += next;
+    return;
+  }
+  // the next step starts at its own time, even if this one ran late
+  stepIdx++;
+  phase = 0;
+  if(stepIdx >= numSteps){
+    running = false;
+    send_event(numSteps, SEQUENCE_DONE);
+    return;
+  }
+  phaseDue = runStart + steps[stepIdx].start;
+}
+
+
+void on_clear_steps(void){
+  if(!running){
+    numSteps = 0;
+  }
+}
+
+
+void on_add_step(void){
+  Step s;
+  s.start = c.readBinArg<unsigned long>();
+  s.action = c.readBinArg<byte>();
+  s.valve = c.readBinArg<char>();
+  s.dur1 = c.readBinArg<int>();
+  s.dur2 = c.readBinArg<int>();
+  // steps beyond the table are dropped, python sees it in SEQUENCE_STARTED
+  if(!running && numSteps < MAX_STEPS){
+    steps[numSteps++] = s;
+  }
+}
+
+
+void on_run_steps(void){
+  if(running){
+    return;
+  }
+  runStart = millis();
+  stepIdx = 0;
+  phase = 0;
+  send_event(numSteps, SEQUENCE_STARTED);
+  if(numSteps == 0){
+    send_event(0, SEQUENCE_DONE);
+    return;
+  }
+  running = true;
+  phaseDue = runStart + steps[0].start;
+}
+
+
+/* close the master valves and go back to flushing */
+void on_abort_steps(void){
+  if(!running){
+    return;
+  }
+  running = false;
+  digitalWrite(masterOdorValve, LOW);
+  digitalWrite(masterCtrlValve, LOW);
+  digitalWrite(masterCO2Valve, LOW);
+  digitalWrite(masterCtrl2Valve, LOW);
+  digitalWrite(vacuumOut, LOW);
+  Step &s = steps[stepIdx];
+  if(s.action == STEP_ODOR || s.action == STEP_ODOR_CO2){
+    digitalWrite(allInPins[s.valve - 65], LOW);
+    digitalWrite(allOutPins[s.valve - 65], LOW);
+  }
+  digitalWrite(flushIn, HIGH);
+  digitalWrite(flushOut, HIGH);
+  send_event(stepIdx, SEQUENCE_ABORTED);
+}
+
+
 /* Attach callbacks for CmdMessenger commands */
 void attach_callbacks(void) {
     c.attach(open_odor_valve, on_open_odor_valve);
@@ -307,6 +517,10 @@ void attach_callbacks(void) {
     c.attach(solvent_wash, on_solvent_wash);
     c.attach(open_CO2_valve, on_open_CO2_valve);
     c.attach(open_odor_CO2, on_open_odor_CO2);
+    c.attach(clear_steps, on_clear_steps);
+    c.attach(add_step, on_add_step);
+    c.attach(run_steps, on_run_steps);
+    c.attach(abort_steps, on_abort_steps);
 }
 
 
@@ -338,4 +552,7 @@ void setup() {
 
 void loop() {
     c.feedinSerialData();
+    if(running){
+        run_due_phase();
+    }
 }
@@ -5,7 +5,9 @@
 # Nov 09, 2017
 # GUI to control the odor delivery system
 # comminucate to Arduino board with serial
+# Run with --simulate to use the boards, DAQ and Markes of rig_simulator.py
 
+import argparse
 
 import PyCmdMessenger
 import tkinter as tk
@@ -19,45 +21,25 @@ import numpy as np
 from numpy.random import permutation
 from sklearn import linear_model
 import threading
-import nidaqmx
+try:
+    import nidaqmx
+except ImportError:  # only needed with the rig attached
+    nidaqmx = None
 from multiprocessing import Process
-
-
-def pattern_parser(pattern):
-    """parse the odor pattern string into parameter value lists"""
-    # example: pattern 'A3_Z10_J3_#_Z5_N2;1'
-    # parsed:[6, 'A', 300, 'Z', 1000, 'J', 300, '#', 0, 'Z', 500, 'N', 200]
-    # 1st int is the number of channels including Z and #
-    # for repeated pattern, duplicate items in the list
-    num_channels = 0
-    # repeats number separate by ;
-    pattern_fields = pattern.split(';')
-    if len(pattern_fields) == 1:
-        repeat = 1
-    else:
-        repeat = int(pattern_fields[1])
-    stream = pattern_fields[0]
-    parameters_value_temp = []
-    num_channels = 0
-    fields = stream.split('_')
-    for f in fields:
-        if 'W' in f:
-            info = f.split('W')
-            valve = info[0] + 'W'
-            duration = int(float(info[1]) * 100)  # time unit is 10ms
-        else:
-            valve = f[0]
-            if valve == '#':
-                parameters_value_temp += [valve, 0]
-                num_channels += 1
-                continue
-            duration = int(float(f[1:]) * 100)  # time unit is 10ms
-        parameters_value_temp += [valve, duration]
-        num_channels += 1
-    parameters_value = [repeat, [num_channels] + parameters_value_temp]
-    # cases where only odor or CO2 is specified, add an empty list
-    return parameters_value
-    # print(parameters_value_final)
+from event_log import (BLOCK_FINISHED, BLOCK_STARTED, BOARD_EVENT_TYPES,
+                       CO2_OPENED, COMMAND_RECEIVED, INTERRUPTED,
+                       MARKES_TRIGGERED, NOT_PLANNED, STEP_STARTED,
+                       TRAP_FIRED, TRIGGER_OFF, TRIGGER_START, TRIGGER_STOP,
+                       EventLog, clock_ns, timeline_record)
+from pattern_scheduler import (PatternScheduler, compile_pattern,
+                               pattern_parser)
+from precise_timing import clock, sleep_ms, wait_until
+from serial_demux import BoardReader
+from trap_fire import TrapFireDetector, open_input
+from ttl_waveform import (LEAD, START, STOP, Acquisition, TriggerTrain,
+                          open_output, split_triggers)
+from valve_board import (SEQUENCE_STARTED, VALVE_COMMANDS, BoardSequence,
+                         compile_steps)
 
 
 def when_interrupted():
@@ -72,198 +54,155 @@ def when_interrupted():
 
 def wait_ms(ms):
     """wait ms milliseconds"""
-    time_ori = datetime.now()
-    while(1):
-        time_elapse = datetime.now() - time_ori
-        # convert to ms
-        time_elapse_ms = time_elapse.seconds * 1000 + time_elapse.microseconds / 1000
-        # need to constantly check if interrupted
-        if interrupted or time_elapse_ms > ms:
-            break
-
-
-def serial_timestamp(arduino):
-    """constantly monitor serial, return the timestamp when it's not empty"""
-    while(1):
-        input = arduino.read()
-        if input == b'1':  # get some input from Arduino
-            print(str(datetime.now()))
-            return
+    # sleeps most of the time, need to constantly check if interrupted
+    sleep_ms(ms, lambda: interrupted)
 
 
-def daq_ttl_thread(symbol, duration):
-    """generate a square TTL for DAQ line for the valve"""
-    def daq_ttl_thread_callback():
-        # start trigger ttl
-        print('triggerStart for ' + symbol + ':', end='')
-        start_write_time = datetime.now()
-        print(str(start_write_time))
-        daq_task.write([True, False])  # write function takes time
-        wait_ms(acquisition_on)
-        daq_task.write([False, False])
-        t = datetime.now() - start_write_time
-        start_take_time = t.seconds * 1000 + t.microseconds / 1000
-        # wait until stop trigger ttl
-        wait_ms(acquisition_pre * 1000 + duration * 10 + acquisition_post * 1000 - start_take_time)
-        print('triggerStop for ' + symbol + ':', end='')
-        print(str(datetime.now()))
-        daq_task.write([False, True])
-        print('>>>>>')
-        wait_ms(acquisition_on)
-        daq_task.write([False, False])
-        return
-    t2 = threading.Thread(target=daq_ttl_thread_callback)
-    t2.start()
+def serial_timestamp(reader, sent=None):
+    """wait for the board of reader to acknowledge, return the timestamp in
+    ns when the byte arrived, None if it doesn't or Stop is pressed"""
+    # sent: when the command was sent, to drop stale acknowledgements
+    received = reader.wait_ack(is_cancelled=lambda: interrupted, sent=sent)
+    if received is None:
+        return None
+    return int(received * 1e9)
 
 
 def daq_ttl_thread_simple(total_duration):
     """generate a square TTL for DAQ line based on total recording duration"""
-    def daq_ttl_thread_simple_callback():
-        # start trigger ttl
-        print('triggerStart at:', end='')
-        start_write_time = datetime.now()
-        print(str(start_write_time))
-        daq_task.write([True, False])  # write function takes time
-        wait_ms(acquisition_on)
-        daq_task.write([False, False])
-        t = datetime.now() - start_write_time
-        start_take_time = t.seconds * 1000 + t.microseconds / 1000
-        # wait until stop trigger ttl
-        wait_ms(total_duration*1000 - start_take_time)
-        print('triggerStop at: ', end='')
-        print(str(datetime.now()))
-        daq_task.write([False, True])
-        print('>>>>>')
-        wait_ms(acquisition_on)
-        daq_task.write([False, False])
-        return
-    t5 = threading.Thread(target=daq_ttl_thread_simple_callback)
-    t5.start()
+    # the start and stop pulse are played as one waveform, see ttl_waveform.py
+    train = TriggerTrain(
+        trigger_output, [Acquisition(0, total_duration * 1000, 'trap')],
+        acquisition_on, origin=clock() + LEAD,
+        is_cancelled=lambda: interrupted, on_finished=log_triggers
+    )
+    train.start()
+
+
+def log_triggers(train):
+    """log the trigger edges played by train, and print their timing"""
+    for edge in train.edges:
+        if edge.levels[START]:
+            event_type = TRIGGER_START
+        elif edge.levels[STOP]:
+            event_type = TRIGGER_STOP
+        else:
+            event_type = TRIGGER_OFF
+        event_log.log(event_type, train.edge_label(edge), edge.planned,
+                      time_ns=int((train.origin + edge.actual / 1000.) * 1e9))
+    print('\n'.join(train.report()))
+
 
-# log = open('temp.txt', 'w')
 def daq_ttl_thread_markes(open_CO2=False, delay_duration=3, co2_duration=3):
     """monitoring the trap firing time from Markes"""
-    def daq_ttl_thread_markes_callback():
-        # start trigger ttl
-        # while not daq_task2.read():
-        #     a=1
-        # print(datetime.now())
-        # print('Trap fire time, see above')
-        # read 4 bytes, if all true, then it's on
-        # single byte may suffer from noise
-        flag_continue = 1
-        a1 = daq_task2.read()
-        a2 = daq_task2.read()
-        a3 = daq_task2.read()
-        while flag_continue:
-            a4 = daq_task2.read()
-            if a1 and a2 and a3 and a4:
-                flag_continue = 0
-            a1 = a2
-            a2 = a3
-            a3 = a4
-            # a = daq_task2.read()
-            # log.write(str(datetime.now())+'\t'+str(a)+'\n')
-        time_fire = datetime.now()
-        print('Trap fire at:' + str(time_fire))
+    def trap_fired(detector):
+        if detector.fire_time is None:
+            if not interrupted:
+                print('no trap fire within {} s'.format(detector.timeout))
+            return
+        # the fire time is that of its first sample, the delay in us
+        event_log.log(TRAP_FIRED, time_ns=int(detector.fire_time * 1e9),
+                      value=int(detector.delay * 1e6))
         if open_CO2:
-            wait_ms(delay_duration*1000)
+            wait_until(detector.fire_time + delay_duration,
+                       lambda: interrupted)
             cmd.send('open_CO2_valve', co2_duration * 100)
-            print('CO2 valve opened at:', str(datetime.now()))
-        return
-    t3 = threading.Thread(target=daq_ttl_thread_markes_callback)
+            event_log.log(CO2_OPENED, 'CO2', value=co2_duration * 100)
+    # single samples may suffer from noise, see trap_fire.py
+    t3 = TrapFireDetector(markes_input, is_cancelled=lambda: interrupted,
+                          on_fire=trap_fired)
     t3.start()
 
 
-def calculate_flush(total_dur):
-    """calculate how to divide the total_dur into regular
-    z-flush and extra-flush, remaining time is regular z-
-    flush to establish a flowrate balance"""
-    pre_flush_dur = 300  # unit 10ms
-    extra_flush_dur = total_dur - 3 * pre_flush_dur
-    return pre_flush_dur, extra_flush_dur
-
-
-def go_through_pattern(arduino, cmd, parameters_value):
+def go_through_pattern(reader, cmd, parameters_value):
     """go through the odor delivery pattern in a separate thread"""
     print(parameters_value)
     num_repeat = parameters_value[0]
-    odor_pattern = parameters_value[1]
-    num_valves = odor_pattern[0]
     print('num_repeat', num_repeat)
-    def go_through_pattern_callback():
-        for r in range(num_repeat):
-            for n_v in range(num_valves):
-                if interrupted:
-                    break
-                idx = 1 + n_v * 2  # the idx of valve in the pattern list
-                valve_symbol = odor_pattern[idx]
-                valve_duration = odor_pattern[idx + 1]   # in unit of 10ms)
-                if valve_symbol == 'Z':
-                    # added 20180827: extra flush Control
-                    [pre_flush_dur, extra_flush_dur] = calculate_flush(valve_duration)
-                    # [pre_flush_dur, extra_flush_dur] = [300, 2000]  # unit of 10ms
-                    cmd.send('extra_flush', pre_flush_dur, extra_flush_dur)
-                    # this a control valve, if next channel is an odor channel
-                    # need to send DAQ START signal for it
-                    if n_v < odor_pattern[0] - 1 and \
-                            odor_pattern[idx + 2][0] in all_valves+['W']:
-                        # wait ms before start image acquisition
-                        wait_ms(valve_duration * 10 - acquisition_pre * 1000)
-                        # send the start signal and print timestamp
-                        # daq_ttl(start_line)
-                        # print('triggerStart for ' + parameters_value[idx+2] + \
-                        # ": " + str(datetime.now()))
-                        # start a new thread in order to send DAQ STOP signal
-                        # 20180918 comment this line to disable trigger
-                        daq_ttl_thread(odor_pattern[idx+2], odor_pattern[idx+3])
-                        # wait a little more until send signal to Arduino
-                        # print(acquisition_pre * 1000 - acquisition_on - prepare)
-                        # print(str(datetime.now()))
-                        wait_ms(acquisition_pre * 1000 - acquisition_on - prepare)
-                        # print(str(datetime.now()))
-                    else:
-                        # Z is the last channel or next channel is not odor channel
-                        # do nothing but wait
-                        wait_ms(valve_duration * 10 - prepare)   # in unit of ms
-                elif valve_symbol == '#':
-                    total_switch_dur = 3000  # in unit of 10ms
-                    [pre_flush_dur, extra_flush_dur] = calculate_flush(total_switch_dur)
-                    # [pre_flush_dur, extra_flush_dur] = [300, 2000]  # unit of 10ms
-                    cmd.send('extra_flush', pre_flush_dur, extra_flush_dur)
-                    print('flushing manifold before switching')
-                    wait_ms(total_switch_dur * 10 + 3000)  # wait 33s to flush the old manifold
-                    cmd.send('switch_panel')
-                    print('switchPanel:' + str(datetime.now()))
-                    cmd.send('extra_flush', pre_flush_dur, extra_flush_dur)
-                    print('flushing manifold after switching')
-                    wait_ms(total_switch_dur * 10 + 3000)  # wait 33s to flush the new manifold
-                elif valve_symbol == 'W' or valve_symbol == 'w':
-                    # lower case 'w' means don't start DAQ trigger
-                    # CO2 valve only
-                    cmd.send('open_CO2_valve', valve_duration)
-                    print('CO2\n'+str(datetime.now()))
-                    serial_timestamp(arduino_valve)
-                    serial_timestamp(arduino_valve)
-                    serial_timestamp(arduino_valve)
-                else:
-                    # odor valve, send command to Arduino
-                    # monitor serial and print out timestamp
-                    print('channel_' + valve_symbol)
-                    if len(valve_symbol)==1:
-                        cmd.send('open_odor_valve', valve_symbol, valve_duration)
-                    else:
-                        cmd.send('open_odor_CO2', valve_symbol[0], valve_duration)
-                    print(str(datetime.now()))
-                    serial_timestamp(arduino_valve)
-                    serial_timestamp(arduino_valve)
-                    serial_timestamp(arduino_valve)
-            # loop is finished, reset the Start and Stop button and flag
+    # every command, valve acknowledgement and DAQ trigger is due at a fixed
+    # time from the start, so delays don't add up over the pattern
+    timeline = compile_pattern(
+        parameters_value, all_valves,
+        acquisition_pre=acquisition_pre * 1000,
+        acquisition_post=acquisition_post * 1000,
+        acquisition_on=acquisition_on, prepare=prepare
+    )
+    # the acquisition triggers of the whole block are played as one waveform
+    acquisitions, timeline = split_triggers(timeline)
+    train = TriggerTrain(trigger_output, acquisitions, acquisition_on,
+                         is_cancelled=lambda: interrupted,
+                         on_finished=log_triggers)
+
+    last_sent = None
+
+    def send_command(event):
+        nonlocal last_sent
+        last_sent = clock()
+        cmd.send(*event.args)
+        event_log.log(*timeline_record(event), planned_ms=event.time)
+
+    def read_ack(event):
+        event_type, channel = timeline_record(event)
+        # the first acknowledgement answers the command just sent
+        sent = last_sent if event_type == COMMAND_RECEIVED else None
+        received = serial_timestamp(reader, sent)
+        if received is None:
+            return
+        # in us, for the acknowledgement of a command
+        latency = 0 if sent is None else received // 1000 - int(sent * 1e6)
+        event_log.log(event_type, channel, event.time, latency, received)
+
+    def pattern_finished(scheduler):
+        # e.g. the stop trigger of the last acquisition is still due
+        if train.ident is not None:
+            train.join()
+        event_log.log(BLOCK_FINISHED, value=int(bool(interrupted)))
+        # print the timing off the critical path
+        print('\n'.join(scheduler.report()))
+        print(reader.latency_summary())
+        # loop is finished, reset the Start and Stop button and flag
         when_interrupted()
+
+    def log_board_event(sequence, event):
+        origin = sequence.scheduler.origin
+        if event.code == SEQUENCE_STARTED:
+            event_log.log(BLOCK_STARTED, value=num_repeat,
+                          time_ns=int(origin * 1e9))
+            # on the board clock as first estimated
+            train.origin = origin
+            train.start()
+            return
+        event_type = BOARD_EVENT_TYPES.get(event.code)
+        if event_type is not None:
+            step = sequence.steps[event.step]
+            planned = step.start if event_type == STEP_STARTED \
+                else NOT_PLANNED
+            event_log.log(event_type, step.valve, planned, event.board_ms,
+                          int((origin + event.host_ms / 1000.) * 1e9))
+
+    if run_on_board.get():
+        # the board runs the valve steps on its own clock, the host only
+        # plays the DAQ triggers
+        steps, host_timeline = compile_steps(timeline)
+        sequence = BoardSequence(
+            cmd, reader, steps, host_timeline, {},
+            is_cancelled=lambda: interrupted, on_finished=pattern_finished,
+            on_event=log_board_event
+        )
+        sequence.start()
         return
-    # use a new thread, to avoid freezing the GUI
-    t1 = threading.Thread(target=go_through_pattern_callback)
-    t1.start()
+
+    origin = clock_ns() + int(LEAD * 1e9)
+    event_log.log(BLOCK_STARTED, value=num_repeat, time_ns=origin)
+    scheduler = PatternScheduler(
+        timeline, {'send': send_command, 'ack': read_ack},
+        is_cancelled=lambda: interrupted, on_finished=pattern_finished,
+        origin=origin / 1e9
+    )
+    train.origin = origin / 1e9
+    # use new threads, to avoid freezing the GUI
+    train.start()
+    scheduler.start()
 
 
 def start_loop(markes_bool=False):
@@ -287,14 +226,14 @@ def start_loop(markes_bool=False):
     print('pattern:' + str(parameters_value))
     print('>>>>>')
     # loop through the pattern, open the valve one by one
-    go_through_pattern(arduino_valve, cmd, parameters_value)
+    go_through_pattern(reader_valve, cmd, parameters_value)
 
 
 def stop_loop():
     """stop button is pressed"""
     global interrupted
     interrupted = 1
-    print('interrupted:' + str(datetime.now()), end='\t')
+    event_log.log(INTERRUPTED)
 
 
 def enable_random():
@@ -445,9 +384,10 @@ def load_markes_tubes():
     delay_single = 60 * 1
 
     # send command to Arduino to trigger Markes to load tubes
+    sent = clock()
     cmd_MFC.send('trigger_markes', 10)
-    print('Load Markes tubes at:')
-    serial_timestamp(arduino_MFC)
+    event_log.log(MARKES_TRIGGERED, value=10,
+                  time_ns=serial_timestamp(reader_MFC, sent))
 
     # deliver single odorant block if specified
     single_block_idx = int(markes_single_odorant_entry.get())
@@ -464,7 +404,8 @@ def open_CO2_valve_thread(delay_duration, co2_duration):
     def open_CO2_valve_thread_callback():
         wait_ms(delay_duration * 1000)
         cmd.send('open_CO2_valve', co2_duration * 100)
-        print('CO2 valve opened at:', str(datetime.now()))
+        event_log.log(CO2_OPENED, 'CO2', delay_duration * 1000,
+                      co2_duration * 100)
         return
     t4 = threading.Thread(target=open_CO2_valve_thread_callback)
     t4.start()
@@ -491,8 +432,8 @@ def trigger_markes():
 
     # start trap purge
     cmd_MFC.send('trigger_markes', 90)
-    print('Start pre-fire trap purge at: ', str(datetime.now()))
-    # serial_timestamp(arduino_MFC)
+    event_log.log(MARKES_TRIGGERED, value=90)
+    # serial_timestamp(reader_MFC)
 
     # start the ScanImage trigger
     daq_ttl_thread_simple(total_duration)
@@ -514,6 +455,26 @@ def trigger_markes():
         daq_ttl_thread_markes()
 
 # settings
+parser = argparse.ArgumentParser(
+    description='GUI to control the odor delivery system')
+parser.add_argument('--simulate', action='store_true',
+                    help='use simulated boards, DAQ and Markes')
+parser.add_argument('--markes-latency', type=float, default=None,
+                    help='seconds from triggering the simulated Markes to '
+                    'the trap firing')
+parser.add_argument('--event-log', default=None,
+                    help='file of the timing events, .csv or binary, '
+                    'events_<date>_<time>.csv by default')
+args = parser.parse_args()
+if args.simulate:
+    from rig_simulator import FIRE_LATENCY, SimulatedRig
+elif nidaqmx is None:
+    parser.error('nidaqmx is not installed, run with --simulate')
+# timing events of the session, see event_log.py
+if args.event_log is None:
+    args.event_log = datetime.now().strftime('events_%Y%m%d_%H%M%S.csv')
+event_log = EventLog(args.event_log)
+
 # DAQ
 # 20180918 comment following lines to disable DAQ trigger
 dev = 'USB6000/'
@@ -522,11 +483,18 @@ start_line = 'pfi0'
 stop_line = 'pfi1'
 # which line is connected to Markes for monitoring trap firing time
 markes_line = 'port0/line2'
-daq_task = nidaqmx.Task()
-daq_task.do_channels.add_do_chan(dev + start_line)
-daq_task.do_channels.add_do_chan(dev + stop_line)
-daq_task2 = nidaqmx.Task()
-daq_task2.di_channels.add_di_chan(dev + markes_line)
+if args.simulate:
+    if args.markes_latency is None:
+        args.markes_latency = FIRE_LATENCY
+    rig = SimulatedRig(fire_latency=args.markes_latency,
+                       markes_line=dev + markes_line)
+    new_task = rig.daq.Task
+else:
+    new_task = nidaqmx.Task
+# hardware timed if the DAQ can, see ttl_waveform.py
+trigger_output = open_output(new_task, [dev + start_line, dev + stop_line])
+# sample clocked if the DAQ can, see trap_fire.py
+markes_input = open_input(new_task, dev + markes_line)
 # how many seconds pre and post odor should acquire images for
 acquisition_pre = 7
 acquisition_post = 20
@@ -544,21 +512,27 @@ com_MFC = 'com9'    # Uno board to control MFC
 # 20180918 change the com name for use with MacBook
 #com_valve = '/dev/cu.usbmodem1411'  # Mega2560 board to control valves
 #com_MFC = '/dev/cu.usbmodem1421'    # Uno board to control MFC
-arduino_valve = PyCmdMessenger.ArduinoBoard(com_valve, baud_rate=115200)
+if args.simulate:
+    arduino_valve = rig.valve_board
+else:
+    arduino_valve = PyCmdMessenger.ArduinoBoard(com_valve, baud_rate=115200)
 # arduino = PyCmdMessenger.ArduinoBoard("/dev/cu.usbmodem1441", baud_rate=115200)
-commands_valve = [['open_odor_valve', 'ci'],
-                  ['switch_panel', ''],
-                  ['extra_flush', 'ii'],
-                  ['purge_system', 'i'],
-                  ['solvent_wash', ''],
-                  ['open_CO2_valve', 'i'],
-                  ['open_odor_CO2', 'ci']]
+# batch mode commands included, see valve_board.py
+commands_valve = VALVE_COMMANDS
 # attach commands to Arduino
 cmd = PyCmdMessenger.CmdMessenger(arduino_valve, commands_valve)
-arduino_MFC = PyCmdMessenger.ArduinoBoard(com_MFC, baud_rate=115200)
+if args.simulate:
+    arduino_MFC = rig.mfc_board
+else:
+    arduino_MFC = PyCmdMessenger.ArduinoBoard(com_MFC, baud_rate=115200)
 commands_MFC = [['flow_setup', 'iiiii'],
                 ['trigger_markes', 'i']]
 cmd_MFC = PyCmdMessenger.CmdMessenger(arduino_MFC, commands_MFC)
+# one thread per board reads what it sends, see serial_demux.py
+reader_valve = BoardReader(arduino_valve, commands_valve)
+reader_valve.start()
+reader_MFC = BoardReader(arduino_MFC, commands_MFC)
+reader_MFC.start()
 
 
 # default flow rates, set as string type
@@ -753,7 +727,19 @@ ttk.Label(frame_control, text='CO2 duration(s):').grid(column=0, row=6)
 CO2duration_entry = ttk.Entry(frame_control, width=4)
 CO2duration_entry.grid(column=1, row=6)
 CO2duration_entry.insert(tk.END, 3)
+# run the odor pattern on the valve board clock instead of step by step
+run_on_board = tk.BooleanVar(value=False)
+check_run_on_board = tk.Checkbutton(frame_control, text='Run on board',
+                                    variable=run_on_board)
+check_run_on_board.grid(column=0, row=7, sticky=tk.W)
 
 
 # start mainloop
 win.mainloop()
+event_log.close()
+reader_valve.close()
+reader_MFC.close()
+markes_input.close()
+trigger_output.close()
+if args.simulate:
+    rig.close()
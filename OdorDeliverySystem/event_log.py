@@ -0,0 +1,181 @@
+# Asynchronous event log of a session
+#
+# The timing threads used to print datetime.now() to the console, doing I/O
+# at the very moments they time, on a clock that jumps with the system time.
+# Here each event is one fixed-size record (monotonic time in ns, event
+# type, channel and planned time) copied into a preallocated buffer under a
+# lock, which takes a few microseconds. A writer thread swaps the buffer for
+# a second one every FLUSH_INTERVAL and appends the records to a file, CSV
+# if its name ends with .csv, else raw records readable by read_log, so
+# every session leaves a machine-readable timeline.
+
+import csv
+import threading
+import time
+
+import numpy as np
+
+from precise_timing import clock
+import valve_board
+
+# time of precise_timing.clock in integer ns
+clock_ns = getattr(time, 'perf_counter_ns', lambda: int(clock() * 1e9))
+
+# records per buffer, events beyond it before the next flush are dropped
+CAPACITY = 4096
+# seconds between writes of the buffered records
+FLUSH_INTERVAL = .5
+# planned_ms of events without a plan
+NOT_PLANNED = float('nan')
+
+# time_ns: precise_timing clock; channel: valve symbol or 'CO2', 'Z' for
+# the flush of a rest period and '#' for the sends of a panel switch, for
+# triggers the odor of the acquisition;
+# planned_ms: from the start of the block, or of the Markes trigger;
+# value: depends on the type, e.g. the board time in ms of board events
+RECORD = np.dtype([('time_ns', '<i8'), ('type', 'u1'), ('channel', 'S4'),
+                   ('planned_ms', '<f8'), ('value', '<i8')])
+
+# event types, value in brackets
+SESSION_STARTED = 0     # (wall clock time in us since 1970)
+BLOCK_STARTED = 1       # (number of repeats)
+BLOCK_FINISHED = 2      # (1 if interrupted)
+COMMAND_SENT = 3
+COMMAND_RECEIVED = 4    # (latency after sending the command in us)
+VALVE_OPENED = 5        # (board time in ms in batch mode)
+VALVE_CLOSED = 6        # (board time in ms in batch mode)
+STEP_STARTED = 7        # (board time in ms)
+TRIGGER_START = 8
+TRIGGER_STOP = 9
+TRIGGER_OFF = 10
+MARKES_TRIGGERED = 11   # (trigger duration in s)
+TRAP_FIRED = 12         # (detection delay in us)
+CO2_OPENED = 13         # (duration in units of 10ms)
+INTERRUPTED = 14
+EVENT_TYPES = ['session started', 'block started', 'block finished',
+               'command sent', 'command received', 'valve opened',
+               'valve closed', 'step started', 'trigger start',
+               'trigger stop', 'trigger off', 'markes triggered',
+               'trap fired', 'CO2 opened', 'interrupted']
+
+# types of the step_event codes of the valve board about steps
+BOARD_EVENT_TYPES = {valve_board.STEP_STARTED: STEP_STARTED,
+                     valve_board.VALVE_OPENED: VALVE_OPENED,
+                     valve_board.VALVE_CLOSED: VALVE_CLOSED}
+
+CSV_FIELDS = RECORD.names
+
+
+def timeline_record(event):
+    """event type and channel of a pattern_scheduler timeline event"""
+    if event.action == 'daq':
+        start, stop = event.args
+        channel = event.label.split(' ')[-1] if event.label else ''
+        if start:
+            return TRIGGER_START, channel
+        return (TRIGGER_STOP if stop else TRIGGER_OFF), channel
+    if event.action == 'ack':
+        # labels of compile_pattern: '<valve symbol|CO2> <phase>'
+        channel, phase = event.label.split(' ')
+        return {'received': COMMAND_RECEIVED, 'open': VALVE_OPENED,
+                'closed': VALVE_CLOSED}[phase], channel
+    command = event.args[0]
+    if command in ('open_odor_valve', 'open_odor_CO2'):
+        return COMMAND_SENT, event.label[len('channel_'):]
+    if command == 'open_CO2_valve':
+        return COMMAND_SENT, 'CO2'
+    # the flushes around a panel switch are labelled, those of a rest period
+    # are not
+    if command == 'switch_panel' or event.label:
+        return COMMAND_SENT, '#'
+    return COMMAND_SENT, 'Z'
+
+
+class EventLog(object):
+    """timeline of a session written to path in the background"""
+
+    def __init__(self, path, capacity=CAPACITY,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.binary = not path.endswith('.csv')
+        self.flush_interval = flush_interval
+        if self.binary:
+            self.file = open(path, 'wb')
+        else:
+            self.file = open(path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(CSV_FIELDS)
+        self.lock = threading.Lock()
+        self.buffers = [np.zeros(capacity, RECORD),
+                        np.zeros(capacity, RECORD)]
+        self.buffer = self.buffers[0]
+        self.count = 0
+        self.dropped = 0
+        self.closed = threading.Event()
+        self.log(SESSION_STARTED, value=int(time.time() * 1e6))
+        self.thread = threading.Thread(target=self.write_loop,
+                                       name='EventLog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, event_type, channel='', planned_ms=NOT_PLANNED, value=0,
+            time_ns=None):
+        """add a record, at clock_ns() now unless time_ns is given"""
+        if time_ns is None:
+            time_ns = clock_ns()
+        with self.lock:
+            if self.count == len(self.buffer):
+                # never block a timing thread
+                self.dropped += 1
+                return
+            self.buffer[self.count] = (time_ns, event_type, channel,
+                                       planned_ms, value)
+            self.count += 1
+
+    def write_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.write_pending()
+        self.write_pending()
+
+    def write_pending(self):
+        """write the buffered records, only from the writer thread"""
+        with self.lock:
+            records, count = self.buffer, self.count
+            self.buffer = self.buffers[records is self.buffers[0]]
+            self.count = 0
+        if not count:
+            return
+        if self.binary:
+            records[:count].tofile(self.file)
+        else:
+            self.writer.writerows(
+                (r['time_ns'], EVENT_TYPES[r['type']],
+                 r['channel'].decode('ascii'), r['planned_ms'], r['value'])
+                for r in records[:count]
+            )
+        self.file.flush()
+
+    def close(self):
+        """write what is left and close the file"""
+        self.closed.set()
+        self.thread.join()
+        self.file.close()
+        if self.dropped:
+            print('event log: {} events dropped, buffer full'.format(
+                self.dropped))
+
+
+def read_log(path):
+    """records of a log file written by EventLog, as a RECORD array"""
+    if not path.endswith('.csv'):
+        return np.fromfile(path, RECORD)
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    records = np.zeros(len(rows), RECORD)
+    for record, row in zip(records, rows):
+        record['time_ns'] = int(row['time_ns'])
+        record['type'] = EVENT_TYPES.index(row['type'])
+        record['channel'] = row['channel']
+        record['planned_ms'] = float(row['planned_ms'])
+        record['value'] = int(row['value'])
+    return records
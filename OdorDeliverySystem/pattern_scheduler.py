@@ -0,0 +1,244 @@
+# Odor delivery patterns compiled into absolute-deadline timelines
+#
+# go_through_pattern used to chain relative waits with serial round-trips, so
+# the overhead of every step added up and odor onsets drifted later over a
+# block. Here a parsed pattern is turned into a list of events, each due at
+# a fixed time from the start of the block, and a single thread executes them
+# on a monotonic clock, recording when each one actually ran.
+
+from collections import namedtuple
+import threading
+
+from precise_timing import clock, wait_until
+
+# defaults of the rig, in ms, see MarkesSingleOdorants.py
+ACQUISITION_PRE = 7000
+ACQUISITION_POST = 20000
+ACQUISITION_ON = 5
+PREPARE = 1000
+# flush before and after switching panels, in units of 10ms
+SWITCH_FLUSH_DUR = 3000
+# extra wait on top of each switch flush, in ms
+SWITCH_SETTLE = 3000
+
+# an event of the timeline, due *time* ms after the start of the block
+# action: 'send' a command, wait for a valve 'ack' byte, or write the 'daq'
+# trigger lines; args: command and its arguments, or the line levels
+# cleanup: an earlier event, once it ran this one is still executed, right
+# away, when the pattern is stopped, otherwise None
+TimelineEvent = namedtuple('TimelineEvent', 'time action args label cleanup')
+# when an event was due and started and finished, in ms from the start
+EventRecord = namedtuple('EventRecord', 'event planned started finished')
+
+
+def pattern_parser(pattern):
+    """parse the odor pattern string into parameter value lists"""
+    # example: pattern 'A3_Z10_J3_#_Z5_N2;1'
+    # parsed:[6, 'A', 300, 'Z', 1000, 'J', 300, '#', 0, 'Z', 500, 'N', 200]
+    # 1st int is the number of channels including Z and #
+    # for repeated pattern, duplicate items in the list
+    num_channels = 0
+    # repeats number separate by ;
+    pattern_fields = pattern.split(';')
+    if len(pattern_fields) == 1:
+        repeat = 1
+    else:
+        repeat = int(pattern_fields[1])
+    stream = pattern_fields[0]
+    parameters_value_temp = []
+    num_channels = 0
+    fields = stream.split('_')
+    for f in fields:
+        if 'W' in f:
+            info = f.split('W')
+            valve = info[0] + 'W'
+            duration = int(float(info[1]) * 100)  # time unit is 10ms
+        else:
+            valve = f[0]
+            if valve == '#':
+                parameters_value_temp += [valve, 0]
+                num_channels += 1
+                continue
+            duration = int(float(f[1:]) * 100)  # time unit is 10ms
+        parameters_value_temp += [valve, duration]
+        num_channels += 1
+    parameters_value = [repeat, [num_channels] + parameters_value_temp]
+    # cases where only odor or CO2 is specified, add an empty list
+    return parameters_value
+
+
+def calculate_flush(total_dur):
+    """calculate how to divide the total_dur into regular
+    z-flush and extra-flush, remaining time is regular z-
+    flush to establish a flowrate balance"""
+    pre_flush_dur = 300  # unit 10ms
+    extra_flush_dur = total_dur - 3 * pre_flush_dur
+    return pre_flush_dur, extra_flush_dur
+
+
+def compile_pattern(parameters_value, odor_valves,
+                    acquisition_pre=ACQUISITION_PRE,
+                    acquisition_post=ACQUISITION_POST,
+                    acquisition_on=ACQUISITION_ON, prepare=PREPARE):
+    """compile the output of pattern_parser into a timeline
+
+    Each step starts when the previous one is planned to end, with the same
+    timing go_through_pattern had: a Z step before an odor channel starts
+    the DAQ acquisition acquisition_pre ms before the odor reaches the
+    animal and stops it acquisition_post ms after, odor and CO2 steps last
+    as long as the board keeps the valves open. Times are in ms.
+    """
+    num_repeat = parameters_value[0]
+    odor_pattern = parameters_value[1]
+    num_valves = odor_pattern[0]
+    timeline = []
+    t = 0
+
+    def add(at, action, args=(), label='', cleanup=None):
+        event = TimelineEvent(at, action, tuple(args), label, cleanup)
+        timeline.append(event)
+        return event
+
+    def add_trigger(at, lines, label, cleanup=None):
+        # a TTL of acquisition_on ms on one of the (start, stop) lines
+        event = add(at, 'daq', lines, label, cleanup)
+        add(at + acquisition_on, 'daq', (False, False), cleanup=cleanup)
+        return event
+
+    for r in range(num_repeat):
+        for n_v in range(num_valves):
+            idx = 1 + n_v * 2  # the idx of valve in the pattern list
+            valve_symbol = odor_pattern[idx]
+            valve_duration = odor_pattern[idx + 1]   # in unit of 10ms
+            if valve_symbol == 'Z':
+                add(t, 'send', ('extra_flush',) +
+                    calculate_flush(valve_duration))
+                if n_v < num_valves - 1 and \
+                        odor_pattern[idx + 2][0] in list(odor_valves) + ['W']:
+                    # the acquisition covers the next odor channel
+                    next_symbol = odor_pattern[idx + 2]
+                    next_duration = odor_pattern[idx + 3]
+                    trigger = t + max(valve_duration * 10 - acquisition_pre,
+                                      0)
+                    start = add_trigger(trigger, (True, False),
+                                        'triggerStart for ' + next_symbol)
+                    # a started acquisition is stopped even if interrupted
+                    add_trigger(trigger + acquisition_pre +
+                                next_duration * 10 + acquisition_post,
+                                (False, True),
+                                'triggerStop for ' + next_symbol, start)
+                    t = trigger + max(
+                        acquisition_pre - acquisition_on - prepare, 0
+                    )
+                else:
+                    t += max(valve_duration * 10 - prepare, 0)
+            elif valve_symbol == '#':
+                flush = ('extra_flush',) + calculate_flush(SWITCH_FLUSH_DUR)
+                wait = SWITCH_FLUSH_DUR * 10 + SWITCH_SETTLE
+                add(t, 'send', flush, 'flushing manifold before switching')
+                t += wait
+                add(t, 'send', ('switch_panel',), 'switchPanel')
+                add(t, 'send', flush, 'flushing manifold after switching')
+                t += wait
+            elif valve_symbol == 'W' or valve_symbol == 'w':
+                # lower case 'w' means don't start DAQ trigger
+                # the board acknowledges the command, opens at once and
+                # acknowledges again, then closes after the duration
+                add(t, 'send', ('open_CO2_valve', valve_duration), 'CO2')
+                add(t, 'ack', label='CO2 received')
+                add(t, 'ack', label='CO2 open')
+                t += valve_duration * 10
+                add(t, 'ack', label='CO2 closed')
+            else:
+                # the board acknowledges the command, fills the tubing for
+                # prepare ms, then opens the master valve for the duration
+                if len(valve_symbol) == 1:
+                    command = ('open_odor_valve', valve_symbol, valve_duration)
+                else:
+                    command = ('open_odor_CO2', valve_symbol[0],
+                               valve_duration)
+                add(t, 'send', command, 'channel_' + valve_symbol)
+                add(t, 'ack', label=valve_symbol + ' received')
+                add(t + prepare, 'ack', label=valve_symbol + ' open')
+                t += prepare + valve_duration * 10
+                add(t, 'ack', label=valve_symbol + ' closed')
+    # triggers of one step may be due after later steps started
+    timeline.sort(key=lambda event: event.time)
+    return timeline
+
+
+class PatternScheduler(threading.Thread):
+    """execute a timeline in a thread
+
+    actions maps the action of each event to a function taking the event.
+    The pattern stops early once is_cancelled() returns True, after the
+    remaining cleanup events ran. on_finished(scheduler) is called at the
+    end, from the scheduler thread. Event times count from the clock() time
+    origin, when the thread starts by default; it may be moved while the
+    timeline runs, e.g. to follow another clock.
+    """
+
+    def __init__(self, timeline, actions, is_cancelled=lambda: False,
+                 on_finished=None, origin=None):
+        threading.Thread.__init__(self, name='PatternScheduler')
+        self.daemon = True
+        self.timeline = timeline
+        self.actions = actions
+        self.is_cancelled = is_cancelled
+        self.on_finished = on_finished
+        self.records = []
+        self.executed = set()
+        self.cancelled = False
+        self.origin = origin
+
+    def execute(self, event, planned):
+        started = clock()
+        self.actions[event.action](event)
+        finished = clock()
+        self.executed.add(event)
+        self.records.append(EventRecord(
+            event, planned, 1000 * (started - self.origin),
+            1000 * (finished - self.origin)
+        ))
+
+    def run(self):
+        if self.origin is None:
+            self.origin = clock()
+        for i, event in enumerate(self.timeline):
+            due = self.origin + event.time / 1000.
+            if not wait_until(due, self.is_cancelled) or \
+                    self.is_cancelled():
+                self.cancelled = True
+                # e.g. stop the acquisition right away
+                for pending in self.timeline[i:]:
+                    if pending.cleanup in self.executed:
+                        self.execute(pending, pending.time)
+                break
+            self.execute(event, event.time)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def lateness(self):
+        """started minus planned time of each executed event, in ms"""
+        return [record.started - record.planned for record in self.records]
+
+    def report(self):
+        """lines of planned vs actual times, and a summary"""
+        lines = ['planned(ms)\tstarted(ms)\tlate(ms)\tfinished(ms)\tevent']
+        for record in self.records:
+            event = record.event
+            lines.append('{:.1f}\t{:.1f}\t{:.1f}\t{:.1f}\t{} {}'.format(
+                record.planned, record.started,
+                record.started - record.planned, record.finished,
+                event.label or event.action, event.args
+            ))
+        lateness = self.lateness()
+        if lateness:
+            lines.append(
+                'events: {}, late by mean {:.2f} ms, max {:.2f} ms, '
+                'last {:.2f} ms'.format(
+                    len(lateness), sum(lateness) / len(lateness),
+                    max(lateness), lateness[-1]
+                )
+            )
+        return lines
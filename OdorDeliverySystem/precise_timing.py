@@ -0,0 +1,79 @@
+# Low-CPU waits with sub-millisecond precision
+#
+# wait_ms used to spin on datetime.now() for the whole wait, and several
+# threads could do so at the same time, each burning a core and fighting the
+# others for the GIL. wait_until sleeps in coarse slices until shortly before
+# the deadline, then spins for the rest while yielding the GIL. How early it
+# stops sleeping follows how much time.sleep overshoots on this PC, so the
+# spin stays short where timers are precise and waits remain exact where
+# they aren't. A cancel check runs between slices, so Stop still interrupts
+# long waits promptly.
+
+import sys
+import threading
+import time
+
+# monotonic and high resolution on every platform
+clock = time.perf_counter
+
+# longest single sleep, so cancellation is noticed within this many seconds
+CHECK_INTERVAL = .01
+# shortest and initial time left to the deadline when spinning starts
+MIN_SPIN = .0005
+INITIAL_SPIN = .002
+# oversleeps remembered for the spin margin
+OVERSHOOT_WINDOW = 64
+
+_lock = threading.Lock()
+_overshoots = [INITIAL_SPIN]
+
+
+def _enable_fine_timer():
+    """make time.sleep millisecond precise on older Windows Pythons"""
+    # Python 3.11+ uses high resolution timers on Windows anyway
+    if sys.platform != 'win32' or sys.version_info >= (3, 11):
+        return
+    try:
+        import ctypes
+        ctypes.windll.winmm.timeBeginPeriod(1)
+    except (ImportError, AttributeError, OSError):
+        pass
+
+
+_enable_fine_timer()
+
+
+def spin_margin():
+    """time before a deadline when to stop sleeping and spin, in seconds"""
+    with _lock:
+        return max(MIN_SPIN, max(_overshoots))
+
+
+def _record_overshoot(overshoot):
+    with _lock:
+        _overshoots.append(overshoot)
+        if len(_overshoots) > OVERSHOOT_WINDOW:
+            del _overshoots[0]
+
+
+def wait_until(deadline, is_cancelled=lambda: False):
+    """wait until the clock() time deadline, return False if cancelled"""
+    while True:
+        if is_cancelled():
+            return False
+        remaining = deadline - clock() - spin_margin()
+        if remaining <= 0:
+            break
+        interval = min(remaining, CHECK_INTERVAL)
+        asleep = clock()
+        time.sleep(interval)
+        _record_overshoot(clock() - asleep - interval)
+    while clock() < deadline:
+        # give the GIL to other threads while spinning
+        time.sleep(0)
+    return not is_cancelled()
+
+
+def sleep_ms(ms, is_cancelled=lambda: False):
+    """wait ms milliseconds, return False if cancelled"""
+    return wait_until(clock() + ms / 1000., is_cancelled)
@@ -0,0 +1,888 @@
+# Software stand-ins for the boards of the odor delivery rig
+#
+# A SimulatedBoard can be handed to PyCmdMessenger.CmdMessenger in place of
+# an ArduinoBoard: bytes written by the host are parsed as CmdMessenger
+# commands by an emulated firmware thread, and what the firmware prints is
+# read back with the same timeout behaviour as a serial port. Both ways
+# are delayed by a configurable USB latency, and the board clock can run
+# slightly fast or slow. SimulatedValveBoard follows odor_delivery_valve.ino,
+# acknowledgement bytes and valve delays included, and SimulatedMFCBoard
+# odor_delivery_MFC.ino; both log every pin change. SimulatedDAQ stands in
+# for the NI USB-6000 and its nidaqmx tasks, and SimulatedMarkes fires the
+# trap on a DAQ input line some time after the MFC board triggered it.
+# SimulatedRig wires them up like the rig, so the scheduling and timing code
+# can be profiled and tested on any PC, e.g. with
+# python MarkesSingleOdorants.py --simulate
+# or headless, running one block through the simulated rig:
+# python rig_simulator.py 'Z10_A3_Z10_B3;2' --batch
+
+import argparse
+from collections import deque
+import random
+import struct
+import threading
+
+import numpy as np
+
+from pattern_scheduler import ACQUISITION_ON, PatternScheduler, \
+    compile_pattern, pattern_parser
+from precise_timing import clock, sleep_ms, wait_until
+from serial_demux import BoardReader
+from ttl_waveform import LEAD, TriggerTrain, open_output, split_triggers
+import valve_board
+
+FIELD_SEPARATOR = b','
+COMMAND_SEPARATOR = b';'
+ESCAPE_SEPARATOR = b'/'
+# USB latency in seconds, each way
+LATENCY = .001
+# longest wait of the firmware loop for new input, in seconds
+IDLE_POLL = .05
+# time a software-timed write or read of the USB-6000 takes, in seconds
+DAQ_WRITE_LATENCY = .001
+DAQ_READ_LATENCY = .0005
+# seconds from triggering the Markes to the trap firing, and how long the
+# fire signal stays on
+FIRE_LATENCY = 23.
+FIRE_DURATION = 2.
+# DAQ line of the Markes fire signal, see MarkesSingleOdorants.py
+MARKES_LINE = 'USB6000/port0/line2'
+# odor channels of the two panels
+ODOR_VALVES = 'ABCDEFGHIJLMNOPQRSTU'
+
+# sizes of the binary arguments of an ATmega board, see PyCmdMessenger
+ARG_FORMATS = {'b': '<B', 'i': '<h', 'I': '<H', 'l': '<i', 'L': '<I',
+               'f': '<f', 'd': '<f', '?': '<?'}
+
+
+def escape(field):
+    """escape the separators in a binary field like CmdMessenger does"""
+    out = bytearray()
+    for byte in field:
+        if bytes([byte]) in (FIELD_SEPARATOR, COMMAND_SEPARATOR,
+                             ESCAPE_SEPARATOR, b'\0'):
+            out += ESCAPE_SEPARATOR
+        out.append(byte)
+    return bytes(out)
+
+
+def encode_args(formats, args):
+    """binary fields of args, c and s as text"""
+    fields = []
+    for f, arg in zip(formats, args):
+        if f in 'cs':
+            fields.append(arg.encode('ascii'))
+        else:
+            fields.append(struct.pack(ARG_FORMATS[f], arg))
+    return fields
+
+
+def decode_args(formats, fields):
+    args = []
+    for f, field in zip(formats, fields):
+        if f == 'c':
+            args.append(field[:1].decode('ascii'))
+        elif f == 's':
+            args.append(field.decode('ascii'))
+        else:
+            size = struct.calcsize(ARG_FORMATS[f])
+            # the firmware reads missing bytes as zero
+            field = field[:size].ljust(size, b'\0')
+            args.append(struct.unpack(ARG_FORMATS[f], field)[0])
+    return args
+
+
+class SimulatedBoard(object):
+    """ArduinoBoard interface to a firmware emulated in a thread
+
+    Subclasses set commands, like the list given to CmdMessenger, and
+    define on_<command>(*args) handlers, which run in the firmware thread
+    and may block like the sketch does. poll() is called between commands
+    and returns the seconds until it wants to run again, or None.
+    """
+
+    commands = []
+
+    # board parameters of PyCmdMessenger for an ATmega board
+    int_bytes = 2
+    long_bytes = 4
+    float_bytes = 4
+    double_bytes = 4
+    int_min, int_max = -2 ** 15, 2 ** 15 - 1
+    unsigned_int_min, unsigned_int_max = 0, 2 ** 16 - 1
+    long_min, long_max = -2 ** 31, 2 ** 31 - 1
+    unsigned_long_min, unsigned_long_max = 0, 2 ** 32 - 1
+    float_min, float_max = -3.4028235E+38, 3.4028235E+38
+    double_min, double_max = float_min, float_max
+    int_type, unsigned_int_type = '<h', '<H'
+    long_type, unsigned_long_type = '<i', '<I'
+    float_type = double_type = '<f'
+
+    def __init__(self, device='simulated', baud_rate=115200, timeout=1.0,
+                 latency=LATENCY, drift_ppm=0.):
+        self.device = device
+        self.baud_rate = baud_rate
+        self.timeout = timeout
+        self.latency = latency
+        self.rate = 1. + drift_ppm * 1e-6
+        # pyserial handle of an ArduinoBoard, e.g. for reset_input_buffer
+        self.comm = self
+
+        self.condition = threading.Condition()
+        # (time available, byte) both ways
+        self.to_board = deque()
+        self.to_host = deque()
+        self.pending = bytearray()
+        self.pins = {}
+        self.pin_log = []
+        self.booted = clock()
+        self._is_connected = True
+        self.firmware = threading.Thread(target=self.firmware_loop,
+                                         name=device)
+        self.firmware.daemon = True
+        self.firmware.start()
+
+    # host side, like ArduinoBoard
+    @property
+    def connected(self):
+        return self._is_connected
+
+    def open(self):
+        pass
+
+    def close(self):
+        with self.condition:
+            self._is_connected = False
+            self.condition.notify_all()
+        self.firmware.join()
+
+    def write(self, msg):
+        arrival = clock() + self.latency
+        with self.condition:
+            self.to_board.extend((arrival, byte) for byte in bytes(msg))
+            self.condition.notify_all()
+
+    def read(self):
+        """one byte, or b'' after the timeout"""
+        deadline = clock() + self.timeout
+        with self.condition:
+            while True:
+                now = clock()
+                if self.to_host and self.to_host[0][0] <= now:
+                    return bytes([self.to_host.popleft()[1]])
+                if now >= deadline or not self._is_connected:
+                    return b''
+                wake = deadline
+                if self.to_host:
+                    wake = min(wake, self.to_host[0][0])
+                self.condition.wait(wake - now)
+
+    def readline(self):
+        line = bytearray()
+        while not line.endswith(b'\n'):
+            byte = self.read()
+            if not byte:
+                break
+            line += byte
+        return bytes(line)
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.to_host.clear()
+
+    # firmware side
+    def millis(self):
+        return int(1000 * (clock() - self.booted) * self.rate)
+
+    def delay(self, ms):
+        """wait ms on the board clock, False if the board was closed"""
+        return wait_until(clock() + max(ms, 0) / 1000. / self.rate,
+                          lambda: not self._is_connected)
+
+    def print(self, data):
+        """Serial.print of the sketch"""
+        if isinstance(data, int):
+            data = str(data)
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        arrival = clock() + self.latency
+        with self.condition:
+            self.to_host.extend((arrival, byte) for byte in data)
+            self.condition.notify_all()
+
+    def send_command(self, name, *args):
+        """sendCmdStart, sendCmdBinArg and sendCmdEnd of the sketch"""
+        index = [c[0] for c in self.commands].index(name)
+        formats = dict(self.commands)[name]
+        fields = [str(index).encode('ascii')] + [
+            escape(field) for field in encode_args(formats, args)
+        ]
+        self.print(FIELD_SEPARATOR.join(fields) + COMMAND_SEPARATOR)
+
+    def digital_write(self, pin, level):
+        self.pins[pin] = level
+        self.pin_log.append((clock(), pin, level))
+
+    def next_message(self, timeout):
+        """the next complete command as (name, raw fields), else None"""
+        deadline = clock() + timeout
+        with self.condition:
+            while self._is_connected:
+                now = clock()
+                while self.to_board and self.to_board[0][0] <= now:
+                    self.pending.append(self.to_board.popleft()[1])
+                message = self.split_message()
+                if message is not None:
+                    return message
+                if now >= deadline:
+                    return None
+                wake = deadline
+                if self.to_board:
+                    wake = min(wake, self.to_board[0][0])
+                self.condition.wait(wake - now)
+        return None
+
+    def split_message(self):
+        fields = [bytearray()]
+        escaped = False
+        for i, byte in enumerate(self.pending):
+            byte = bytes([byte])
+            if escaped:
+                fields[-1] += byte
+                escaped = False
+            elif byte == ESCAPE_SEPARATOR:
+                escaped = True
+            elif byte == FIELD_SEPARATOR:
+                fields.append(bytearray())
+            elif byte == COMMAND_SEPARATOR:
+                del self.pending[:i + 1]
+                try:
+                    name = self.commands[int(fields[0].strip())][0]
+                except (ValueError, IndexError):
+                    # unknown commands are ignored by the sketch
+                    return 'unknown', []
+                return name, [bytes(field) for field in fields[1:]]
+            else:
+                fields[-1] += byte
+        return None
+
+    def firmware_loop(self):
+        wait = IDLE_POLL
+        while self._is_connected:
+            message = self.next_message(min(wait, IDLE_POLL)
+                                        if wait is not None else IDLE_POLL)
+            if message is not None:
+                name, fields = message
+                handler = getattr(self, 'on_' + name, None)
+                if handler is not None:
+                    formats = dict(self.commands)[name]
+                    handler(*decode_args(formats, fields))
+            wait = self.poll()
+
+    def poll(self):
+        return None
+
+
+class SimulatedValveBoard(SimulatedBoard):
+    """odor_delivery_valve.ino on a Mega2560"""
+
+    commands = valve_board.VALVE_COMMANDS
+
+    # pins, see the sketch
+    prepare = 100  # in units of 10ms
+    masterOdorValve = 4
+    masterCtrlValve = 3
+    masterCO2Valve = 2
+    masterCtrl2Valve = 5
+    sourceValves = [65, 64]
+    flushInPins = [7, 40]
+    flushOutPins = [38, 63]
+    allInPins = [9, 12, 23, 25, 27, 29, 31, 33, 35, 37, 39, 42, 44, 46, 48,
+                 67, 52, 66, 56, 58, 60, 62]
+    allOutPins = [6, 8, 11, 22, 24, 26, 28, 30, 32, 34, 36, 41, 43, 45, 47,
+                  49, 68, 53, 55, 69, 59, 61]
+    vacuumOutPins = [36, 62]
+
+    def __init__(self, *args, **kwargs):
+        self.panel = 0
+        self.steps = []
+        self.running = False
+        self.step_idx = 0
+        self.phase = 0
+        self.run_start = 0
+        self.phase_due = 0
+        SimulatedBoard.__init__(self, *args, **kwargs)
+        self.digital_write(self.masterCtrlValve, 0)
+        self.digital_write(self.masterOdorValve, 0)
+        self.digital_write(self.masterCO2Valve, 0)
+        self.digital_write(self.flush_in, 1)
+        self.digital_write(self.flush_out, 1)
+        self.digital_write(self.sourceValves[0], 1)
+        self.digital_write(self.sourceValves[1], 0)
+
+    @property
+    def flush_in(self):
+        return self.flushInPins[self.panel]
+
+    @property
+    def flush_out(self):
+        return self.flushOutPins[self.panel]
+
+    @property
+    def vacuum_out(self):
+        return self.vacuumOutPins[self.panel]
+
+    def master_odor_open_times(self):
+        """host times at which the odor reached the animal"""
+        return [t for t, pin, level in self.pin_log
+                if pin == self.masterOdorValve and level]
+
+    # odor channels
+    def channel_on(self, valve):
+        idx = ord(valve) - 65  # A is ascii 65
+        self.digital_write(self.allInPins[idx], 1)
+        self.digital_write(self.allOutPins[idx], 1)
+        self.digital_write(self.flush_in, 0)
+        self.digital_write(self.flush_out, 0)
+
+    def channel_off(self, valve):
+        idx = ord(valve) - 65
+        self.digital_write(self.allInPins[idx], 0)
+        self.digital_write(self.allOutPins[idx], 0)
+        self.digital_write(self.flush_in, 1)
+        self.digital_write(self.flush_out, 1)
+
+    def masters(self, level, odor=True, co2=False):
+        if odor:
+            self.digital_write(self.masterOdorValve, level)
+            self.digital_write(self.masterCtrlValve, level)
+        if co2:
+            self.digital_write(self.masterCO2Valve, level)
+            self.digital_write(self.masterCtrl2Valve, level)
+
+    # commands sent one by one, blocking like the sketch
+    def on_open_odor_valve(self, valve, duration, co2=False):
+        self.print(1)
+        self.channel_on(valve)
+        self.delay(self.prepare * 10)
+        self.masters(1, co2=co2)
+        self.print(1)
+        self.delay(duration * 10)
+        self.masters(0, co2=co2)
+        self.print(1)
+        self.channel_off(valve)
+
+    def on_open_odor_CO2(self, valve, duration):
+        self.on_open_odor_valve(valve, duration, co2=True)
+
+    def on_open_CO2_valve(self, duration):
+        self.print(1)
+        self.masters(1, odor=False, co2=True)
+        self.print(1)
+        self.delay(duration * 10)
+        self.masters(0, odor=False, co2=True)
+        self.print(1)
+
+    def on_switch_panel(self):
+        self.digital_write(self.flush_in, 0)
+        self.digital_write(self.flush_out, 0)
+        self.digital_write(self.sourceValves[self.panel], 0)
+        self.panel = 1 - self.panel
+        self.digital_write(self.sourceValves[self.panel], 1)
+        self.digital_write(self.flush_in, 1)
+        self.digital_write(self.flush_out, 1)
+
+    def on_extra_flush(self, pre_flush_dur, extra_flush_dur):
+        self.delay(pre_flush_dur * 10)
+        self.digital_write(self.vacuum_out, 1)
+        self.delay(extra_flush_dur * 10)
+        self.digital_write(self.vacuum_out, 0)
+
+    def on_purge_system(self, num_purges):
+        for n in range(num_purges):
+            for p in range(2):
+                self.digital_write(self.flush_in, 1)
+                self.digital_write(self.flush_out, 1)
+                self.digital_write(self.vacuum_out, 1)
+                self.delay(60000)
+                for c in range(10):
+                    idx = 11 * self.panel + c
+                    self.digital_write(self.allInPins[idx], 1)
+                    self.digital_write(self.allOutPins[idx], 1)
+                    self.delay(180000)
+                    self.digital_write(self.allInPins[idx], 0)
+                    self.digital_write(self.allOutPins[idx], 0)
+                self.digital_write(self.vacuum_out, 0)
+                self.on_switch_panel()
+
+    def on_solvent_wash(self):
+        self.delay(20000)
+        self.digital_write(self.flush_in, 0)
+        for c in range(10):
+            pin = self.allInPins[11 * self.panel + c]
+            self.digital_write(pin, 1)
+            self.delay(10000)
+            self.digital_write(pin, 0)
+        self.digital_write(self.flush_in, 1)
+        self.delay(10000)
+        for c in range(10):
+            pin = self.allOutPins[11 * self.panel + c]
+            self.digital_write(pin, 1)
+            self.delay(20000)
+            self.digital_write(pin, 0)
+        self.digital_write(self.masterOdorValve, 1)
+        self.delay(10000)
+        self.digital_write(self.masterOdorValve, 0)
+
+    # batch mode
+    def send_event(self, idx, code):
+        self.send_command('step_event', idx, code,
+                          self.millis() - self.run_start)
+
+    def on_clear_steps(self):
+        if not self.running:
+            del self.steps[:]
+
+    def on_add_step(self, start, action, valve, dur1, dur2):
+        if not self.running and len(self.steps) < valve_board.MAX_STEPS:
+            self.steps.append(valve_board.Step(start, action, valve, dur1,
+                                               dur2))
+
+    def on_run_steps(self):
+        if self.running:
+            return
+        self.run_start = self.millis()
+        self.step_idx = 0
+        self.phase = 0
+        self.send_event(len(self.steps), valve_board.SEQUENCE_STARTED)
+        if not self.steps:
+            self.send_event(0, valve_board.SEQUENCE_DONE)
+            return
+        self.running = True
+        self.phase_due = self.run_start + self.steps[0].start
+
+    def on_abort_steps(self):
+        if not self.running:
+            return
+        self.running = False
+        self.masters(0, co2=True)
+        self.digital_write(self.vacuum_out, 0)
+        step = self.steps[self.step_idx]
+        if step.action in (valve_board.STEP_ODOR, valve_board.STEP_ODOR_CO2):
+            self.channel_off(step.valve)
+        self.send_event(self.step_idx, valve_board.SEQUENCE_ABORTED)
+
+    def step_phase(self, step, idx, phase):
+        """one phase of a step, ms to the next one or -1 when done"""
+        if step.action == valve_board.STEP_EXTRA_FLUSH:
+            if phase == 0:
+                return max(step.dur1, 0) * 10
+            if phase == 1:
+                self.digital_write(self.vacuum_out, 1)
+                return max(step.dur2, 0) * 10
+            self.digital_write(self.vacuum_out, 0)
+            return -1
+        if step.action == valve_board.STEP_SWITCH_PANEL:
+            self.on_switch_panel()
+            return -1
+        if step.action == valve_board.STEP_CO2:
+            if phase == 0:
+                self.masters(1, odor=False, co2=True)
+                self.send_event(idx, valve_board.VALVE_OPENED)
+                return step.dur1 * 10
+            self.masters(0, odor=False, co2=True)
+            self.send_event(idx, valve_board.VALVE_CLOSED)
+            return -1
+        co2 = step.action == valve_board.STEP_ODOR_CO2
+        if phase == 0:
+            self.channel_on(step.valve)
+            return self.prepare * 10
+        if phase == 1:
+            self.masters(1, co2=co2)
+            self.send_event(idx, valve_board.VALVE_OPENED)
+            return step.dur1 * 10
+        self.masters(0, co2=co2)
+        self.send_event(idx, valve_board.VALVE_CLOSED)
+        self.channel_off(step.valve)
+        return -1
+
+    def poll(self):
+        if not self.running:
+            return None
+        now = self.millis()
+        if now < self.phase_due:
+            return (self.phase_due - now) / 1000. / self.rate
+        if self.phase == 0:
+            # phases are timed from the actual start of the step
+            self.phase_due = now
+            self.send_event(self.step_idx, valve_board.STEP_STARTED)
+        step = self.steps[self.step_idx]
+        next_phase = self.step_phase(step, self.step_idx, self.phase)
+        if next_phase >= 0:
+            self.phase += 1
+            self.phase_due += next_phase
+            return 0.
+        self.step_idx += 1
+        self.phase = 0
+        if self.step_idx >= len(self.steps):
+            self.running = False
+            self.send_event(len(self.steps), valve_board.SEQUENCE_DONE)
+            return None
+        self.phase_due = self.run_start + self.steps[self.step_idx].start
+        return 0.
+
+
+class SimulatedMFCBoard(SimulatedBoard):
+    """odor_delivery_MFC.ino on an Uno, triggering markes"""
+
+    # as commands_MFC of MarkesSingleOdorants.py
+    commands = [['flow_setup', 'iiiii'],
+                ['trigger_markes', 'i']]
+
+    markes_pin = 4
+
+    def __init__(self, *args, **kwargs):
+        self.markes = kwargs.pop('markes', None)
+        # PWM values of carrier, ctrl, odor, CO2 and ctrl2 MFCs
+        self.flows = [109, 108, 219, 35, 35]
+        SimulatedBoard.__init__(self, *args, **kwargs)
+        # for markes trigger, the logic is reversed
+        self.digital_write(self.markes_pin, 1)
+
+    def digital_write(self, pin, level):
+        triggered = pin == self.markes_pin and not level and \
+            self.pins.get(pin, 1)
+        SimulatedBoard.digital_write(self, pin, level)
+        if triggered and self.markes is not None:
+            self.markes.trigger()
+
+    def on_flow_setup(self, carrier, ctrl, odor, co2, ctrl2):
+        self.flows = [carrier, ctrl, odor, co2, ctrl2]
+
+    def on_trigger_markes(self, trigger_duration):
+        self.digital_write(self.markes_pin, 0)
+        self.print(1)
+        self.delay(trigger_duration * 1000)
+        self.digital_write(self.markes_pin, 1)
+
+
+class SimulatedDAQ(object):
+    """the digital lines of the NI USB-6000, shared by its tasks
+
+    Each line is named like in nidaqmx, e.g. 'USB6000/pfi0', and every
+    change is logged with its time. Unlike the USB-6000 the lines can be
+    sample clocked, unless sample_clock is False.
+    """
+
+    def __init__(self, write_latency=DAQ_WRITE_LATENCY,
+                 read_latency=DAQ_READ_LATENCY, sample_clock=True):
+        self.write_latency = write_latency
+        self.read_latency = read_latency
+        self.sample_clock = sample_clock
+        self.lock = threading.Lock()
+        self.lines = {}
+        self.log = []
+
+    def Task(self):
+        """a new task, like nidaqmx.Task()"""
+        return SimulatedTask(self)
+
+    def set_line(self, line, level):
+        with self.lock:
+            if self.lines.get(line, False) != level:
+                self.log.append((clock(), line, level))
+            self.lines[line] = level
+
+    def get_line(self, line):
+        with self.lock:
+            return self.lines.get(line, False)
+
+    def levels(self, line, times):
+        """levels of line at each of times"""
+        with self.lock:
+            changes = [(t, level) for t, name, level in self.log
+                       if name == line]
+        if not changes:
+            return np.zeros(len(times), dtype=bool)
+        change_times, change_levels = zip(*changes)
+        index = np.searchsorted(change_times, times, side='right') - 1
+        return np.where(index >= 0,
+                        np.array(change_levels)[np.maximum(index, 0)], False)
+
+    def rising_edges(self, line):
+        """times at which line went high"""
+        with self.lock:
+            return [t for t, name, level in self.log
+                    if name == line and level]
+
+
+class SimulatedChannels(object):
+    """do_channels and di_channels of a task"""
+
+    def __init__(self, task):
+        self.task = task
+
+    def add_do_chan(self, lines):
+        self.task.channels.append(lines)
+
+    add_di_chan = add_do_chan
+
+
+class SimulatedTiming(object):
+    """timing of a task"""
+
+    def __init__(self, task):
+        self.task = task
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None,
+                            sample_mode=None, samps_per_chan=1000):
+        self.task.rate = rate
+
+
+class SimulatedTask(object):
+    """the part of nidaqmx.Task used by the GUI, software timed unless
+    timing.cfg_samp_clk_timing was called"""
+
+    def __init__(self, daq):
+        self.daq = daq
+        self.channels = []
+        self.do_channels = SimulatedChannels(self)
+        self.di_channels = SimulatedChannels(self)
+        self.timing = SimulatedTiming(self)
+        self.rate = None
+        self.started = None
+        # samples of a clocked output, and the thread playing them
+        self.buffer = None
+        self.player = None
+
+    def start(self):
+        if self.rate is not None and not self.daq.sample_clock:
+            raise RuntimeError('the lines of the DAQ are software timed')
+        self.started = started = clock()
+        self.samples = 0
+        if self.buffer is not None:
+            self.player = threading.Thread(target=self.play,
+                                           args=(started,))
+            self.player.daemon = True
+            self.player.start()
+
+    def play(self, started):
+        """set the lines at the changes of the buffer, on the sample clock"""
+        before = np.concatenate((np.zeros((len(self.buffer), 1), dtype=bool),
+                                 self.buffer[:, :-1]), axis=1)
+        changes = np.flatnonzero(np.any(self.buffer != before, axis=0))
+        for index in changes:
+            if not wait_until(started + index / self.rate,
+                              lambda: self.started != started):
+                return
+            for line, level in zip(self.channels, self.buffer[:, index]):
+                self.daq.set_line(line, bool(level))
+
+    def wait_until_done(self, timeout=10.):
+        if self.player is not None:
+            self.player.join(timeout)
+
+    def stop(self):
+        self.started = None
+        self.wait_until_done()
+
+    def write(self, data, auto_start=True):
+        if self.rate is not None:
+            # clocked, one list of samples per channel
+            self.buffer = np.asarray(data, dtype=bool).reshape(
+                len(self.channels), -1)
+            if auto_start:
+                self.start()
+            return
+        sleep_ms(1000 * self.daq.write_latency)
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        for line, level in zip(self.channels, data):
+            self.daq.set_line(line, bool(level))
+
+    def read(self, number_of_samples_per_channel=1, timeout=10.):
+        if self.rate is None:
+            sleep_ms(1000 * self.daq.read_latency)
+            values = [self.daq.get_line(line) for line in self.channels]
+            return values[0] if len(values) == 1 else values
+        # clocked, of the first channel
+        if self.started is None:
+            self.start()
+        count = number_of_samples_per_channel
+        wait_until(self.started + (self.samples + count) / self.rate)
+        times = self.started + (self.samples + np.arange(count)) / self.rate
+        self.samples += count
+        return self.daq.levels(self.channels[0], times).tolist()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SimulatedMarkes(object):
+    """the Markes thermal desorber, firing its trap fire_latency seconds
+    after being triggered
+
+    The fire signal is held on the DAQ line for fire_duration seconds.
+    glitches short spikes on the line before the fire test debouncing.
+    """
+
+    def __init__(self, daq, line=MARKES_LINE, fire_latency=FIRE_LATENCY,
+                 fire_duration=FIRE_DURATION, glitches=0):
+        self.daq = daq
+        self.line = line
+        self.fire_latency = fire_latency
+        self.fire_duration = fire_duration
+        self.glitches = glitches
+        self.trigger_times = []
+        self.fire_times = []
+
+    def trigger(self):
+        triggered = clock()
+        self.trigger_times.append(triggered)
+        thread = threading.Thread(target=self.fire, args=(triggered,),
+                                  name='SimulatedMarkes')
+        thread.daemon = True
+        thread.start()
+
+    def fire(self, triggered):
+        spikes = sorted(random.uniform(0, self.fire_latency)
+                        for _ in range(self.glitches))
+        for spike in spikes:
+            wait_until(triggered + spike)
+            self.daq.set_line(self.line, True)
+            sleep_ms(.2)
+            self.daq.set_line(self.line, False)
+        wait_until(triggered + self.fire_latency)
+        self.fire_times.append(clock())
+        self.daq.set_line(self.line, True)
+        sleep_ms(1000 * self.fire_duration)
+        self.daq.set_line(self.line, False)
+
+
+class SimulatedRig(object):
+    """valve and MFC boards, DAQ and Markes wired up like the rig"""
+
+    def __init__(self, latency=LATENCY, drift_ppm=0.,
+                 fire_latency=FIRE_LATENCY, markes_line=MARKES_LINE,
+                 glitches=0):
+        self.daq = SimulatedDAQ()
+        self.markes = SimulatedMarkes(self.daq, markes_line, fire_latency,
+                                      glitches=glitches)
+        self.valve_board = SimulatedValveBoard(
+            'simulated valve board', latency=latency, drift_ppm=drift_ppm
+        )
+        self.mfc_board = SimulatedMFCBoard(
+            'simulated MFC board', latency=latency, drift_ppm=drift_ppm,
+            markes=self.markes
+        )
+
+    def close(self):
+        self.valve_board.close()
+        self.mfc_board.close()
+
+
+def run_block(rig, pattern, batch=False, start_line='USB6000/pfi0',
+              **timing):
+    """run one odor block through the simulated rig like the GUI does,
+    return the scheduler or BoardSequence, the BoardReader, the
+    TriggerTrain, planned and actual odor onsets and acquisition starts in
+    ms"""
+    import PyCmdMessenger
+
+    cmd = PyCmdMessenger.CmdMessenger(rig.valve_board,
+                                      valve_board.VALVE_COMMANDS)
+    reader = BoardReader(rig.valve_board, valve_board.VALVE_COMMANDS)
+    reader.start()
+    output = open_output(rig.daq.Task, [start_line, start_line[:-1] + '1'])
+    timeline = compile_pattern(pattern_parser(pattern), ODOR_VALVES,
+                               **timing)
+    acquisitions, timeline = split_triggers(timeline)
+    train = TriggerTrain(output, acquisitions,
+                         timing.get('acquisition_on', ACQUISITION_ON))
+
+    sent = []
+
+    def send_command(event):
+        sent.append(clock())
+        cmd.send(*event.args)
+
+    def read_ack(event):
+        # only the first acknowledgement follows the command right away
+        received = event.label.endswith(' received')
+        reader.wait_ack(sent=sent[-1] if received else None)
+
+    def start_train(sequence, event):
+        if event.code == valve_board.SEQUENCE_STARTED:
+            train.origin = sequence.scheduler.origin
+            train.start()
+
+    if batch:
+        steps, host_timeline = valve_board.compile_steps(timeline)
+        runner = valve_board.BoardSequence(cmd, reader, steps,
+                                           host_timeline, {},
+                                           on_event=start_train)
+    else:
+        runner = PatternScheduler(timeline, {'send': send_command,
+                                             'ack': read_ack},
+                                  origin=clock() + LEAD)
+        train.origin = runner.origin
+        train.start()
+    runner.start()
+    runner.join()
+    if train.ident is not None:
+        train.join()
+    reader.close()
+    output.close()
+    origin = runner.scheduler.origin if batch else runner.origin
+
+    def since_origin(times):
+        return [1000 * (t - origin) for t in times]
+
+    planned_onsets = [event.time for event in timeline
+                      if event.action == 'ack' and
+                      event.label.endswith(' open') and
+                      not event.label.startswith('CO2')]
+    planned_triggers = [acquisition.start for acquisition in acquisitions]
+    return (runner, reader, train, planned_onsets,
+            since_origin(rig.valve_board.master_odor_open_times()),
+            planned_triggers, since_origin(rig.daq.rising_edges(start_line)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='run an odor block through the simulated rig')
+    parser.add_argument('pattern', help="odor pattern, e.g. 'Z10_A3;2'")
+    parser.add_argument('--batch', action='store_true',
+                        help='run the valve steps on the board clock')
+    parser.add_argument('--latency', type=float, default=LATENCY,
+                        help='USB latency each way in s')
+    parser.add_argument('--drift', type=float, default=0.,
+                        help='board clock error in ppm')
+    parser.add_argument('--software-timed', action='store_true',
+                        help='no sample clock on the DAQ, like the USB-6000')
+    args = parser.parse_args()
+
+    rig = SimulatedRig(latency=args.latency, drift_ppm=args.drift)
+    rig.daq.sample_clock = not args.software_timed
+    (runner, reader, train, planned, onsets, planned_triggers,
+     triggers) = run_block(rig, args.pattern, args.batch)
+    rig.close()
+    print('\n'.join(runner.report()))
+    print(reader.latency_summary())
+    print('\n'.join(train.report()))
+    print('odor onsets, planned vs actual (ms):')
+    for p, a in zip(planned, onsets):
+        print('{}\t{:.1f}\t{:+.1f}'.format(p, a, a - p))
+    print('acquisition starts, planned vs actual (ms):')
+    for p, a in zip(planned_triggers, triggers):
+        print('{}\t{:.1f}\t{:+.1f}'.format(p, a, a - p))
+
+
+if __name__ == '__main__':
+    main()
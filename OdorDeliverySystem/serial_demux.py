@@ -0,0 +1,182 @@
+# One reader thread per board, routing its input to queues
+#
+# serial_timestamp used to spin on arduino.read() byte by byte until the
+# acknowledgement came, Stop could not interrupt it, and the time was taken
+# whenever Python got around to the byte. A BoardReader owns the serial
+# input of a board instead: its thread blocks in the serial driver, stamps
+# each byte with the time it arrived and routes it. Acknowledgement bytes of
+# the legacy commands go to one queue, CmdMessenger messages of batch mode
+# (valve_board.py) to a queue per command. Waiting threads sleep on these
+# queues with a timeout and a cancel check, and the latency from sending a
+# command to its acknowledgement is recorded.
+
+from collections import deque
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from precise_timing import CHECK_INTERVAL, clock
+
+# what the sketches print to acknowledge a command, or a valve change
+ACK = b'1'
+FIELD_SEPARATOR = b','
+COMMAND_SEPARATOR = b';'
+ESCAPE_SEPARATOR = b'/'
+ESCAPED = (FIELD_SEPARATOR, COMMAND_SEPARATOR, ESCAPE_SEPARATOR, b'\0')
+# seconds to wait for an acknowledgement
+ACK_TIMEOUT = 5.
+# latest acknowledgement latencies kept for the summary
+LATENCY_WINDOW = 256
+
+
+def decode_field(board, arg_format, field):
+    """value of a binary CmdMessenger field sent by board"""
+    if arg_format == 'c':
+        return field[:1].decode('ascii')
+    if arg_format == 's':
+        return field.decode('ascii')
+    struct_format = {'b': '<B', '?': '<?',
+                     'i': board.int_type, 'I': board.unsigned_int_type,
+                     'l': board.long_type, 'L': board.unsigned_long_type,
+                     'f': board.float_type, 'd': board.double_type
+                     }[arg_format]
+    return struct.unpack(struct_format, field)[0]
+
+
+class BoardReader(threading.Thread):
+    """reads everything board sends, commands as given to CmdMessenger
+
+    In message mode the input is parsed as CmdMessenger messages, otherwise
+    each ACK byte is an acknowledgement and anything else is ignored. Nothing
+    else may read from the board while the reader runs.
+    """
+
+    def __init__(self, board, commands):
+        threading.Thread.__init__(
+            self, name='BoardReader ' + str(getattr(board, 'device', ''))
+        )
+        self.daemon = True
+        self.board = board
+        self.names = [command[0] for command in commands]
+        self.formats = dict((command[0], command[1])
+                            for command in commands)
+        self.acks = queue.Queue()
+        self.messages = dict((name, queue.Queue()) for name in self.names)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+        self.message_mode = False
+        self.stopped = False
+        self.reset_message()
+
+    def run(self):
+        while not self.stopped:
+            # blocks in the driver until a byte comes or the board timeout
+            byte = self.board.read()
+            arrival = clock()
+            if byte:
+                self.route(byte, arrival)
+
+    def close(self):
+        self.stopped = True
+        self.join()
+
+    def set_message_mode(self, message_mode):
+        """parse messages or acknowledgements from now on, dropping what
+        came before"""
+        with self.lock:
+            self.message_mode = message_mode
+            self.reset_message()
+            for q in [self.acks] + list(self.messages.values()):
+                while not q.empty():
+                    q.get_nowait()
+
+    # reader thread
+    def reset_message(self):
+        self.fields = [bytearray()]
+        self.escaped = False
+        self.message_start = None
+
+    def route(self, byte, arrival):
+        with self.lock:
+            if not self.message_mode:
+                if byte == ACK:
+                    self.acks.put(arrival)
+                return
+            # the same parsing as CmdMessenger.receive
+            if self.message_start is None:
+                self.message_start = arrival
+            if self.escaped:
+                if byte not in ESCAPED:
+                    self.fields[-1] += ESCAPE_SEPARATOR
+                self.fields[-1] += byte
+                self.escaped = False
+            elif byte == ESCAPE_SEPARATOR:
+                self.escaped = True
+            elif byte == FIELD_SEPARATOR:
+                self.fields.append(bytearray())
+            elif byte == COMMAND_SEPARATOR:
+                self.dispatch()
+                self.reset_message()
+            else:
+                self.fields[-1] += byte
+
+    def dispatch(self):
+        """queue a complete message, with the arrival of its first byte"""
+        fields = [bytes(field) for field in self.fields]
+        try:
+            name = self.names[int(fields[0].strip())]
+            formats = self.formats[name]
+            if len(formats) != len(fields) - 1:
+                return
+            args = [decode_field(self.board, f, field)
+                    for f, field in zip(formats, fields[1:])]
+        except (ValueError, IndexError, struct.error):
+            # garbled, e.g. by a stray acknowledgement
+            return
+        self.messages[name].put((args, self.message_start))
+
+    # waiting threads
+    def wait(self, q, timeout, is_cancelled):
+        deadline = clock() + timeout
+        while not is_cancelled():
+            remaining = deadline - clock()
+            if remaining <= 0:
+                return None
+            try:
+                return q.get(timeout=min(remaining, CHECK_INTERVAL))
+            except queue.Empty:
+                pass
+        return None
+
+    def wait_ack(self, timeout=ACK_TIMEOUT, is_cancelled=lambda: False,
+                 sent=None):
+        """clock() time the next acknowledgement arrived, None on timeout or
+        when cancelled
+
+        sent is when its command was sent: acknowledgements that came
+        earlier are stale and dropped, and the latency is recorded.
+        """
+        while True:
+            arrival = self.wait(self.acks, timeout, is_cancelled)
+            if arrival is None or sent is None:
+                return arrival
+            if arrival >= sent:
+                self.latencies.append(arrival - sent)
+                return arrival
+
+    def wait_message(self, name, timeout, is_cancelled=lambda: False):
+        """(args, arrival) of the next message name, None on timeout or when
+        cancelled"""
+        return self.wait(self.messages[name], timeout, is_cancelled)
+
+    def latency_summary(self):
+        """acknowledgement latencies as a line of text"""
+        if not self.latencies:
+            return 'ack latency: none recorded'
+        latencies = 1000 * np.array(self.latencies)
+        return 'ack latency: {}, median {:.2f} ms, p99 {:.2f} ms, ' \
+            'max {:.2f} ms'.format(len(latencies), np.median(latencies),
+                                   np.percentile(latencies, 99),
+                                   latencies.max())
@@ -0,0 +1,60 @@
+# Regression test of the scheduling and timing paths on the simulated rig
+#
+# A short block runs through SimulatedRig like the GUI runs it, host
+# scheduled and on the board clock (--batch). Each takes about 6 s: the Z
+# step always flushes for 3 s on the board. Run with python -m pytest.
+
+import pytest
+
+from pattern_scheduler import ACQUISITION_ON, compile_pattern, \
+    pattern_parser
+from rig_simulator import ODOR_VALVES, SimulatedRig, run_block
+from ttl_waveform import split_triggers
+import valve_board
+
+PATTERN = 'Z3_A1;1'
+# short acquisitions, the odor command still goes out after the flush
+TIMING = {'acquisition_pre': 4500, 'acquisition_post': 500}
+START_LINE = 'USB6000/pfi0'
+STOP_LINE = 'USB6000/pfi1'
+# ms an odor onset or a trigger edge may be off the plan
+TOLERANCE = 5.
+
+
+@pytest.mark.parametrize('batch', [False, True], ids=['host', 'batch'])
+def test_block_timing(batch):
+    rig = SimulatedRig()
+    try:
+        (runner, reader, train, planned_onsets, onsets, planned_triggers,
+         triggers) = run_block(rig, PATTERN, batch, START_LINE, **TIMING)
+    finally:
+        rig.close()
+    origin = runner.scheduler.origin if batch else runner.origin
+    stops = [1000 * (t - origin) for t in rig.daq.rising_edges(STOP_LINE)]
+
+    if batch:
+        assert runner.error is None
+        assert not runner.aborted
+        assert runner.events[-1].code == valve_board.SEQUENCE_DONE
+    else:
+        assert not runner.cancelled
+        assert len(runner.records) == len(runner.timeline)
+
+    assert len(onsets) == len(planned_onsets) == 1
+    for planned, actual in zip(planned_onsets, onsets):
+        assert abs(actual - planned) < TOLERANCE
+
+    acquisitions, _ = split_triggers(compile_pattern(
+        pattern_parser(PATTERN), ODOR_VALVES, **TIMING))
+    assert [a.label for a in acquisitions] == ['A']
+    assert planned_triggers == [a.start for a in acquisitions]
+    assert [edge.planned for edge in train.edges] == sorted(
+        t for a in acquisitions
+        for t in (a.start, a.start + ACQUISITION_ON,
+                  a.stop, a.stop + ACQUISITION_ON))
+    for edge in train.edges:
+        assert abs(edge.actual - edge.planned) < TOLERANCE
+    assert len(triggers) == len(stops) == len(acquisitions)
+    for acquisition, start, stop in zip(acquisitions, triggers, stops):
+        assert abs(start - acquisition.start) < TOLERANCE
+        assert abs(stop - acquisition.stop) < TOLERANCE
@@ -0,0 +1,92 @@
+# Tests of the batch mode step table, without hardware
+#
+# compile_steps must turn the valve commands of a compile_pattern timeline
+# into the same steps at the same times, and add_step must reach
+# odor_delivery_valve.ino packed as its Step struct ('Lbcii' on an ATmega:
+# unsigned long, byte, char and two 2-byte ints).
+
+import PyCmdMessenger
+import pytest
+
+from pattern_scheduler import compile_pattern, pattern_parser
+from precise_timing import clock, sleep_ms
+from rig_simulator import ODOR_VALVES, SimulatedValveBoard
+from valve_board import NO_VALVE, STEP_CO2, STEP_EXTRA_FLUSH, STEP_ODOR, \
+    STEP_ODOR_CO2, STEP_SWITCH_PANEL, VALVE_COMMANDS, Step, compile_steps, \
+    upload_steps
+
+# flush, odor with CO2 and its acquisition, CO2, switch of the panels
+PATTERN = 'Z10_AW3_W1_#'
+STEPS = [Step(0, STEP_EXTRA_FLUSH, NO_VALVE, 300, 100),
+         Step(8995, STEP_ODOR_CO2, 'A', 300, 0),
+         Step(12995, STEP_CO2, NO_VALVE, 100, 0),
+         Step(13995, STEP_EXTRA_FLUSH, NO_VALVE, 300, 2100),
+         Step(46995, STEP_SWITCH_PANEL, NO_VALVE, 0, 0),
+         Step(46995, STEP_EXTRA_FLUSH, NO_VALVE, 300, 2100)]
+
+
+def test_compile_steps():
+    timeline = compile_pattern(pattern_parser(PATTERN), ODOR_VALVES)
+    steps, host_timeline = compile_steps(timeline)
+
+    assert steps == STEPS
+    sends = [event for event in timeline if event.action == 'send']
+    assert [step.start for step in steps] == [event.time for event in sends]
+    # the board reports the valve acknowledgements, the host keeps the
+    # triggers
+    assert host_timeline == [event for event in timeline
+                             if event.action not in ('send', 'ack')]
+    assert [(event.time, event.args) for event in host_timeline] == [
+        (3000, (True, False)), (3005, (False, False)),
+        (33000, (False, True)), (33005, (False, False))]
+
+
+def test_compile_steps_rejects_host_commands():
+    timeline = compile_pattern(pattern_parser('A1'), ODOR_VALVES)
+    timeline[0] = timeline[0]._replace(args=('purge_system', 1))
+    with pytest.raises(ValueError):
+        compile_steps(timeline)
+
+
+class WiredValveBoard(SimulatedValveBoard):
+    """simulated valve board keeping the bytes of the last write"""
+
+    def write(self, msg):
+        self.last_write = bytes(msg)
+        SimulatedValveBoard.write(self, msg)
+
+
+@pytest.fixture
+def board():
+    board = WiredValveBoard(latency=0.)
+    yield board
+    board.close()
+
+
+def test_add_step_packing(board):
+    cmd = PyCmdMessenger.CmdMessenger(board, VALVE_COMMANDS)
+    # ';' as the low byte of start and ',' of dur1 have to be escaped
+    cmd.send('add_step', *Step(59, STEP_ODOR, 'A', 300, 0))
+    assert board.last_write == (b'8,/;/\x00/\x00/\x00,\x02,A,'
+                                b'/,\x01,/\x00/\x00;')
+
+
+def test_add_step_round_trip(board):
+    cmd = PyCmdMessenger.CmdMessenger(board, VALVE_COMMANDS)
+    steps = [Step(59, STEP_ODOR, 'A', 300, 0),
+             Step(2 ** 32 - 1, STEP_EXTRA_FLUSH, NO_VALVE, 300, 2 ** 15 - 1),
+             Step(44, STEP_ODOR_CO2, 'U', 47, 0)] + STEPS
+    upload_steps(cmd, steps)
+    deadline = clock() + 2.
+    while len(board.steps) < len(steps) and clock() < deadline:
+        sleep_ms(10)
+    assert board.steps == steps
+
+
+def test_add_step_range(board):
+    cmd = PyCmdMessenger.CmdMessenger(board, VALVE_COMMANDS)
+    # durations are 2-byte ints of 10 ms on the board, at most 327 s
+    with pytest.raises(OverflowError):
+        cmd.send('add_step', *Step(0, STEP_ODOR, 'A', 2 ** 15, 0))
+    with pytest.raises(OverflowError):
+        cmd.send('add_step', *Step(2 ** 32, STEP_ODOR, 'A', 100, 0))
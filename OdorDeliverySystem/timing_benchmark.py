@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Compare the old busy-wait wait_ms with precise_timing.sleep_ms
+#
+# Several threads wait at the same time, like go_through_pattern, the DAQ
+# trigger threads and the CO2 thread of a session do. For each wait the
+# lateness against the requested duration is kept, and the CPU time of the
+# process is compared to the wall time.
+# Run in terminal: python timing_benchmark.py [--threads 1 4] [--waits 5 50]
+
+import argparse
+from datetime import datetime
+import threading
+import time
+
+import numpy as np
+
+from precise_timing import clock, sleep_ms
+
+THREADS = (1, 4)
+WAITS_MS = (1, 5, 50, 200)
+# total time each thread spends waiting for one wait duration, in seconds
+SECONDS_PER_CASE = 2.
+
+
+def busy_wait_ms(ms, is_cancelled=lambda: False):
+    """the former wait_ms of MarkesSingleOdorants.py"""
+    time_ori = datetime.now()
+    while True:
+        time_elapse = datetime.now() - time_ori
+        # convert to ms
+        time_elapse_ms = time_elapse.seconds * 1000 + \
+            time_elapse.microseconds / 1000
+        # need to constantly check if interrupted
+        if is_cancelled() or time_elapse_ms > ms:
+            break
+
+
+def run_case(wait, ms, num_threads, seconds=SECONDS_PER_CASE):
+    """wait ms repeatedly in num_threads threads, return lateness and load"""
+    repeats = max(int(seconds * 1000 / ms), 5)
+    lateness = [[] for _ in range(num_threads)]
+
+    def waiter(late):
+        for _ in range(repeats):
+            started = clock()
+            wait(ms)
+            late.append(1000 * (clock() - started) - ms)
+
+    threads = [threading.Thread(target=waiter, args=(late,))
+               for late in lateness]
+    wall, cpu = clock(), time.process_time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall, cpu = clock() - wall, time.process_time() - cpu
+    return np.concatenate(lateness), cpu / wall
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='jitter and CPU load of busy and hybrid waits')
+    parser.add_argument('--threads', type=int, nargs='+', default=THREADS,
+                        help='numbers of threads waiting at the same time')
+    parser.add_argument('--waits', type=float, nargs='+', default=WAITS_MS,
+                        help='wait durations in ms')
+    parser.add_argument('--seconds', type=float, default=SECONDS_PER_CASE,
+                        help='time each thread waits per case')
+    args = parser.parse_args()
+
+    print('method\tthreads\twait(ms)\tlate p50/p99/max (ms)\tCPU cores')
+    for name, wait in (('busy', busy_wait_ms), ('hybrid', sleep_ms)):
+        for num_threads in args.threads:
+            for ms in args.waits:
+                late, load = run_case(wait, ms, num_threads, args.seconds)
+                print('{}\t{}\t{:g}\t\t{:.3f}/{:.3f}/{:.3f}\t\t{:.2f}'.format(
+                    name, num_threads, ms, np.percentile(late, 50),
+                    np.percentile(late, 99), late.max(), load
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+# Detection of the Markes trap fire on a buffered digital input
+#
+# daq_ttl_thread_markes used to call daq_task2.read() in a loop that never
+# ended unless the trap fired, debouncing by asking for four True reads in a
+# row, so its time resolution and CPU load were those of USB round trips.
+# Here the fire line is acquired in chunks of samples, from a sample-clocked
+# DAQ task where the device has one, else by polling as fast as the DAQ
+# answers (the USB-6000 only has software-timed lines). Each chunk is
+# searched at once with numpy for the first run of DEBOUNCE high samples, so
+# the fire time is the time of its first sample, and the wait has a timeout
+# and can be cancelled. The inputs are made with a task factory, nidaqmx.Task
+# or SimulatedDAQ.Task of rig_simulator.py.
+
+import threading
+
+import numpy as np
+
+from precise_timing import clock
+
+try:
+    from nidaqmx.constants import AcquisitionType
+    CONTINUOUS = AcquisitionType.CONTINUOUS
+except ImportError:  # the simulated DAQ ignores the sample mode
+    CONTINUOUS = None
+
+# samples per second of a clocked input
+SAMPLE_RATE = 10000.
+# seconds acquired per read
+CHUNK = .01
+# high samples in a row needed for a fire, single samples may be noise
+DEBOUNCE = 4
+# seconds to wait for a fire, the whole recording of trigger_markes
+FIRE_TIMEOUT = 90.
+# seconds of samples the DAQ buffers for a clocked input
+BUFFER = 1.
+
+
+def find_fire(levels, run, debounce=DEBOUNCE):
+    """index of the first sample of the first run of debounce high levels,
+    or None, and the number of high levels ending the chunk
+
+    run is the number of high levels that ended the previous chunk, an index
+    below 0 means the fire started in it.
+    """
+    levels = np.asarray(levels, dtype=bool)
+    carried = min(run, debounce - 1)
+    high = np.concatenate((np.ones(carried, dtype=int), levels))
+    # number of high levels in the window of debounce samples ending at i
+    total = np.cumsum(high)
+    total[debounce:] = total[debounce:] - total[:-debounce]
+    found = np.flatnonzero(total[debounce - 1:] == debounce)
+    lows = np.flatnonzero(~levels)
+    trailing = int(len(levels) - 1 - lows[-1]) if len(lows) \
+        else run + len(levels)
+    if not len(found):
+        return None, trailing
+    return int(found[0]) - carried, trailing
+
+
+class ClockedInput(object):
+    """digital input line acquired on the sample clock of the DAQ
+
+    The time of a sample is its index over the rate after the moment the
+    task was started, taken on the host.
+    """
+
+    def __init__(self, new_task, line, rate=SAMPLE_RATE, chunk=CHUNK):
+        self.rate = rate
+        self.samples_per_read = max(int(round(rate * chunk)), 1)
+        self.task = new_task()
+        self.task.di_channels.add_di_chan(line)
+        self.task.timing.cfg_samp_clk_timing(
+            rate, sample_mode=CONTINUOUS,
+            samps_per_chan=max(int(rate * BUFFER), self.samples_per_read)
+        )
+        # raises here if the device can't clock its lines
+        self.start()
+        self.stop()
+
+    def start(self):
+        before = clock()
+        self.task.start()
+        self.started = (before + clock()) / 2
+        self.samples = 0
+
+    def read(self):
+        """levels and clock() times of the next chunk of samples"""
+        levels = np.asarray(self.task.read(
+            number_of_samples_per_channel=self.samples_per_read
+        ), dtype=bool)
+        times = self.started + (self.samples + np.arange(len(levels))) / \
+            self.rate
+        self.samples += len(levels)
+        return levels, times
+
+    def stop(self):
+        self.task.stop()
+
+    def close(self):
+        self.task.close()
+
+
+class PolledInput(object):
+    """digital input line read sample by sample for chunk seconds"""
+
+    def __init__(self, new_task, line, chunk=CHUNK):
+        self.chunk = chunk
+        self.task = new_task()
+        self.task.di_channels.add_di_chan(line)
+
+    def start(self):
+        pass
+
+    def read(self):
+        levels, times = [], []
+        end = clock() + self.chunk
+        while not times or times[-1] < end:
+            levels.append(self.task.read())
+            times.append(clock())
+        return np.array(levels, dtype=bool), np.array(times)
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.task.close()
+
+
+def open_input(new_task, line, rate=SAMPLE_RATE, chunk=CHUNK):
+    """clocked input of line if the DAQ can, else a polled one"""
+    try:
+        return ClockedInput(new_task, line, rate, chunk)
+    except Exception as error:  # nidaqmx.DaqError, or no timing at all
+        print('{} is polled, no sample clock: {}'.format(
+            line, str(error).splitlines()[0] if str(error) else error))
+        return PolledInput(new_task, line, chunk)
+
+
+class TrapFireDetector(threading.Thread):
+    """wait in a thread for the trap of the Markes to fire on source
+
+    A fire is a rising edge, so the line must have been low once before.
+    on_fire(detector) is called at the end, with fire_time the clock() time
+    of the first high sample of the fire, or None after timeout seconds or
+    when is_cancelled() returned True; delay is how long after the fire it
+    was detected.
+    """
+
+    def __init__(self, source, timeout=FIRE_TIMEOUT,
+                 is_cancelled=lambda: False, on_fire=None,
+                 debounce=DEBOUNCE):
+        threading.Thread.__init__(self, name='TrapFireDetector')
+        self.daemon = True
+        self.source = source
+        self.timeout = timeout
+        self.is_cancelled = is_cancelled
+        self.on_fire = on_fire
+        self.debounce = debounce
+        self.fire_time = None
+        self.delay = None
+        self.samples = 0
+
+    def run(self):
+        deadline = clock() + self.timeout
+        run, run_start = 0, None
+        armed = False
+        self.source.start()
+        try:
+            while not self.is_cancelled() and clock() < deadline:
+                levels, times = self.source.read()
+                self.samples += len(levels)
+                if not armed:
+                    lows = np.flatnonzero(~levels)
+                    if not len(lows):
+                        continue
+                    armed = True
+                    levels, times = levels[lows[0]:], times[lows[0]:]
+                start, trailing = find_fire(levels, run, self.debounce)
+                if start is not None:
+                    self.fire_time = times[start] if start >= 0 \
+                        else run_start
+                    self.delay = clock() - self.fire_time
+                    break
+                if trailing and trailing <= len(levels):
+                    run_start = times[len(levels) - trailing]
+                run = trailing
+        finally:
+            self.source.stop()
+        if self.on_fire is not None:
+            self.on_fire(self)
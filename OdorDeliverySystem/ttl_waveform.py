@@ -0,0 +1,290 @@
+# ScanImage start/stop triggers played as one precomputed waveform
+#
+# The acquisition triggers used to be written one level at a time, with
+# waits of acquisition_on ms in between and the cost of each write measured
+# and subtracted. Here all start (pfi0) and stop (pfi1) pulses of a trial are
+# rendered into one digital buffer, and played from a single thread. Where
+# the DAQ has a sample clock the buffer goes to one hardware-timed task, so
+# pulse widths and positions are exact to the sample. Otherwise (the lines
+# of the USB-6000 are software timed) the transitions of the buffer are
+# written at their absolute deadlines, and how late each one was is
+# reported. Outputs are made with a task factory, nidaqmx.Task or
+# SimulatedDAQ.Task of rig_simulator.py, like the inputs of trap_fire.py.
+
+from collections import namedtuple
+import threading
+
+import numpy as np
+
+from pattern_scheduler import ACQUISITION_ON
+from precise_timing import clock, wait_until
+
+try:
+    from nidaqmx.constants import AcquisitionType
+    FINITE = AcquisitionType.FINITE
+except ImportError:  # the simulated DAQ ignores the sample mode
+    FINITE = None
+
+# samples per second of the waveform, the timeline is in whole ms
+RATE = 1000.
+# seconds from setting up a block to its start, so the trigger task is
+# ready to start on time
+LEAD = .05
+# index of the start and the stop line in the waveform
+START = 0
+STOP = 1
+
+# an acquisition of ScanImage, from the start to the stop pulse, in ms from
+# the start of the trial; label: e.g. the odor it records
+Acquisition = namedtuple('Acquisition', 'start stop label')
+# a change of the trigger lines, planned and actual time in ms from the
+# start of the trial, and the levels of (start, stop) after it
+Edge = namedtuple('Edge', 'planned actual levels')
+
+
+def split_triggers(timeline):
+    """acquisitions of the 'daq' events of a pattern_scheduler timeline,
+    and the other events"""
+    acquisitions = []
+    rest = []
+    for event in timeline:
+        if event.action != 'daq':
+            rest.append(event)
+        elif event.args[STOP] and event.cleanup is not None:
+            # a stop trigger refers to its start trigger
+            acquisitions.append(Acquisition(
+                event.cleanup.time, event.time,
+                event.label.split(' ')[-1]
+            ))
+    acquisitions.sort()
+    return acquisitions, rest
+
+
+def render(acquisitions, width=ACQUISITION_ON, rate=RATE):
+    """levels of the (start, stop) lines at each sample, pulses of width ms"""
+    if not acquisitions:
+        return np.zeros((2, 0), dtype=bool)
+    last = max(acquisition.stop for acquisition in acquisitions)
+    # and end low
+    samples = int(np.ceil((last + width) * rate / 1000.)) + 1
+    pulse = max(int(round(width * rate / 1000.)), 1)
+    waveform = np.zeros((2, samples), dtype=bool)
+    for acquisition in acquisitions:
+        for line, at in ((START, acquisition.start),
+                         (STOP, acquisition.stop)):
+            first = int(round(at * rate / 1000.))
+            waveform[line, first:first + pulse] = True
+    return waveform
+
+
+def transitions(waveform, rate=RATE):
+    """times in ms at which the levels of waveform change, and the levels
+    from then on"""
+    before = np.concatenate((np.zeros((2, 1), dtype=bool),
+                             waveform[:, :-1]), axis=1)
+    index = np.flatnonzero(np.any(waveform != before, axis=0))
+    return index * 1000. / rate, waveform[:, index].T
+
+
+class HardwareOutput(object):
+    """trigger lines played on the sample clock of the DAQ"""
+
+    timing = 'hardware'
+
+    def __init__(self, new_task, lines, rate=RATE):
+        self.new_task = new_task
+        self.lines = lines
+        self.rate = rate
+        # raises here if the device can't clock its lines
+        self.play(np.zeros((2, 2), dtype=bool), clock())
+
+    def open_task(self):
+        task = self.new_task()
+        for line in self.lines:
+            task.do_channels.add_do_chan(line)
+        return task
+
+    def play(self, waveform, origin, is_cancelled=lambda: False):
+        """play waveform from the clock() time origin, return its edges up
+        to when it was cancelled"""
+        task = self.open_task()
+        try:
+            task.timing.cfg_samp_clk_timing(
+                self.rate, sample_mode=FINITE,
+                samps_per_chan=waveform.shape[1]
+            )
+            task.write(waveform.tolist(), auto_start=False)
+            if not wait_until(origin, is_cancelled):
+                return []
+            before = clock()
+            task.start()
+            offset = 1000 * ((before + clock()) / 2 - origin)
+            duration = waveform.shape[1] / self.rate
+            if wait_until(origin + offset / 1000. + duration, is_cancelled):
+                task.wait_until_done(timeout=duration + 10.)
+                played = duration * 1000
+            else:
+                played = 1000 * (clock() - origin) - offset
+            task.stop()
+        finally:
+            task.close()
+        times, levels = transitions(waveform, self.rate)
+        return [Edge(t, t + offset, tuple(level.tolist()))
+                for t, level in zip(times, levels) if t <= played]
+
+    def pulse(self, line, width=ACQUISITION_ON):
+        """a single pulse of width ms on line right away"""
+        task = self.open_task()
+        try:
+            pulse_now(task, line, width)
+        finally:
+            task.close()
+
+    def idle(self):
+        """both lines low, they keep their level when a task stops"""
+        task = self.open_task()
+        try:
+            task.write([False, False])
+        finally:
+            task.close()
+
+    def close(self):
+        pass
+
+
+class SoftwareOutput(object):
+    """trigger lines written at the transitions of the waveform"""
+
+    timing = 'software'
+
+    def __init__(self, new_task, lines, rate=RATE):
+        self.rate = rate
+        self.task = new_task()
+        for line in lines:
+            self.task.do_channels.add_do_chan(line)
+
+    def play(self, waveform, origin, is_cancelled=lambda: False):
+        edges = []
+        for t, level in zip(*transitions(waveform, self.rate)):
+            if not wait_until(origin + t / 1000., is_cancelled):
+                break
+            before = clock()
+            self.task.write(level.tolist())
+            # the lines change during the write
+            actual = 1000 * ((before + clock()) / 2 - origin)
+            edges.append(Edge(t, actual, tuple(level.tolist())))
+        return edges
+
+    def pulse(self, line, width=ACQUISITION_ON):
+        pulse_now(self.task, line, width)
+
+    def idle(self):
+        self.task.write([False, False])
+
+    def close(self):
+        self.task.close()
+
+
+def pulse_now(task, line, width):
+    levels = [False, False]
+    levels[line] = True
+    start = clock()
+    task.write(levels)
+    wait_until(start + width / 1000.)
+    task.write([False, False])
+
+
+def open_output(new_task, lines, rate=RATE):
+    """hardware-timed output of the (start, stop) lines if the DAQ can,
+    else a software-timed one"""
+    try:
+        return HardwareOutput(new_task, lines, rate)
+    except Exception as error:  # nidaqmx.DaqError, or no timing at all
+        print('{} are software timed, no sample clock: {}'.format(
+            ', '.join(lines),
+            str(error).splitlines()[0] if str(error) else error))
+        return SoftwareOutput(new_task, lines, rate)
+
+
+class TriggerTrain(threading.Thread):
+    """play the trigger pulses of acquisitions from origin on output
+
+    origin is a clock() time, by default when the thread starts; it may be
+    set until then. When is_cancelled() returns True, acquisitions whose
+    start pulse was played are stopped with a pulse right away.
+    on_finished(train) is called at the end.
+    """
+
+    def __init__(self, output, acquisitions, width=ACQUISITION_ON,
+                 origin=None, is_cancelled=lambda: False, on_finished=None):
+        threading.Thread.__init__(self, name='TriggerTrain')
+        self.daemon = True
+        self.output = output
+        self.acquisitions = acquisitions
+        self.width = width
+        self.origin = origin
+        self.is_cancelled = is_cancelled
+        self.on_finished = on_finished
+        self.waveform = render(acquisitions, width, output.rate)
+        self.edges = []
+        self.stopped_early = []
+
+    def run(self):
+        if self.origin is None:
+            self.origin = clock()
+        self.edges = self.output.play(self.waveform, self.origin,
+                                      self.is_cancelled)
+        if self.is_cancelled():
+            # e.g. stopped in the middle of a pulse
+            self.output.idle()
+            for acquisition in self.acquisitions:
+                if self.played(START, acquisition.start) and \
+                        not self.played(STOP, acquisition.stop):
+                    self.output.pulse(STOP, self.width)
+                    self.stopped_early.append(acquisition)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def played(self, line, at):
+        """whether the pulse on line planned at ms was played"""
+        # within a sample of the plan
+        return any(edge.levels[line] and
+                   abs(edge.planned - at) < 1000. / self.output.rate
+                   for edge in self.edges)
+
+    def edge_label(self, edge):
+        """label of the acquisition edge starts or stops, else ''"""
+        for acquisition in self.acquisitions:
+            if edge.levels[START] and \
+                    abs(edge.planned - acquisition.start) < 1 or \
+                    edge.levels[STOP] and \
+                    abs(edge.planned - acquisition.stop) < 1:
+                return acquisition.label
+        return ''
+
+    def lateness(self):
+        """actual minus planned time of each edge, in ms"""
+        return [edge.actual - edge.planned for edge in self.edges]
+
+    def report(self):
+        """lines of planned vs actual edges, and a jitter summary"""
+        lines = ['planned(ms)\tactual(ms)\tlate(ms)\ttrigger lines']
+        for edge in self.edges:
+            lines.append('{:.1f}\t{:.1f}\t{:.2f}\t{} {}'.format(
+                edge.planned, edge.actual, edge.actual - edge.planned,
+                edge.levels, self.edge_label(edge)
+            ))
+        lateness = np.array(self.lateness())
+        if len(lateness):
+            lines.append(
+                '{} timed triggers: {} edges, late by mean {:.3f} ms, '
+                'jitter (sd) {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'.format(
+                    self.output.timing, len(lateness), lateness.mean(),
+                    lateness.std(), np.percentile(lateness, 99),
+                    lateness.max()
+                )
+            )
+        for acquisition in self.stopped_early:
+            lines.append('stopped early: acquisition for ' +
+                         acquisition.label)
+        return lines
@@ -0,0 +1,239 @@
+# Odor sequences run autonomously by the valve Arduino
+#
+# In batch mode the timeline of a block (pattern_scheduler.compile_pattern)
+# is split in two. Its valve commands become a compact step table that is
+# uploaded once to odor_delivery_valve.ino, which runs the steps on its own
+# clock and reports their progress as timestamped step_event messages. The
+# DAQ triggers stay on the host, scheduled on the board clock as estimated
+# from those messages. The trial timing then no longer depends on USB
+# latency or host scheduling.
+
+from collections import namedtuple
+import threading
+
+from pattern_scheduler import PatternScheduler
+from precise_timing import clock
+
+# commands of odor_delivery_valve.ino, in the same order as its enum
+VALVE_COMMANDS = [['open_odor_valve', 'ci'],
+                  ['switch_panel', ''],
+                  ['extra_flush', 'ii'],
+                  ['purge_system', 'i'],
+                  ['solvent_wash', ''],
+                  ['open_CO2_valve', 'i'],
+                  ['open_odor_CO2', 'ci'],
+                  # batch mode
+                  ['clear_steps', ''],
+                  ['add_step', 'Lbcii'],
+                  ['run_steps', ''],
+                  ['abort_steps', ''],
+                  ['step_event', 'iiL']]
+
+# step actions and step_event codes, need to be consistent with the board
+STEP_EXTRA_FLUSH = 0
+STEP_SWITCH_PANEL = 1
+STEP_ODOR = 2
+STEP_ODOR_CO2 = 3
+STEP_CO2 = 4
+SEQUENCE_STARTED = 0
+STEP_STARTED = 1
+VALVE_OPENED = 2
+VALVE_CLOSED = 3
+SEQUENCE_DONE = 4
+SEQUENCE_ABORTED = 5
+EVENT_NAMES = ['sequence started', 'step started', 'valve opened',
+               'valve closed', 'sequence done', 'sequence aborted']
+# size of the step table on the board
+MAX_STEPS = 200
+# valve of the steps without odor channel
+NO_VALVE = '-'
+# seconds to wait for the board to start the sequence or confirm an abort
+START_TIMEOUT = 5.
+ABORT_TIMEOUT = 2.
+# latest board messages used to estimate the board clock
+SYNC_WINDOW = 16
+
+# a row of the step table, start in ms from the start of the run and
+# durations in units of 10ms
+Step = namedtuple('Step', 'start action valve dur1 dur2')
+# a step_event, board time and host arrival time in ms from the run start
+BoardEvent = namedtuple('BoardEvent', 'step code board_ms host_ms')
+
+
+def command_step(start, command):
+    """the step running command, as sent by go_through_pattern, at start"""
+    name, args = command[0], command[1:]
+    if name == 'extra_flush':
+        return Step(start, STEP_EXTRA_FLUSH, NO_VALVE, args[0], args[1])
+    if name == 'switch_panel':
+        return Step(start, STEP_SWITCH_PANEL, NO_VALVE, 0, 0)
+    if name == 'open_odor_valve':
+        return Step(start, STEP_ODOR, args[0], args[1], 0)
+    if name == 'open_odor_CO2':
+        return Step(start, STEP_ODOR_CO2, args[0], args[1], 0)
+    if name == 'open_CO2_valve':
+        return Step(start, STEP_CO2, NO_VALVE, args[0], 0)
+    raise ValueError("command '{}' can't run in batch mode".format(name))
+
+
+def compile_steps(timeline):
+    """split a timeline into the step table and the events left to the host
+
+    The valve acknowledgements of the timeline are dropped, the board
+    reports the same moments as step events.
+    """
+    steps = []
+    host_timeline = []
+    for event in timeline:
+        if event.action == 'send':
+            steps.append(command_step(int(round(event.time)), event.args))
+        elif event.action != 'ack':
+            host_timeline.append(event)
+    if len(steps) > MAX_STEPS:
+        raise ValueError('{} steps, the board holds at most {}'.format(
+            len(steps), MAX_STEPS))
+    return steps, host_timeline
+
+
+def upload_steps(cmd, steps):
+    """replace the step table of the board"""
+    cmd.send('clear_steps')
+    for step in steps:
+        cmd.send('add_step', *step)
+
+
+class BoardSequence(threading.Thread):
+    """upload steps to the valve board, run them and follow their progress
+
+    Board messages come from reader, its serial_demux.BoardReader.
+    host_timeline is executed by a PatternScheduler with actions, aligned
+    to the board clock. on_event(sequence, board_event) is called for every
+    step_event and on_finished(sequence) at the end, both from this thread.
+    When is_cancelled() returns True the board is told to abort.
+    """
+
+    def __init__(self, cmd, reader, steps, host_timeline, actions,
+                 is_cancelled=lambda: False, on_finished=None,
+                 on_event=None):
+        threading.Thread.__init__(self, name='BoardSequence')
+        self.daemon = True
+        self.cmd = cmd
+        self.reader = reader
+        self.steps = steps
+        self.is_cancelled = is_cancelled
+        self.on_finished = on_finished
+        self.on_event = on_event
+        self.events = []
+        self.offsets = []
+        self.error = None
+        self.aborted = False
+        self.scheduler = PatternScheduler(
+            host_timeline, actions,
+            is_cancelled=lambda: self.aborted or is_cancelled()
+        )
+
+    def receive_event(self, timeout, is_cancelled=lambda: False):
+        """next step_event as (step, code, board_ms, arrival), else None"""
+        message = self.reader.wait_message('step_event', timeout,
+                                           is_cancelled)
+        if message is None:
+            return None
+        args, arrival = message
+        return tuple(args) + (arrival,)
+
+    def synchronize(self, board_ms, arrival):
+        """move the host scheduler origin to the board run start"""
+        # the message that travelled fastest gives the best estimate
+        self.offsets.append(arrival - board_ms / 1000.)
+        del self.offsets[:-SYNC_WINDOW]
+        self.scheduler.origin = min(self.offsets)
+
+    def record(self, step, code, board_ms, arrival):
+        event = BoardEvent(step, code, board_ms,
+                           1000 * (arrival - self.scheduler.origin))
+        self.events.append(event)
+        if self.on_event is not None:
+            self.on_event(self, event)
+        return event
+
+    def run(self):
+        # stale acknowledgements of earlier commands would garble messages
+        self.reader.set_message_mode(True)
+        upload_steps(self.cmd, self.steps)
+        self.cmd.send('run_steps')
+        started = self.receive_event(START_TIMEOUT)
+        if started is None or started[1] != SEQUENCE_STARTED:
+            self.error = 'the valve board did not start the sequence'
+        elif started[0] != len(self.steps):
+            self.error = 'the valve board took {} of {} steps'.format(
+                started[0], len(self.steps))
+            self.cmd.send('abort_steps')
+        if self.error is not None:
+            self.finish()
+            return
+
+        self.synchronize(started[2], started[3])
+        self.record(*started)
+        self.scheduler.start()
+        abort_sent = None
+        while True:
+            if abort_sent is None and self.is_cancelled():
+                self.cmd.send('abort_steps')
+                abort_sent = clock()
+            message = self.receive_event(
+                ABORT_TIMEOUT,
+                lambda: abort_sent is None and self.is_cancelled()
+            )
+            if message is None:
+                if abort_sent is not None and \
+                        clock() - abort_sent > ABORT_TIMEOUT:
+                    self.error = 'the valve board did not confirm the abort'
+                    self.aborted = True
+                    break
+                continue
+            self.synchronize(message[2], message[3])
+            code = self.record(*message).code
+            if code == SEQUENCE_ABORTED:
+                self.aborted = True
+            if code in (SEQUENCE_DONE, SEQUENCE_ABORTED):
+                break
+        # e.g. the stop trigger of the last acquisition is still due
+        self.scheduler.join()
+        self.finish()
+
+    def finish(self):
+        self.reader.set_message_mode(False)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def step_lateness(self):
+        """board start minus planned start of each step, in ms"""
+        return [event.board_ms - self.steps[event.step].start
+                for event in self.events if event.code == STEP_STARTED]
+
+    def report(self):
+        """lines of the board events and host events, and summaries"""
+        lines = ['board(ms)\thost(ms)\tplanned(ms)\tevent']
+        for event in self.events:
+            if event.step < len(self.steps) and event.code in (
+                    STEP_STARTED, VALVE_OPENED, VALVE_CLOSED):
+                step = self.steps[event.step]
+                what = 'step {} {}'.format(event.step, step)
+                planned = '{}'.format(step.start) \
+                    if event.code == STEP_STARTED else ''
+            else:
+                what, planned = '', ''
+            lines.append('{}\t{:.1f}\t{}\t{} {}'.format(
+                event.board_ms, event.host_ms, planned,
+                EVENT_NAMES[event.code], what
+            ))
+        lateness = self.step_lateness()
+        if lateness:
+            lines.append(
+                'steps: {}, late on the board by mean {:.2f} ms, max {} ms'
+                .format(len(lateness), sum(lateness) / len(lateness),
+                        max(lateness))
+            )
+        if self.error is not None:
+            lines.append('error: ' + self.error)
+        return lines + self.scheduler.report()